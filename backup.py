@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+
+import engine
+from jobs import ConsoleProgress
+
+# Command line entry point for scheduled and headless use, e.g.
+#   python3 backup.py run --incremental
+#   python3 backup.py run --read-limit 40 --io-class idle --max-load 0.8
+#   python3 backup.py run --incremental --delta-min-size 256
+#   python3 backup.py list
+#   python3 backup.py restore 3 /tmp/restore --path documents/notes.txt
+#   python3 backup.py restore 5 /mnt/restore --writers 16
+#   python3 backup.py restore-at 2024-10-31 /tmp/restore
+#   python3 backup.py prune --keep-full 4
+#   python3 backup.py retain --keep-daily 7 --keep-weekly 4 --keep-monthly 12 --dry-run
+#   python3 backup.py gc
+#   python3 backup.py verify --deep
+#   python3 backup.py scrub --budget 30
+#   python3 backup.py watch
+#   python3 backup.py schedule
+# Settings not given on the command line come from user_config.ini. The
+# encryption password is read from --password-file or $BACKUP_PASSWORD.
+PASSWORD_ENV = 'BACKUP_PASSWORD'
+
+
+def read_password(args):
+    if args.password_file:
+        with open(args.password_file, 'r') as f:
+            return f.read().strip()
+    return os.environ.get(PASSWORD_ENV, '')
+
+
+def cmd_run(args, config):
+    password = read_password(args)
+    if config['encryption_enabled'] and not password:
+        raise engine.BackupError(f"Encryption is enabled; provide --password-file or set {PASSWORD_ENV}.")
+
+    codec = args.codec or config['compression']
+    level = args.level if args.level is not None else (config['compression_level'] if codec == config['compression'] else None)
+    from governor import governor_from_config
+    governor = governor_from_config(config, read_limit=args.read_limit, write_limit=args.write_limit, nice=args.nice,
+                                    io_class=args.io_class, max_workers=args.workers, max_load=args.max_load,
+                                    max_disk_await=args.max_await)
+    result = engine.run_backup(
+        args.source or config['source_dirs'],
+        args.dest or config['backup_dir'],
+        backup_type='Incremental' if args.incremental else 'Full',
+        password=password,
+        codec=codec,
+        level=level,
+        hash_files=config['content_hash'],
+        archive_format=args.format or config['archive_format'],
+        metrics_export=args.metrics_export or config['metrics_export'],
+        adaptive=config['adaptive_compression'] and not args.no_adaptive,
+        governor=governor,
+        use_journal=not args.full_scan,
+        delta_min_size=0 if args.no_delta else (args.delta_min_size if args.delta_min_size is not None
+                                                else config['delta_min_size']),
+    )
+    print(f"{result['backup_type']} backup saved as {result['backup_file']} in {result['backup_location']} ({result['size']} bytes)")
+    adaptive = result['details']['metrics'].get('adaptive')
+    if adaptive and adaptive['files_stored'] + adaptive['files_fast']:
+        saved = f", about {adaptive['cpu_saved']:.1f}s CPU saved" if adaptive['cpu_saved'] else ""
+        print(f"Stored {adaptive['files_stored']} incompressible file(s) uncompressed and compressed "
+              f"{adaptive['files_fast']} at the fast level{saved}")
+    throttled = result['details']['metrics'].get('throttled')
+    if throttled and throttled['total']:
+        reasons = ', '.join(f"{reason} {throttled[reason]:.1f}s" for reason in ('read', 'write', 'load', 'await')
+                            if throttled[reason])
+        print(f"Throttled for {throttled['total']:.1f}s ({reasons})")
+    delta = result['details']['metrics'].get('delta')
+    if delta and delta['files']:
+        print(f"Stored {delta['files']} large file(s) as block deltas: {delta['stored']} of {delta['bytes']} bytes "
+              f"({delta['ratio']:.1%})")
+        for item in delta['per_file'][:10]:
+            print(f"  {item['path']}: {item['stored']} of {item['size']} bytes ({item['ratio']:.1%})")
+    journal = result['details'].get('change_journal')
+    if journal:
+        for source in journal['used']:
+            print(f"{source}: changes read from the change journal")
+        for source, reason in journal['full_scan'].items():
+            print(f"{source}: scanned the full tree ({reason})")
+    unreadable = result['details'].get('unreadable')
+    if unreadable:
+        print(f"Warning: {len(unreadable)} path(s) could not be read and were left as in the previous backup:",
+              file=sys.stderr)
+        for path in unreadable[:20]:
+            print(f"  {path}", file=sys.stderr)
+
+    from retention import policy_from_config, apply_retention
+    policy = policy_from_config(config)
+    if policy and not args.no_retention:
+        print_retention_summary(apply_retention(policy, password, source_set=result['source_set']))
+
+
+def cmd_list(args, config):
+    for entry in engine.list_backups(limit=args.limit, backup_type=args.type):
+        print(engine.format_backup_entry(entry))
+
+
+def cmd_restore(args, config):
+    progress = ConsoleProgress() if sys.stderr.isatty() else None
+    try:
+        result = engine.restore_backup_by_version(args.version, args.target, read_password(args), paths=args.path,
+                                                  progress=progress, workers=args.writers,
+                                                  metrics_export=args.metrics_export or config['metrics_export'])
+    finally:
+        if progress is not None:
+            progress.done()
+    print(f"Backup restored to {args.target}: {result['files']} entries, "
+          f"{result['bytes_out'] / (1024 * 1024):.1f} MiB in {result['wall']:.1f}s ({result['mb_per_second'] or 0:.1f} MB/s)")
+
+
+def cmd_restore_at(args, config):
+    from point_in_time import restore_to_time
+    chain = restore_to_time(args.timestamp, args.target, read_password(args), source_dirs=args.source, paths=args.path)
+    print(f"Restored the state of {args.timestamp} from {len(chain)} backup(s) into {args.target}")
+
+
+def cmd_contents(args, config):
+    backup_path = engine.get_backup_path(engine.get_backup(args.version))
+    for entry in engine.list_archive_contents(backup_path, read_password(args)):
+        suffix = '/' if entry['type'] == 'dir' else ' (delta)' if entry['type'] == 'delta' else ''
+        print(f"{entry['size']:>12}  {entry['path']}{suffix}")
+
+
+def cmd_delete(args, config):
+    merged = engine.delete_backup(args.version, read_password(args))
+    if merged:
+        print(f"Backup merged into {merged['backup_file']} (id {merged['id']}), which depended on it.")
+    else:
+        print("Backup has been deleted.")
+
+
+def cmd_prune(args, config):
+    removed = engine.prune_backups(args.keep_full)
+    for entry in removed:
+        print(f"Removed {entry['backup_file']}")
+    print(f"{len(removed)} backup(s) removed.")
+
+
+def print_retention_summary(summary, dry_run=False):
+    verb = "Would" if dry_run else "Retention:"
+    for merge in summary['merged']:
+        print(f"{verb} merge {merge['backups']} backup(s) into {merge['into']}")
+    for backup_file in summary['deleted']:
+        print(f"{verb} delete {backup_file}")
+    if not dry_run:
+        print(f"{summary['kept']} restore point(s) kept, {summary['bytes_freed']} bytes freed.")
+
+
+def cmd_retain(args, config):
+    from retention import RetentionPolicy, apply_retention
+    policy = RetentionPolicy(*(config[f'keep_{period}'] if value is None else value
+                               for period, value in (('daily', args.keep_daily), ('weekly', args.keep_weekly),
+                                                     ('monthly', args.keep_monthly))))
+    if not any(policy):
+        raise engine.BackupError("No retention policy: pass --keep-daily/--keep-weekly/--keep-monthly or set them in the config.")
+    print_retention_summary(apply_retention(policy, read_password(args), dry_run=args.dry_run), args.dry_run)
+
+
+def cmd_gc(args, config):
+    removed, freed = engine.collect_repository_garbage(args.dest or config['backup_dir'], read_password(args))
+    print(f"Removed {removed} unreferenced pack(s), {freed} bytes freed.")
+
+
+def print_verification(result):
+    print(f"{result['status'].upper():8} {result['id']}. {result['backup_file']} "
+          f"({result['level']}, {result['files']} files, {result['bytes']} bytes read)")
+    for error in result['errors'][:20]:
+        print(f"         {error}")
+
+
+def report_verification(results):
+    failed = sum(1 for result in results if result['status'] not in ('ok', 'partial'))
+    partial = sum(1 for result in results if result['status'] == 'partial')
+    print(f"{len(results)} backup(s) checked, {failed} with problems"
+          + (f", {partial} to be finished by the next scrub." if partial else "."))
+    if failed:
+        raise engine.BackupError(f"{failed} backup(s) failed verification.")
+
+
+def cmd_verify(args, config):
+    from verify import verify
+    report_verification(verify(args.version, read_password(args), deep=args.deep, workers=args.workers,
+                               on_result=print_verification))
+
+
+def cmd_scrub(args, config):
+    from verify import scrub
+    budget = args.budget if args.budget is not None else config['scrub_minutes']
+    report_verification(scrub(budget * 60, read_password(args), deep=args.deep, workers=args.workers,
+                              on_result=print_verification))
+
+
+def cmd_watch(args, config):
+    from journal import ChangeJournal, ChangeWatcher
+    if args.status:
+        with ChangeJournal(engine.JOURNAL_FILE) as journal:
+            for row in journal.status():
+                age = f", last heartbeat {time.time() - row['heartbeat']:.0f}s ago" if row['heartbeat'] else ""
+                state = f"{row['status']}: {row['error']}" if row['error'] else row['status']
+                usable = f"{row['pending']} change(s) since the last backup" if row['usable'] else "next run scans fully"
+                print(f"{row['source']}: {state}{age}; {usable}")
+        return
+
+    import signal
+    import threading
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    watcher = ChangeWatcher(args.source or config['source_dirs'], engine.JOURNAL_FILE)
+    try:
+        watcher.run(stop, on_ready=lambda watches: print(f"Watching {watches} directories; Ctrl-C to stop",
+                                                         flush=True))
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_schedule(args, config):
+    import scheduler
+    script = os.path.abspath(__file__)
+    if args.install:
+        print(f"Installed: {scheduler.install_trigger(script)}")
+        return
+    if args.uninstall:
+        scheduler.remove_trigger(script)
+        print("Removed the scheduler trigger")
+        return
+    daemon = scheduler.Scheduler(read_password(args), log=lambda message: print(
+        f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True))
+    if args.status:
+        for job in daemon.status():
+            last = time.strftime('%Y-%m-%d %H:%M', time.localtime(job['last_run'])) if job['last_run'] else "never"
+            state = f"{job['status']}: {job['error']}" if job['error'] else job['status'] or "not run yet"
+            missed = f", {job['missed']} missed" if job['missed'] else ""
+            upcoming = time.strftime('%Y-%m-%d %H:%M', time.localtime(job['next_run'])) if job['enabled'] else "disabled"
+            print(f"{job['name']}: {job['backup_type'].lower()} {job['interval']} of {'; '.join(job['source_dirs'])} "
+                  f"to {job['backup_dir']}; last {last} ({state}{missed}); next {upcoming}")
+        return
+
+    import signal
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    try:
+        daemon.run(once=args.once)
+    except engine.BackupRunning as e:
+        if not args.once:
+            raise
+        print(e)    # A running daemon already takes care of the jobs
+    except KeyboardInterrupt:
+        pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='backup', description="Automated Backup Utility")
+    parser.add_argument('--password-file', help=f"file holding the encryption password (default: ${PASSWORD_ENV})")
+    parser.add_argument('--metrics-export', help="append run metrics to this JSON-lines file, or write a Prometheus textfile if it ends in .prom")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run a backup")
+    kind = run.add_mutually_exclusive_group()
+    kind.add_argument('--full', action='store_true', help="full backup (default)")
+    kind.add_argument('--incremental', action='store_true', help="only files changed since the last backup")
+    run.add_argument('--source', action='append', help="source directory (repeatable, default from config)")
+    run.add_argument('--dest', help="backup destination (default from config)")
+    run.add_argument('--codec', choices=['gzip', 'zstd'], help="compression codec")
+    run.add_argument('--level', type=int, help="compression level")
+    run.add_argument('--format', choices=engine.ARCHIVE_FORMATS, help="archive format (seekable allows single-file restore, repository deduplicates across runs)")
+    run.add_argument('--no-adaptive', action='store_true', help="compress every file, even already-compressed ones")
+    run.add_argument('--full-scan', action='store_true', help="walk the whole tree even if the change journal is usable")
+    run.add_argument('--delta-min-size', type=float, metavar='MB', help="store changed files of at least this size as block deltas")
+    run.add_argument('--no-delta', action='store_true', help="always store changed files whole")
+    run.add_argument('--no-retention', action='store_true', help="do not apply the configured retention policy afterwards")
+    run.add_argument('--read-limit', type=float, metavar='MB/S', help="limit reading the sources to this many MB/s")
+    run.add_argument('--write-limit', type=float, metavar='MB/S', help="limit writing the backup to this many MB/s")
+    run.add_argument('--nice', type=int, help="run at this CPU niceness (0-19)")
+    run.add_argument('--io-class', choices=['idle', 'best-effort'], help="run in this I/O scheduling class (Linux)")
+    run.add_argument('--workers', type=int, help="cap the compression, chunking and scanning threads")
+    run.add_argument('--max-load', type=float, metavar='LOAD', help="pause while the load average per CPU is above this")
+    run.add_argument('--max-await', type=float, metavar='MS', help="pause while the disks' average I/O wait is above this (Linux)")
+    run.set_defaults(func=cmd_run)
+
+    list_parser = commands.add_parser('list', help="list backup versions, newest first")
+    list_parser.add_argument('--limit', type=int, default=50, help="number of entries to show (default 50)")
+    list_parser.add_argument('--type', choices=['Full', 'Incremental'], help="only show this backup type")
+    list_parser.set_defaults(func=cmd_list)
+
+    restore = commands.add_parser('restore', help="restore a backup version")
+    restore.add_argument('version', type=int, help="backup id as shown by 'list'")
+    restore.add_argument('target', help="directory to restore into")
+    restore.add_argument('--path', action='append', help="only restore this file or directory, e.g. docs/notes.txt (repeatable)")
+    restore.add_argument('--writers', type=int, help="threads writing restored files (default 8)")
+    restore.set_defaults(func=cmd_restore)
+
+    restore_at = commands.add_parser('restore-at', help="restore the state as of a date, replaying full + incremental backups")
+    restore_at.add_argument('timestamp', help="YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS'")
+    restore_at.add_argument('target', help="directory to restore into")
+    restore_at.add_argument('--source', action='append', help="source directory of the backups (needed when several source sets exist)")
+    restore_at.add_argument('--path', action='append', help="only restore this file or directory (repeatable)")
+    restore_at.set_defaults(func=cmd_restore_at)
+
+    contents = commands.add_parser('contents', help="list the files inside a backup")
+    contents.add_argument('version', type=int, help="backup id as shown by 'list'")
+    contents.set_defaults(func=cmd_contents)
+
+    delete = commands.add_parser('delete', help="delete a backup version (merged into the next one if that depends on it)")
+    delete.add_argument('version', type=int, help="backup id as shown by 'list'")
+    delete.set_defaults(func=cmd_delete)
+
+    prune = commands.add_parser('prune', help="delete old backup chains")
+    prune.add_argument('--keep-full', type=int, required=True, help="number of newest full backups (with their incrementals) to keep")
+    prune.set_defaults(func=cmd_prune)
+
+    retain = commands.add_parser('retain', help="apply a grandfather-father-son retention policy")
+    retain.add_argument('--keep-daily', type=int, help="newest backup of each of the last N days (default from config)")
+    retain.add_argument('--keep-weekly', type=int, help="newest backup of each of the last N weeks (default from config)")
+    retain.add_argument('--keep-monthly', type=int, help="newest backup of each of the last N months (default from config)")
+    retain.add_argument('--dry-run', action='store_true', help="only show what would be merged and deleted")
+    retain.set_defaults(func=cmd_retain)
+
+    gc = commands.add_parser('gc', help="free repository space no snapshot uses any more")
+    gc.add_argument('--dest', help="backup destination holding the repository (default from config)")
+    gc.set_defaults(func=cmd_gc)
+
+    verify = commands.add_parser('verify', help="check stored backups against their checksums without restoring them")
+    verify.add_argument('version', type=int, nargs='*', help="backup ids as shown by 'list' (default: all)")
+    verify.add_argument('--deep', action='store_true', help="also decrypt and decompress, checking every file")
+    verify.add_argument('--workers', type=int, help="parallel checks (default: one per CPU)")
+    verify.set_defaults(func=cmd_verify)
+
+    scrub = commands.add_parser('scrub', help="verify the least recently verified backups within a time budget")
+    scrub.add_argument('--budget', type=float, help="minutes to spend (default from config)")
+    scrub.add_argument('--deep', action='store_true', help="also decrypt and decompress, checking every file")
+    scrub.add_argument('--workers', type=int, help="parallel checks (default: one per CPU)")
+    scrub.set_defaults(func=cmd_scrub)
+
+    watch = commands.add_parser('watch', help="keep a change journal of the sources so incrementals need not walk them")
+    watch.add_argument('--source', action='append', help="source directory (repeatable, default from config)")
+    watch.add_argument('--status', action='store_true', help="show the journal's state per source and exit")
+    watch.set_defaults(func=cmd_watch)
+
+    schedule = commands.add_parser('schedule', help="run the scheduler daemon that backs up each configured job on its interval")
+    mode = schedule.add_mutually_exclusive_group()
+    mode.add_argument('--once', action='store_true', help="start the jobs that are due, wait for them and exit")
+    mode.add_argument('--status', action='store_true', help="show every job's last and next run and exit")
+    mode.add_argument('--install', action='store_true', help="make cron (or the Windows task scheduler) run --once every 15 minutes")
+    mode.add_argument('--uninstall', action='store_true', help="remove what --install added")
+    schedule.set_defaults(func=cmd_schedule)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args, engine.load_config())
+    except (engine.BackupError, OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+# Reproducible throughput benchmarks for the backup engine, e.g.
+#   python3 benchmark.py --output baseline.json
+#   python3 benchmark.py --profile tiny --profile huge --compare baseline.json
+#
+# Every profile generates the same synthetic source tree from a fixed seed
+# (same names, sizes, contents and mtimes on every run), then runs the cases
+# below in order against a private catalog and manifest in a temporary
+# directory. Each case runs in its own interpreter, so the reported peak RSS
+# belongs to that case alone; wall time covers only the measured call.
+CASES = ('full_backup', 'incremental_backup', 'encrypt', 'decrypt', 'full_restore', 'single_file_restore')
+BENCHMARK_PASSWORD = 'benchmark'
+DEFAULT_SEED = 1234
+DEFAULT_CHURN = 10          # percent of files rewritten before the incremental backup
+DEFAULT_THRESHOLD = 10      # percent slowdown reported as a regression
+FIXED_MTIME = 1700000000    # every generated file gets this mtime, so scans see identical trees
+
+# Profile parameters at scale 1.0; --scale multiplies the file counts (tiny, deep,
+# incompressible) or the file sizes (huge)
+PROFILES = {
+    'tiny': {'files': 20000, 'dirs': 200, 'min_size': 64, 'max_size': 4096, 'depth': 1, 'compressible': True},
+    'huge': {'files': 4, 'dirs': 1, 'min_size': 64 << 20, 'max_size': 64 << 20, 'depth': 1, 'compressible': True},
+    'deep': {'files': 2000, 'dirs': 50, 'min_size': 512, 'max_size': 16384, 'depth': 40, 'compressible': True},
+    'incompressible': {'files': 200, 'dirs': 10, 'min_size': 1 << 20, 'max_size': 1 << 20, 'depth': 1, 'compressible': False},
+}
+
+WORDS = (b"backup restore archive block index chunk stream cipher catalog manifest "
+         b"source target scan stat inode mtime level codec frame header footer ").split()
+
+
+def scaled_profile(name, scale):
+    profile = dict(PROFILES[name])
+    if name == 'huge':
+        profile['min_size'] = profile['max_size'] = max(1, int(profile['max_size'] * scale))
+    else:
+        profile['files'] = max(1, int(profile['files'] * scale))
+    return profile
+
+
+# Text-like data that compresses roughly like real documents
+def compressible_bytes(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = WORDS[rng.randrange(len(WORDS))]
+        words.append(word)
+        length += len(word) + 1
+    return b" ".join(words)[:size]
+
+
+def file_content(rng, size, compressible):
+    if compressible:
+        return compressible_bytes(rng, size)
+    return rng.randbytes(size)
+
+
+def write_file(path, data, mtime=FIXED_MTIME):
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+# Write a profile's tree below `root`; returns the relative file paths in creation order
+def generate_tree(root, profile, seed=DEFAULT_SEED):
+    rng = random.Random(seed)
+    directories = []
+    for number in range(profile['dirs']):
+        # Deep profiles nest every directory `depth` levels down
+        parts = [f"d{number:04d}"] + [f"n{level:02d}" for level in range(profile['depth'] - 1)]
+        directories.append(os.path.join(*parts))
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    paths = []
+    # Huge files are written in pieces so generating them does not need the whole file in memory
+    piece = 4 << 20
+    for number in range(profile['files']):
+        relative = os.path.join(directories[number % len(directories)], f"f{number:06d}.dat")
+        size = rng.randint(profile['min_size'], profile['max_size'])
+        target = os.path.join(root, relative)
+        with open(target, 'wb') as f:
+            remaining = size
+            while remaining:
+                data = file_content(rng, min(piece, remaining), profile['compressible'])
+                f.write(data)
+                remaining -= len(data)
+        os.utime(target, (FIXED_MTIME, FIXED_MTIME))
+        paths.append(relative)
+    return paths
+
+
+# Rewrite `percent` of the files (same size, new content) so an incremental backup has work to do
+def churn_tree(root, paths, percent, seed=DEFAULT_SEED, compressible=True):
+    rng = random.Random(seed + 1)
+    count = max(1, len(paths) * percent // 100) if percent else 0
+    changed = rng.sample(paths, min(count, len(paths)))
+    total = 0
+    for relative in changed:
+        target = os.path.join(root, relative)
+        size = os.path.getsize(target)
+        write_file(target, file_content(rng, size, compressible), mtime=FIXED_MTIME + 1)
+        total += size
+    return len(changed), total
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def tree_totals(root):
+    files = size = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(directory, name))
+    return files, size
+
+
+# State shared by the cases of one profile run; kept as JSON in the work directory
+def load_state(workdir):
+    with open(os.path.join(workdir, 'state.json')) as f:
+        return json.load(f)
+
+
+def save_state(workdir, state):
+    with open(os.path.join(workdir, 'state.json'), 'w') as f:
+        json.dump(state, f)
+
+
+# Run one case inside this process and return its measurements
+def run_case(case, workdir):
+    import engine
+
+    # Keep the benchmark's backups out of the user's catalog and manifest
+    engine.CATALOG_FILE = os.path.join(workdir, 'catalog.db')
+    engine.MANIFEST_FILE = os.path.join(workdir, 'manifest.db')
+    engine.METADATA_FILE = os.path.join(workdir, 'no_legacy_metadata.json')
+
+    state = load_state(workdir)
+    source = os.path.join(workdir, 'source')
+    backups = os.path.join(workdir, 'backups')
+    settings = state['settings']
+
+    def backup(backup_type):
+        return engine.run_backup([source], backups, backup_type, codec=settings['codec'],
+                                 archive_format=settings['format'])
+
+    if case == 'full_backup':
+        files, size = tree_totals(source)
+        started = time.perf_counter()
+        result = backup('Full')
+        wall = time.perf_counter() - started
+        state['full_archive'] = os.path.join(backups, result['backup_file'])
+        extra = {'archive_bytes': result['size']}
+
+    elif case == 'incremental_backup':
+        files, size = churn_tree(source, state['paths'], settings['churn'], settings['seed'], state['compressible'])
+        started = time.perf_counter()
+        result = backup('Incremental')
+        wall = time.perf_counter() - started
+        extra = {'archive_bytes': result['size'], 'churn_percent': settings['churn']}
+
+    elif case == 'encrypt':
+        files, size = 1, os.path.getsize(state['full_archive'])
+        started = time.perf_counter()
+        state['encrypted_archive'] = engine.encrypt_backup_file(state['full_archive'], BENCHMARK_PASSWORD)
+        wall = time.perf_counter() - started
+        extra = {}
+
+    elif case == 'decrypt':
+        files, size = 1, os.path.getsize(state['encrypted_archive'])
+        started = time.perf_counter()
+        engine.decrypt_backup_file(state['encrypted_archive'], BENCHMARK_PASSWORD)
+        wall = time.perf_counter() - started
+        extra = {}
+
+    elif case == 'full_restore':
+        target = os.path.join(workdir, 'restore_full')
+        started = time.perf_counter()
+        engine.restore_backup(state['full_archive'], target)
+        wall = time.perf_counter() - started
+        files, size = tree_totals(target)
+        if files != len(state['paths']):
+            raise engine.BackupError(f"Restored {files} files, expected {len(state['paths'])}")
+        shutil.rmtree(target)
+        extra = {}
+
+    elif case == 'single_file_restore':
+        # The middle file of the tree, so tar archives have to be read about halfway
+        relative = sorted(state['paths'])[len(state['paths']) // 2]
+        member = f"{os.path.basename(source)}/{relative.replace(os.sep, '/')}"
+        target = os.path.join(workdir, 'restore_single')
+        started = time.perf_counter()
+        engine.restore_backup(state['full_archive'], target, paths=[member])
+        wall = time.perf_counter() - started
+        files, size = tree_totals(target)
+        shutil.rmtree(target)
+        extra = {}
+
+    else:
+        raise ValueError(f"Unknown benchmark case: {case}")
+
+    save_state(workdir, state)
+    measurement = {
+        'wall_seconds': round(wall, 4),
+        'files': files,
+        'bytes': size,
+        'mb_per_second': round(size / (1024 * 1024) / wall, 2) if wall > 0 else None,
+        'files_per_second': round(files / wall, 1) if wall > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    measurement.update(extra)
+    return measurement
+
+
+# Generate the profile's tree once, then run every case in a fresh interpreter
+def run_profile(name, settings):
+    profile = scaled_profile(name, settings['scale'])
+    workdir = tempfile.mkdtemp(prefix=f"backup-bench-{name}-", dir=settings['workdir'])
+    try:
+        source = os.path.join(workdir, 'source')
+        os.makedirs(os.path.join(workdir, 'backups'))
+        os.makedirs(source)
+        paths = generate_tree(source, profile, settings['seed'])
+        save_state(workdir, {'settings': settings, 'paths': paths, 'compressible': profile['compressible']})
+
+        results = {}
+        for case in CASES:
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', case, workdir],
+                                       capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"{name}/{case} failed:\n{completed.stderr}")
+            results[case] = json.loads(completed.stdout.strip().splitlines()[-1])
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Keep the fastest of several runs; peak RSS is the highest seen
+def best_of(runs):
+    best = {}
+    for results in runs:
+        for case, measurement in results.items():
+            current = best.get(case)
+            peak = max((value for value in (measurement['peak_rss_mb'], current and current['peak_rss_mb']) if value),
+                       default=None)
+            if current is None or measurement['wall_seconds'] < current['wall_seconds']:
+                current = best[case] = dict(measurement)
+            current['peak_rss_mb'] = peak
+    return best
+
+
+# Compare two result files; returns a list of (profile, case, metric, old, new, change %) regressions
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    regressions = []
+    for profile, cases in current['results'].items():
+        for case, measurement in cases.items():
+            old = baseline.get('results', {}).get(profile, {}).get(case)
+            if not old:
+                continue
+            for metric in ('wall_seconds', 'peak_rss_mb'):
+                if not old.get(metric) or measurement.get(metric) is None:
+                    continue
+                change = (measurement[metric] - old[metric]) / old[metric] * 100
+                if change > threshold:
+                    regressions.append((profile, case, metric, old[metric], measurement[metric], change))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'profile':<16}{'case':<22}{'wall s':>10}{'MB/s':>10}{'files/s':>12}{'peak MB':>10}")
+    for profile, cases in results.items():
+        for case, m in cases.items():
+            print(f"{profile:<16}{case:<22}{m['wall_seconds']:>10.3f}{m['mb_per_second'] or 0:>10.1f}"
+                  f"{m['files_per_second'] or 0:>12.1f}{m['peak_rss_mb'] or 0:>10.1f}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='benchmark', description="Backup engine throughput benchmarks")
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES), help="profile to run (repeatable, default all)")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply profile file counts (or huge file sizes)")
+    parser.add_argument('--churn', type=int, default=DEFAULT_CHURN, help="percent of files changed before the incremental backup")
+    parser.add_argument('--repeat', type=int, default=1, help="run every profile N times and keep the fastest")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="seed of the synthetic tree generator")
+    parser.add_argument('--format', choices=['tar', 'seekable', 'repository'], default='tar', help="archive format to benchmark")
+    parser.add_argument('--codec', choices=['gzip', 'zstd'], default='gzip', help="compression codec to benchmark")
+    parser.add_argument('--workdir', help="where to build the synthetic trees (default: system temp dir)")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file to write the results to")
+    parser.add_argument('--compare', help="earlier results file; exit 1 if anything got slower than --threshold")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown in percent (default 10)")
+    parser.add_argument('--run-case', nargs=2, metavar=('CASE', 'WORKDIR'), help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.run_case:
+        print(json.dumps(run_case(*args.run_case)))
+        return 0
+
+    settings = {'scale': args.scale, 'churn': args.churn, 'seed': args.seed, 'format': args.format,
+                'codec': args.codec, 'workdir': args.workdir}
+    results = {}
+    for name in args.profile or sorted(PROFILES):
+        print(f"Running profile {name}...", file=sys.stderr)
+        results[name] = best_of(run_profile(name, settings) for _ in range(max(1, args.repeat)))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            **{key: value for key, value in settings.items() if key != 'workdir'},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_results(results)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, report, args.threshold)
+        for profile, case, metric, old, new, change in regressions:
+            print(f"REGRESSION {profile}/{case} {metric}: {old} -> {new} (+{change:.1f}%)")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:g}% against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+# Transactional backup catalog.
+#
+# Replaces backup_metadata.json, which was loaded and rewritten in full on
+# every change. Each backup is one row in a WAL-mode SQLite database, so
+# recording or deleting a backup is a single small transaction that a crash
+# cannot half-apply. Rows are indexed by timestamp, type, source set and
+# destination, and listings are paginated with keyset cursors so the cost of
+# a page does not grow with the size of the catalog.
+CATALOG_FILE = 'backup_catalog.db'
+LEGACY_METADATA_FILE = 'backup_metadata.json'
+DEFAULT_PAGE_SIZE = 200
+
+COLUMNS = ('id', 'timestamp', 'backup_file', 'backup_type', 'size', 'backup_location', 'backup_folder',
+           'source_set', 'encrypted', 'status', 'details')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    backup_file TEXT NOT NULL,
+    backup_type TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    backup_location TEXT NOT NULL,
+    backup_folder TEXT,
+    source_set TEXT NOT NULL DEFAULT '',
+    encrypted INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'success',
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_timestamp ON backups (timestamp, id);
+CREATE INDEX IF NOT EXISTS backups_type ON backups (backup_type, timestamp);
+CREATE INDEX IF NOT EXISTS backups_source_set ON backups (source_set, timestamp);
+CREATE INDEX IF NOT EXISTS backups_location ON backups (backup_location, timestamp);
+CREATE TABLE IF NOT EXISTS catalog_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS block_checksums (
+    backup_id INTEGER NOT NULL,
+    block INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (backup_id, block)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS file_checksums (
+    backup_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (backup_id, path)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS verifications (
+    backup_id INTEGER PRIMARY KEY,
+    verified_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS verification_cursors (
+    backup_id INTEGER PRIMARY KEY,
+    cursor TEXT NOT NULL
+);
+"""
+
+
+# Canonical name of a set of source directories, used to group backup chains
+def make_source_set(source_dirs):
+    return '; '.join(sorted(os.path.abspath(source) for source in source_dirs))
+
+
+def _row_to_entry(row):
+    entry = dict(zip(COLUMNS, row))
+    entry['encrypted'] = bool(entry['encrypted'])
+    entry['details'] = json.loads(entry['details']) if entry['details'] else {}
+    return entry
+
+
+class BackupCatalog:
+    def __init__(self, path=CATALOG_FILE, legacy_metadata_file=LEGACY_METADATA_FILE):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._import_legacy_metadata(legacy_metadata_file)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # One-time import of the old JSON metadata; the JSON file itself is left untouched
+    def _import_legacy_metadata(self, legacy_metadata_file):
+        if not legacy_metadata_file or not os.path.exists(legacy_metadata_file):
+            return
+        if self.conn.execute("SELECT 1 FROM catalog_info WHERE key = 'legacy_imported'").fetchone():
+            return
+        with open(legacy_metadata_file, 'r') as f:
+            entries = json.load(f)
+        with self.conn:
+            for entry in entries:
+                self.conn.execute(
+                    "INSERT INTO backups (timestamp, backup_file, backup_type, size, backup_location, backup_folder, "
+                    "encrypted, status, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (entry['timestamp'], entry['backup_file'], entry['backup_type'], entry['size'],
+                     entry['backup_location'], entry.get('backup_folder'), entry['backup_file'].endswith('.enc'),
+                     'success' if entry['size'] > 0 else 'failed',
+                     json.dumps({'scan': entry['scan']}) if 'scan' in entry else None))
+            self.conn.execute("INSERT INTO catalog_info (key, value) VALUES ('legacy_imported', ?)",
+                              (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+
+    # `checksums`, if given, is the checksums.ArchiveChecksums recorded while the archive was written
+    def add_backup(self, backup_file, backup_type, size, backup_location, backup_folder, source_set='',
+                   encrypted=False, status='success', details=None, timestamp=None, checksums=None):
+        timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO backups (timestamp, backup_file, backup_type, size, backup_location, backup_folder, "
+                "source_set, encrypted, status, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (timestamp, backup_file, backup_type, size, backup_location, backup_folder, source_set,
+                 int(encrypted), status, json.dumps(details) if details else None))
+            self._insert_checksums(cursor.lastrowid, checksums)
+        return self.get_backup(cursor.lastrowid)
+
+    def _insert_checksums(self, backup_id, checksums):
+        if checksums is None:
+            return
+        self.conn.executemany("INSERT INTO block_checksums (backup_id, block, digest) VALUES (?, ?, ?)",
+                              ((backup_id, block, digest) for block, digest in enumerate(checksums.blocks)))
+        self.conn.executemany("INSERT OR REPLACE INTO file_checksums (backup_id, path, digest) VALUES (?, ?, ?)",
+                              ((backup_id, path, digest) for path, digest in checksums.files.items()))
+
+    def _delete_checksums(self, backup_ids):
+        for table in ('block_checksums', 'file_checksums', 'verifications', 'verification_cursors'):
+            self.conn.executemany(f"DELETE FROM {table} WHERE backup_id = ?", ((backup_id,) for backup_id in backup_ids))
+
+    def block_checksums(self, backup_id):
+        return [row[0] for row in self.conn.execute(
+            "SELECT digest FROM block_checksums WHERE backup_id = ? ORDER BY block", (backup_id,))]
+
+    def file_checksums(self, backup_id):
+        return dict(self.conn.execute("SELECT path, digest FROM file_checksums WHERE backup_id = ?", (backup_id,)))
+
+    def record_verification(self, backup_id, status, error=None):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO verifications (backup_id, verified_at, status, error) "
+                              "VALUES (?, ?, ?, ?)",
+                              (backup_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), status, error))
+            self.conn.execute("DELETE FROM verification_cursors WHERE backup_id = ?", (backup_id,))
+
+    # Where an unfinished check of a backup stopped (see verify.py); replaced by record_verification
+    def save_verification_cursor(self, backup_id, cursor):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO verification_cursors (backup_id, cursor) VALUES (?, ?)",
+                              (backup_id, json.dumps(cursor)))
+
+    def verification_cursor(self, backup_id):
+        row = self.conn.execute("SELECT cursor FROM verification_cursors WHERE backup_id = ?",
+                                (backup_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def last_verification(self, backup_id):
+        row = self.conn.execute("SELECT verified_at, status, error FROM verifications WHERE backup_id = ?",
+                                (backup_id,)).fetchone()
+        return dict(zip(('verified_at', 'status', 'error'), row)) if row else None
+
+    # Successful backups in scrub order: unfinished checks first, then never verified, then least
+    # recently verified, oldest first
+    def iter_scrub_order(self):
+        columns = ', '.join(f"b.{column}" for column in COLUMNS)
+        for row in self.conn.execute(
+                f"SELECT {columns} FROM backups b LEFT JOIN verifications v ON v.backup_id = b.id "
+                "LEFT JOIN verification_cursors c ON c.backup_id = b.id WHERE b.status = 'success' "
+                "ORDER BY c.backup_id IS NULL, v.verified_at IS NOT NULL, v.verified_at, b.timestamp, b.id"):
+            yield _row_to_entry(row)
+
+    def update_details(self, backup_id, **details):
+        entry = self.get_backup(backup_id)
+        if entry is None:
+            return
+        merged = dict(entry['details'], **details)
+        with self.conn:
+            self.conn.execute("UPDATE backups SET details = ? WHERE id = ?", (json.dumps(merged), backup_id))
+
+    def get_backup(self, backup_id):
+        row = self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM backups WHERE id = ?", (backup_id,)).fetchone()
+        return _row_to_entry(row) if row else None
+
+    def delete_backup(self, backup_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM backups WHERE id = ?", (backup_id,))
+            self._delete_checksums([backup_id])
+
+    # Point backup `target_id` at the archive that replaced it and drop the backups merged
+    # into that archive, in one transaction, so no reader ever sees a half-merged chain
+    def merge_backups(self, target_id, merged_ids, backup_file, backup_type, size, details, checksums=None):
+        with self.conn:
+            self.conn.execute("UPDATE backups SET backup_file = ?, backup_type = ?, size = ?, details = ? WHERE id = ?",
+                              (backup_file, backup_type, size, json.dumps(details) if details else None, target_id))
+            self.conn.executemany("DELETE FROM backups WHERE id = ?", ((backup_id,) for backup_id in merged_ids))
+            self._delete_checksums([target_id] + list(merged_ids))
+            self._insert_checksums(target_id, checksums)
+        return self.get_backup(target_id)
+
+    def _filters(self, backup_type=None, source_set=None, backup_location=None, status=None, since=None, until=None):
+        clauses, params = [], []
+        for column, value in (('backup_type', backup_type), ('source_set', source_set),
+                              ('backup_location', backup_location), ('status', status)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        return clauses, params
+
+    # One page of backups, newest first. Pass the last entry of the previous
+    # page as `after` to get the next page.
+    def list_backups(self, limit=DEFAULT_PAGE_SIZE, after=None, newest_first=True, **filters):
+        clauses, params = self._filters(**filters)
+        if after is not None:
+            clauses.append("(timestamp, id) < (?, ?)" if newest_first else "(timestamp, id) > (?, ?)")
+            params += [after['timestamp'], after['id']]
+        order = "DESC" if newest_first else "ASC"
+        sql = f"SELECT {', '.join(COLUMNS)} FROM backups"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY timestamp {order}, id {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [_row_to_entry(row) for row in self.conn.execute(sql, params)]
+
+    # Iterate over every matching backup page by page without loading them all at once
+    def iter_backups(self, newest_first=False, page_size=DEFAULT_PAGE_SIZE, **filters):
+        after = None
+        while True:
+            page = self.list_backups(limit=page_size, after=after, newest_first=newest_first, **filters)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1]
+
+    def count_backups(self, **filters):
+        clauses, params = self._filters(**filters)
+        sql = "SELECT COUNT(*) FROM backups"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def source_sets(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT source_set FROM backups ORDER BY source_set")]
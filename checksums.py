@@ -0,0 +1,115 @@
+import hashlib
+from contextlib import nullcontext
+
+# Checksums recorded while a backup archive is written, and checked by verify.py.
+#
+#   blocks  BLAKE2b of every BLOCK_SIZE block of the archive as stored (after
+#           compression and encryption). Checking them needs nothing but
+#           sequential reads and hashing, works without the password, and a
+#           mismatch names the damaged byte range.
+#   files   BLAKE2b of every regular file's content as archived, checked when
+#           an archive is decoded. Seekable archives keep these in their own
+#           index, so only tar archives record them here.
+#
+# Both are stored in the catalog (see catalog.py), next to the backup they belong to.
+ALGORITHM = 'blake2b-256'
+DIGEST_SIZE = 32
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def new_digest(data=b""):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE)
+
+
+class ArchiveChecksums:
+    def __init__(self, block_size=BLOCK_SIZE, metrics=None):
+        self.block_size = block_size
+        self.metrics = metrics
+        self.blocks = []        # digest of each stored block, in order
+        self.files = {}         # member name -> content digest
+        self.size = 0
+        self.digest = new_digest()
+        self.filled = 0
+
+    def _timed(self):
+        return self.metrics.timed('checksum') if self.metrics is not None else nullcontext()
+
+    # Feed the next bytes of the stored archive
+    def update(self, data):
+        with self._timed():
+            view = memoryview(data)
+            while view:
+                take = min(len(view), self.block_size - self.filled)
+                self.digest.update(view[:take])
+                self.filled += take
+                view = view[take:]
+                if self.filled == self.block_size:
+                    self.blocks.append(self.digest.digest())
+                    self.digest = new_digest()
+                    self.filled = 0
+            self.size += len(data)
+
+    def finish(self):
+        if self.filled:
+            self.blocks.append(self.digest.digest())
+            self.digest = new_digest()
+            self.filled = 0
+
+    def writer(self, fileobj):
+        return ChecksumWriter(fileobj, self)
+
+    def tar(self, tar):
+        return ChecksummingTar(tar, self)
+
+    # What the catalog entry's details say about the recorded checksums
+    def summary(self):
+        return {'algorithm': ALGORITHM, 'block_size': self.block_size, 'size': self.size,
+                'blocks': len(self.blocks), 'files': len(self.files)}
+
+
+# Output wrapper that checksums the archive as it is written
+class ChecksumWriter:
+    def __init__(self, fileobj, checksums):
+        self.fileobj = fileobj
+        self.checksums = checksums
+
+    def write(self, data):
+        self.checksums.update(data)
+        return self.fileobj.write(data)
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+# Reader that checksums a file's content while tarfile copies it into the archive
+class ChecksumReader:
+    def __init__(self, fileobj, checksums):
+        self.fileobj = fileobj
+        self.checksums = checksums
+        self.digest = new_digest()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        with self.checksums._timed():
+            self.digest.update(data)
+        return data
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+# TarFile wrapper that records the checksum of every regular file added to it
+class ChecksummingTar:
+    def __init__(self, tar, checksums):
+        self.tar = tar
+        self.checksums = checksums
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is None or not tarinfo.isreg():
+            return self.tar.addfile(tarinfo, fileobj)
+        reader = ChecksumReader(fileobj, self.checksums)
+        self.tar.addfile(tarinfo, reader)
+        self.checksums.files[tarinfo.name] = reader.digest.digest()
+
+    def __getattr__(self, attribute):
+        return getattr(self.tar, attribute)
@@ -0,0 +1,305 @@
+import os
+import gzip
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Parallel block compression engine.
+#
+# The tar stream is cut into fixed-size blocks and each block is compressed
+# independently on a worker pool. Every gzip block becomes a complete gzip
+# member, and every zstd block a complete zstd frame, so the concatenated
+# output is a standard multi-member .gz / multi-frame .zst file that gzip,
+# zstd and Python's gzip module can all read.
+#
+# zlib and zstandard both release the GIL while compressing, so a thread pool
+# gives real multi-core scaling without pickling every block across process
+# boundaries.
+CODECS = ("gzip", "zstd")
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+LEVEL_RANGES = {"gzip": (0, 9), "zstd": (1, 22)}
+EXTENSIONS = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Adaptive per-file compression: already-compressed formats are stored, known
+# text formats are compressed at the configured level, and anything else is
+# judged by trial-compressing a sample of its first bytes. Files below
+# ADAPTIVE_MIN_SIZE always use the configured level, so small files never
+# split the stream into tiny blocks.
+STORED_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.m4a', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.7z', '.rar',
+    '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub',
+    '.enc', '.gpg', '.age', '.abx',
+))
+COMPRESSIBLE_EXTENSIONS = frozenset((
+    '.txt', '.md', '.csv', '.tsv', '.log', '.json', '.xml', '.html', '.htm', '.css', '.js', '.svg',
+    '.py', '.c', '.h', '.cpp', '.java', '.go', '.rs', '.sh', '.sql', '.ini', '.yaml', '.yml', '.tex',
+))
+ADAPTIVE_MIN_SIZE = 64 * 1024
+SAMPLE_SIZE = 16 * 1024
+STORE_RATIO = 0.95      # a sample that shrinks less than 5% is stored
+FAST_RATIO = 0.80       # one that shrinks less than 20% is compressed at the fast level
+STORE_LEVELS = {"gzip": 0, "zstd": 1}
+FAST_LEVELS = {"gzip": 1, "zstd": 1}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+# zstandard is optional and only imported the first time a zstd stream is used
+def load_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def check_codec(codec, level=None):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if codec == "zstd" and load_zstandard() is None:
+        raise ValueError("zstd compression requires the 'zstandard' package")
+    if level is not None:
+        low, high = LEVEL_RANGES[codec]
+        if not low <= level <= high:
+            raise ValueError(f"{codec} level must be between {low} and {high}")
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def compress_block(data, codec, level):
+    if codec == "zstd":
+        return load_zstandard().ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def decompress_block(data, codec):
+    if codec == "zstd":
+        return load_zstandard().ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+# Per-file compression level choice, plus the counters that estimate the CPU it saved
+class CompressionPolicy:
+    def __init__(self, codec="gzip", level=None):
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.levels = {'store': STORE_LEVELS[codec], 'fast': FAST_LEVELS[codec], 'default': self.level}
+        # The level the next bytes written to the archive should be compressed at
+        self.current_level = self.level
+        self.lock = threading.Lock()
+        self.files = {'store': 0, 'fast': 0, 'default': 0}
+        self.bytes = {'store': 0, 'fast': 0, 'default': 0}
+        self.samples = 0
+        self.sample_cpu = 0.0
+        self.trial_bytes = {'store': 0, 'fast': 0, 'default': 0}
+        self.trial_cpu = {'store': 0.0, 'fast': 0.0, 'default': 0.0}
+        self.block_bytes = {}
+        self.block_cpu = {}
+
+    # Decide how to compress one file; `fileobj` is open at its start and is left there
+    def select(self, path, size, fileobj):
+        decision = 'default'
+        if size >= ADAPTIVE_MIN_SIZE:
+            extension = os.path.splitext(path)[1].lower()
+            if extension in STORED_EXTENSIONS:
+                decision = 'store'
+            elif extension not in COMPRESSIBLE_EXTENSIONS:
+                decision = self._sample(fileobj)
+        self.files[decision] += 1
+        self.bytes[decision] += size
+        self.current_level = self.levels[decision]
+        return self.current_level
+
+    # Trial-compress the head of the file at the configured level
+    def _sample(self, fileobj):
+        sample = fileobj.read(SAMPLE_SIZE)
+        fileobj.seek(0)
+        if not sample:
+            return 'default'
+        cpu_start = time.thread_time()
+        ratio = len(compress_block(sample, self.codec, self.level)) / len(sample)
+        cpu = time.thread_time() - cpu_start
+        decision = 'store' if ratio > STORE_RATIO else 'fast' if ratio > FAST_RATIO else 'default'
+        self.samples += 1
+        self.sample_cpu += cpu
+        self.trial_bytes[decision] += len(sample)
+        self.trial_cpu[decision] += cpu
+        return decision
+
+    # Called by the compressor for every block it compressed
+    def record_block(self, level, nbytes, cpu):
+        with self.lock:
+            self.block_bytes[level] = self.block_bytes.get(level, 0) + nbytes
+            self.block_cpu[level] = self.block_cpu.get(level, 0.0) + cpu
+
+    # Estimated CPU saved: what the stored/fast bytes would have cost at the configured
+    # level (measured on samples of the same files), minus what they did cost and the sampling
+    def summary(self):
+        with self.lock:
+            block_bytes, block_cpu = dict(self.block_bytes), dict(self.block_cpu)
+        saved = None
+        if self.level not in (self.levels['store'], self.levels['fast']):
+            saved = -self.sample_cpu
+            for decision in ('store', 'fast'):
+                level = self.levels[decision]
+                if not block_bytes.get(level):
+                    continue
+                trial_bytes, trial_cpu = self.trial_bytes[decision], self.trial_cpu[decision]
+                if not trial_bytes and block_bytes.get(self.level):
+                    # Only extension-matched files: fall back to this run's default-level blocks
+                    trial_bytes, trial_cpu = block_bytes[self.level], block_cpu[self.level]
+                if trial_bytes:
+                    saved += block_bytes[level] * trial_cpu / trial_bytes - block_cpu[level]
+        return {
+            'files_stored': self.files['store'],
+            'files_fast': self.files['fast'],
+            'files_default': self.files['default'],
+            'bytes_stored': self.bytes['store'],
+            'bytes_fast': self.bytes['fast'],
+            'samples': self.samples,
+            'sample_cpu': round(self.sample_cpu, 4),
+            'cpu_saved': round(saved, 3) if saved is not None else None,
+        }
+
+
+# File-like writer that compresses blocks in parallel and writes them to `fileobj` in order.
+# With a CompressionPolicy, each block is compressed at the level the policy chose for
+# the file being written, and a change of level starts a new block.
+class ParallelCompressor:
+    def __init__(self, fileobj, codec="gzip", level=None, workers=None, block_size=DEFAULT_BLOCK_SIZE, metrics=None,
+                 policy=None):
+        level = DEFAULT_LEVELS[codec] if level is None else level
+        check_codec(codec, level)
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.policy = policy
+        self.codec = codec
+        self.level = level
+        self.block_level = level
+        self.block_size = block_size
+        self.workers = workers or default_workers()
+        # Bound the number of blocks in flight so memory stays at a few blocks per worker
+        self.max_pending = self.workers * 2
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def _compress(self, block, level):
+        cpu_start = time.thread_time()
+        if self.metrics is None:
+            compressed = compress_block(block, self.codec, level)
+        else:
+            with self.metrics.timed('compress'):
+                compressed = compress_block(block, self.codec, level)
+            self.metrics.add('compress', nbytes=len(block))
+        if self.policy is not None:
+            self.policy.record_block(level, len(block), time.thread_time() - cpu_start)
+        return compressed
+
+    def _submit(self, block):
+        if self.executor is None:
+            self._emit(self._compress(block, self.block_level))
+            return
+        self.pending.append(self.executor.submit(self._compress, block, self.block_level))
+        while len(self.pending) >= self.max_pending:
+            self._emit(self.pending.popleft().result())
+
+    def _emit(self, compressed):
+        self.fileobj.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed ParallelCompressor")
+        if self.policy is not None and self.policy.current_level != self.block_level:
+            # The policy picked another level for the file now being written
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self.block_level = self.policy.current_level
+        self.buffer += data
+        self.bytes_in += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer or self.bytes_in == 0:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._emit(self.pending.popleft().result())
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+
+    # Drop whatever is still buffered or in flight, e.g. when the backup was cancelled
+    def abort(self):
+        self.closed = True
+        self.buffer = bytearray()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Reader that replays already-consumed magic bytes before the rest of `fileobj`
+class _PrefixedReader:
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b""
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+    def readable(self):
+        return True
+
+
+# Detect the codec from the stream's magic bytes and return a plaintext reader
+def open_decompressed_stream(fileobj):
+    magic = fileobj.read(4)
+    stream = _PrefixedReader(magic, fileobj)
+    if magic.startswith(ZSTD_MAGIC):
+        zstandard = load_zstandard()
+        if zstandard is None:
+            raise ValueError("This backup is zstd-compressed; install the 'zstandard' package to restore it")
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    return stream
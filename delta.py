@@ -0,0 +1,592 @@
+import os
+import sys
+import zlib
+import struct
+import hashlib
+import tempfile
+from array import array
+
+from repository import load_numpy
+
+# Block-level deltas for large files that change in place (VM images,
+# databases, mailboxes).
+#
+# When a large file is archived whole, a signature of it is kept in the
+# manifest: for every aligned block a weak rolling checksum (Adler-32) and a
+# strong one (BLAKE2b-128). When the file has changed by the next incremental,
+# it is compared with that signature rsync-style and only a delta is archived:
+#
+#   header  = DELTA_MAGIC | version (1) | flags (1) | block size (4) | base size (8) | new size (8)
+#   ops     = C first block (8) count (4)   copy base blocks
+#             D length (4) bytes             literal data
+#             Z length (8)                   zeros
+#             B block (8) checksum (16)      the base block must still hold this
+#   end     = E | BLAKE2b-256 of the new file
+#
+# The file is read once, front to back. Each position is first compared
+# with the base block expected next (or the base block at the same offset),
+# which is all an in-place edit needs; only when neither matches is the
+# rolling checksum slid over the next SEARCH_BLOCKS blocks to find data that
+# moved, vectorised with numpy (without numpy only aligned blocks match).
+#
+# Restoring applies the delta to the version the restore already wrote. If
+# every copy keeps its block in place (FLAG_IN_PLACE), only the changed
+# blocks are written into the existing file, after checking that the blocks
+# they overwrite are the ones the delta was made against; the bytes they
+# replace are kept aside and put back if the result does not match the
+# delta's checksum. Otherwise the file is rebuilt next to the old one and
+# swapped in once its checksum matches.
+DELTA_MAGIC = b"ABUDELTA"
+DELTA_VERSION = 1
+FLAG_IN_PLACE = 1
+DELTA_PAX_KEY = 'ABU.delta'     # marks tar members whose content is a delta
+DEFAULT_MIN_SIZE = 64           # MB; smaller files are always archived whole
+BLOCK_SIZE = 64 * 1024
+MAX_BLOCKS = 1024 * 1024        # the block size doubles until a file fits in this many blocks
+SEARCH_BLOCKS = 16              # window, in blocks, searched for moved data after a mismatch
+MAX_DELTA_RATIO = 0.5           # a delta larger than this share of the file is dropped for a full copy
+MAX_LITERAL = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024   # deltas up to this size stay in memory until archived
+MAX_REPORTED = 1000             # per-file results kept with a run's metrics
+STRONG_SIZE = 16
+
+HEADER = struct.Struct(">8sBBIQQ")
+SIGNATURE_HEADER = struct.Struct(">IQ")
+COPY = struct.Struct(">QI")
+DATA = struct.Struct(">I")
+ZERO = struct.Struct(">Q")
+CHECK = struct.Struct(">Q")
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def block_size_for(size):
+    block_size = BLOCK_SIZE
+    while size > block_size * MAX_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+# Weak and strong checksums of every aligned block of one version of a file
+class Signature:
+    def __init__(self, block_size, size, weak, strong):
+        self.block_size = block_size
+        self.size = size
+        self.weak = weak        # array('I')
+        self.strong = strong    # STRONG_SIZE bytes per block
+
+    @property
+    def blocks(self):
+        return len(self.weak)
+
+    def block_length(self, block):
+        return min(self.block_size, self.size - block * self.block_size)
+
+    def strong_at(self, block):
+        return self.strong[block * STRONG_SIZE:(block + 1) * STRONG_SIZE]
+
+    def to_bytes(self):
+        weak = array('I', self.weak)
+        if sys.byteorder == 'big':
+            weak.byteswap()
+        return SIGNATURE_HEADER.pack(self.block_size, self.size) + weak.tobytes() + bytes(self.strong)
+
+    @classmethod
+    def from_bytes(cls, data):
+        block_size, size = SIGNATURE_HEADER.unpack_from(data)
+        blocks = -(-size // block_size)
+        weak = array('I')
+        weak.frombytes(data[SIGNATURE_HEADER.size:SIGNATURE_HEADER.size + 4 * blocks])
+        if sys.byteorder == 'big':
+            weak.byteswap()
+        return cls(block_size, size, weak, bytes(data[SIGNATURE_HEADER.size + 4 * blocks:]))
+
+
+# Builds a Signature from data fed in pieces of any size
+class SignatureBuilder:
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.size = 0
+        self.weak = array('I')
+        self.strong = bytearray()
+        self.pending = bytearray()
+
+    @property
+    def blocks(self):
+        return len(self.weak)
+
+    def update(self, data):
+        self.pending += data
+        if len(self.pending) < self.block_size:
+            return
+        view = memoryview(self.pending)
+        done = 0
+        while len(self.pending) - done >= self.block_size:
+            self._add_block(view[done:done + self.block_size])
+            done += self.block_size
+        view.release()
+        del self.pending[:done]
+
+    def _add_block(self, block):
+        self.weak.append(zlib.adler32(block))
+        self.strong += strong_checksum(block)
+        self.size += len(block)
+
+    def finish(self):
+        if self.pending:
+            self._add_block(self.pending)
+            self.pending = bytearray()
+        return Signature(self.block_size, self.size, self.weak, self.strong)
+
+
+# Passes a file through unchanged while building its signature
+class SignatureReader:
+    def __init__(self, fileobj, block_size):
+        self.fileobj = fileobj
+        self.builder = SignatureBuilder(block_size)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.builder.update(data)
+        return data
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+# Sorted weak checksums of the base's full blocks, searched for a whole window of offsets at once
+class _WeakIndex:
+    def __init__(self, base, numpy):
+        self.numpy = numpy
+        self.base = base
+        full = base.blocks if base.blocks and base.block_length(base.blocks - 1) == base.block_size else base.blocks - 1
+        weak = numpy.frombuffer(base.weak, dtype=numpy.uint32)[:max(full, 0)]
+        self.order = numpy.argsort(weak, kind='stable')
+        self.sorted = weak[self.order]
+
+    # First offset k of `window` whose block matches a base block: (k, block), or None.
+    # `position` is the window's offset in the new file, so a block that stayed put is preferred.
+    def search(self, window, position):
+        np = self.numpy
+        block_size = self.base.block_size
+        if not len(self.sorted) or len(window) < block_size:
+            return None
+        x = np.frombuffer(window, dtype=np.uint8).astype(np.int64)
+        n = len(x) - block_size + 1
+        sums = np.zeros(len(x) + 1, dtype=np.int64)
+        np.cumsum(x, out=sums[1:])
+        weighted = np.zeros(len(x) + 1, dtype=np.int64)
+        np.cumsum(x * np.arange(len(x), dtype=np.int64), out=weighted[1:])
+        a = sums[block_size:block_size + n] - sums[:n]
+        b = (np.arange(n, dtype=np.int64) + block_size) * a - (weighted[block_size:block_size + n] - weighted[:n])
+        weak = (((block_size + b) % 65521) << 16) | ((1 + a) % 65521)
+        slots = np.searchsorted(self.sorted, weak)
+        hits = np.flatnonzero(self.sorted[np.minimum(slots, len(self.sorted) - 1)] == weak)
+        for k in hits.tolist():
+            strong = strong_checksum(window[k:k + block_size])
+            if (position + k) % block_size == 0:
+                block = (position + k) // block_size
+                if block < self.base.blocks and self.base.strong_at(block) == strong:
+                    return k, block
+            slot = int(slots[k])
+            while slot < len(self.sorted) and self.sorted[slot] == weak[k]:
+                block = int(self.order[slot])
+                if self.base.strong_at(block) == strong:
+                    return k, block
+                slot += 1
+        return None
+
+
+# Writes delta ops, merging adjacent copies and small literals
+class _DeltaWriter:
+    def __init__(self, out, base):
+        self.out = out
+        self.base = base
+        self.size = HEADER.size
+        self.in_place = True
+        self.copy = None        # [first block, count] not yet written
+        self.literal = bytearray()
+        self.checked = -1       # highest base block already checked
+
+    def _write(self, data):
+        self.out.write(data)
+        self.size += len(data)
+
+    def _flush(self):
+        if self.copy is not None:
+            self._write(b"C" + COPY.pack(*self.copy))
+            self.copy = None
+        if self.literal:
+            self._write(b"D" + DATA.pack(len(self.literal)) + self.literal)
+            self.literal = bytearray()
+
+    # Before `length` bytes at `position` are overwritten, record what the base held there
+    def _check(self, position, length):
+        block_size = self.base.block_size
+        end = min(position + length, self.base.size)
+        for block in range(max(position // block_size, self.checked + 1), -(-end // block_size)):
+            self._flush()
+            self._write(b"B" + CHECK.pack(block) + self.base.strong_at(block))
+            self.checked = block
+
+    def add_copy(self, block, position):
+        if block * self.base.block_size != position:
+            self.in_place = False
+        if self.copy is not None and self.copy[0] + self.copy[1] == block:
+            self.copy[1] += 1
+            return
+        self._flush()
+        self.copy = [block, 1]
+
+    def add_literal(self, data, position):
+        if self.copy is not None:
+            self._flush()
+        self._check(position, len(data))
+        view = memoryview(data)
+        while view:
+            part = view[:MAX_LITERAL - len(self.literal)]
+            self.literal += part
+            view = view[len(part):]
+            if len(self.literal) >= MAX_LITERAL:
+                self._flush()
+
+    def add_zeros(self, length, position):
+        self._flush()
+        self._check(position, length)
+        self._write(b"Z" + ZERO.pack(length))
+
+    def finish(self, size, digest):
+        self._flush()
+        self._write(b"E" + digest)
+        self.out.seek(0)
+        self.out.write(HEADER.pack(DELTA_MAGIC, DELTA_VERSION, FLAG_IN_PLACE if self.in_place else 0,
+                                   self.base.block_size, self.base.size, size))
+        self.out.seek(0, os.SEEK_END)
+
+
+# Function to write the delta of `fileobj` against `base` to `out`. Returns (signature of
+# the new version, delta size), or None once the delta grows past `limit` bytes.
+def encode_delta(fileobj, base, out, limit=None):
+    block_size = base.block_size
+    numpy = load_numpy()
+    index = _WeakIndex(base, numpy) if numpy is not None else None
+    writer = _DeltaWriter(out, base)
+    out.write(b"\0" * HEADER.size)
+    builder = SignatureBuilder(block_size)
+    digest = hashlib.blake2b(digest_size=32)
+    zeros = bytes(block_size)
+    lookahead = (SEARCH_BLOCKS + 1) * block_size
+    buffer = bytearray()
+    start = 0           # offset of buffer[0] in the new file
+    position = 0
+    expected = 0        # base block expected at `position` if the data continues as before
+    eof = False
+
+    def strong_at(offset, data):
+        # Aligned blocks were already hashed for the new signature
+        if offset % block_size == 0 and len(data) == block_size and offset // block_size < builder.blocks:
+            return builder.strong[offset // block_size * STRONG_SIZE:(offset // block_size + 1) * STRONG_SIZE]
+        return strong_checksum(data)
+
+    while True:
+        if position - start >= READ_SIZE:
+            del buffer[:position - start]
+            start = position
+        while not eof and start + len(buffer) < position + lookahead:
+            data = fileobj.read(READ_SIZE)
+            if not data:
+                eof = True
+                break
+            buffer += data
+            digest.update(data)
+            builder.update(data)
+        available = start + len(buffer) - position
+        if available <= 0:
+            break
+        if limit is not None and writer.size > limit:
+            return None
+        offset = position - start
+
+        matched = None
+        candidates = [expected]
+        if position % block_size == 0 and position // block_size != expected:
+            candidates.append(position // block_size)
+        for block in candidates:
+            if block >= base.blocks:
+                continue
+            length = base.block_length(block)
+            if available >= length and strong_at(position, buffer[offset:offset + length]) == base.strong_at(block):
+                matched = block, length
+                break
+        if matched is not None:
+            writer.add_copy(matched[0], position)
+            position += matched[1]
+            expected = matched[0] + 1
+            continue
+
+        length = min(block_size, available)
+        if buffer[offset:offset + length] == (zeros if length == block_size else bytes(length)):
+            writer.add_zeros(length, position)
+            position += length
+            continue
+
+        # A block rewritten in place: the data after it still lines up with the base
+        following = expected + 1
+        if following < base.blocks and available >= block_size + base.block_length(following):
+            if strong_at(position + block_size, buffer[offset + block_size:offset + block_size + base.block_length(
+                    following)]) == base.strong_at(following):
+                writer.add_literal(buffer[offset:offset + block_size], position)
+                position += block_size
+                expected = following
+                continue
+
+        if index is not None and available >= block_size:
+            end = offset + min(available, SEARCH_BLOCKS * block_size + block_size - 1)
+            found = index.search(buffer[offset:end], position)
+            if found is not None:
+                skip, block = found
+                if skip:
+                    writer.add_literal(buffer[offset:offset + skip], position)
+                writer.add_copy(block, position + skip)
+                position += skip + block_size
+                expected = block + 1
+                continue
+            length = end - offset - block_size + 1
+        writer.add_literal(buffer[offset:offset + length], position)
+        position += length
+
+    writer.finish(position, digest.digest())
+    return builder.finish(), writer.size
+
+
+def _read_exact(fileobj, size):
+    data = fileobj.read(size)
+    while len(data) < size:
+        more = fileobj.read(size - len(data))
+        if not more:
+            raise DeltaError("Delta is truncated")
+        data += more
+    return data
+
+
+# Yields the ops of a delta as (op, argument, argument)
+def _read_ops(fileobj):
+    while True:
+        op = _read_exact(fileobj, 1)
+        if op == b"C":
+            yield (op,) + COPY.unpack(_read_exact(fileobj, COPY.size))
+        elif op == b"D":
+            (length,) = DATA.unpack(_read_exact(fileobj, DATA.size))
+            yield op, _read_exact(fileobj, length), None
+        elif op == b"Z":
+            yield op, ZERO.unpack(_read_exact(fileobj, ZERO.size))[0], None
+        elif op == b"B":
+            (block,) = CHECK.unpack(_read_exact(fileobj, CHECK.size))
+            yield op, block, _read_exact(fileobj, STRONG_SIZE)
+        elif op == b"E":
+            yield op, _read_exact(fileobj, 32), None
+            return
+        else:
+            raise DeltaError(f"Unknown delta op {op!r}")
+
+
+def _write_zeros(f, length, digest=None):
+    zeros = bytes(min(length, READ_SIZE))
+    while length:
+        part = zeros[:min(length, len(zeros))]
+        f.write(part)
+        if digest is not None:
+            digest.update(part)
+        length -= len(part)
+
+
+def _file_digest(f):
+    digest = hashlib.blake2b(digest_size=32)
+    f.seek(0)
+    for data in iter(lambda: f.read(READ_SIZE), b""):
+        digest.update(data)
+    return digest.digest()
+
+
+# Copy the `length` bytes of the base version at `offset` of `f` to `undo` before they are overwritten
+def _save_range(f, undo, saved, offset, length, base_size):
+    length = min(length, base_size - offset)
+    if length <= 0:
+        return
+    f.seek(offset)
+    saved.append((offset, length))
+    while length:
+        data = f.read(min(length, READ_SIZE))
+        undo.write(data)
+        length -= len(data)
+
+
+def _restore_ranges(f, undo, saved, base_size):
+    undo.seek(0)
+    for offset, length in saved:
+        f.seek(offset)
+        while length:
+            data = undo.read(min(length, READ_SIZE))
+            f.write(data)
+            length -= len(data)
+    f.truncate(base_size)
+
+
+# Function to turn the file at `target` (the version a delta was made against) into the new
+# version described by the delta read from `fileobj`. Returns the new size.
+def apply_delta(fileobj, target):
+    magic, version, flags, block_size, base_size, size = HEADER.unpack(_read_exact(fileobj, HEADER.size))
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+        raise DeltaError("Not a delta this version can apply")
+    try:
+        current_size = os.path.getsize(target)
+    except FileNotFoundError:
+        raise DeltaError(f"{target} is stored as changes to an earlier version, which has not been restored; "
+                         f"restore the backup chain up to this backup instead") from None
+    if current_size != base_size:
+        raise DeltaError(f"{target} is not the version its delta was made against")
+
+    def check(f, block, expected):
+        f.seek(block * block_size)
+        if strong_checksum(f.read(min(block_size, base_size - block * block_size))) != expected:
+            raise DeltaError(f"{target} is not the version its delta was made against")
+
+    if flags & FLAG_IN_PLACE and os.access(target, os.W_OK):
+        # Only the changed ranges are written; every copy leaves its block where it is.
+        # A read-only target (its mode restored by an earlier archive) is rebuilt instead.
+        # What they overwrite is kept in `undo`, so a failure leaves the base version in place.
+        with open(target, 'r+b') as f, tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as undo:
+            saved = []
+            try:
+                position = 0
+                for op, first, second in _read_ops(fileobj):
+                    if op == b"C":
+                        if first * block_size != position:
+                            raise DeltaError("Delta marked in-place moves data")
+                        position = min((first + second) * block_size, base_size)
+                    elif op == b"B":
+                        check(f, first, second)
+                    elif op == b"D":
+                        _save_range(f, undo, saved, position, len(first), base_size)
+                        f.seek(position)
+                        f.write(first)
+                        position += len(first)
+                    elif op == b"Z":
+                        _save_range(f, undo, saved, position, first, base_size)
+                        f.seek(position)
+                        _write_zeros(f, first)
+                        position += first
+                    else:
+                        expected = first
+                if position != size:
+                    raise DeltaError(f"Delta for {target} does not add up to {size} bytes")
+                f.truncate(size)
+                if _file_digest(f) != expected:
+                    raise DeltaError(f"Checksum mismatch after applying the delta for {target}")
+            except BaseException:
+                _restore_ranges(f, undo, saved, base_size)
+                raise
+        return size
+
+    partial = target + '.delta-partial'
+    try:
+        with open(target, 'rb') as base, open(partial, 'wb') as out:
+            digest = hashlib.blake2b(digest_size=32)
+            for op, first, second in _read_ops(fileobj):
+                if op == b"C":
+                    base.seek(first * block_size)
+                    remaining = min((first + second) * block_size, base_size) - first * block_size
+                    while remaining:
+                        data = base.read(min(remaining, READ_SIZE))
+                        if not data:
+                            raise DeltaError(f"{target} is shorter than its delta expects")
+                        out.write(data)
+                        digest.update(data)
+                        remaining -= len(data)
+                elif op == b"B":
+                    check(base, first, second)
+                elif op == b"D":
+                    out.write(first)
+                    digest.update(first)
+                elif op == b"Z":
+                    _write_zeros(out, first, digest)
+                elif digest.digest() != first:
+                    raise DeltaError(f"Checksum mismatch after applying the delta for {target}")
+        os.replace(partial, target)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return size
+
+
+# A delta waiting to be archived, with the signature of the version it describes
+class DeltaFile:
+    def __init__(self, spool, signature):
+        self.spool = spool
+        self.signature = signature
+
+    def read(self, size=-1):
+        return self.spool.read(size)
+
+    def close(self):
+        self.spool.close()
+
+
+# Decides, per run, which large files are archived as deltas, keeps the signatures of
+# what was archived for the manifest, and collects per-file results for the run's metrics.
+# Full backups (`encode` off) only take signatures.
+class DeltaPolicy:
+    def __init__(self, manifest, min_size=DEFAULT_MIN_SIZE, encode=True):
+        self.manifest = manifest
+        self.min_size = min_size * 1024 * 1024
+        self.encode = encode
+        self.signatures = {}    # (source, path) -> signature bytes, or None to drop the old one
+        self.patched = set()    # (source, path) archived as a delta
+        self.files = []
+        self.full_copies = 0    # files with a signature whose delta was too large
+
+    # Returns (what to archive for this file, delta size or None for the whole file)
+    def prepare(self, source, path, size, fileobj):
+        if size < self.min_size:
+            self.signatures[(source, path)] = None
+            return fileobj, None
+        base = self.manifest.signature(source, path) if self.encode else None
+        if base is not None:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            result = encode_delta(fileobj, Signature.from_bytes(base), spool, int(size * MAX_DELTA_RATIO))
+            if result is not None:
+                signature, stored = result
+                spool.seek(0)
+                self.files.append({'path': os.path.join(source, path), 'size': signature.size, 'stored': stored,
+                                   'ratio': round(stored / signature.size, 4) if signature.size else None})
+                return DeltaFile(spool, signature), stored
+            spool.close()
+            fileobj.seek(0)
+            self.full_copies += 1
+        return SignatureReader(fileobj, block_size_for(size)), None
+
+    # Record the signature of what was archived by prepare()
+    def finish(self, source, path, fileobj):
+        if isinstance(fileobj, DeltaFile):
+            self.signatures[(source, path)] = fileobj.signature.to_bytes()
+            self.patched.add((source, path))
+            fileobj.close()
+        elif isinstance(fileobj, SignatureReader):
+            self.signatures[(source, path)] = fileobj.builder.finish().to_bytes()
+
+    def summary(self):
+        if not self.files and not self.full_copies:
+            return None
+        size = sum(item['size'] for item in self.files)
+        stored = sum(item['stored'] for item in self.files)
+        return {'files': len(self.files), 'bytes': size, 'stored': stored,
+                'ratio': round(stored / size, 4) if size else None, 'full_copies': self.full_copies,
+                'per_file': sorted(self.files, key=lambda item: item['stored'], reverse=True)[:MAX_REPORTED]}
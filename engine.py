@@ -0,0 +1,801 @@
+import os
+import io
+import stat
+import time
+import threading
+import tarfile
+import configparser
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from compression import ParallelCompressor, CompressionPolicy, open_decompressed_stream, DEFAULT_LEVELS, EXTENSIONS
+from manifest import BackupManifest
+from catalog import BackupCatalog, make_source_set
+from scanner import scan_tree, ScanStats
+from extractor import RestoreWriter, data_extents, format_extents, parse_extents, SPARSE_PAX_KEY, CHUNK_SIZE
+from metrics import RunMetrics, export_metrics
+from checksums import ArchiveChecksums
+
+# Headless backup engine shared by the GUI (main.py) and the command line (backup.py).
+#
+# Nothing here imports Tk, matplotlib or PIL, and optional heavy modules
+# (cryptography, zstandard) are only imported when a run actually needs
+# them, so scheduled jobs start fast on servers without a display. The
+# storage backends, seekable and repository formats, block deltas and the
+# change journal are likewise imported by the functions that use them.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(APP_DIR, 'user_config.ini')
+METADATA_FILE = os.path.join(APP_DIR, 'backup_metadata.json')
+CATALOG_FILE = os.path.join(APP_DIR, 'backup_catalog.db')
+MANIFEST_FILE = os.path.join(APP_DIR, 'backup_manifest.db')
+JOURNAL_FILE = os.path.join(APP_DIR, 'change_journal.db')
+LOCK_DIR = os.path.join(APP_DIR, 'locks')
+
+# 'tar' writes one compressed tar stream; 'seekable' writes independently
+# compressed blocks plus a per-file index (see seekable.py); 'repository'
+# adds a snapshot to a deduplicating chunk store in the destination (see repository.py)
+ARCHIVE_FORMATS = ('tar', 'seekable', 'repository')
+
+
+class BackupError(Exception):
+    pass
+
+
+# Raised from a progress callback when the user cancels a running job
+class BackupCancelled(BackupError):
+    pass
+
+
+# Raised when another backup of the same source set holds its lock
+class BackupRunning(BackupError):
+    pass
+
+
+def password_to_key(password):
+    import base64
+    import hashlib
+    return base64.urlsafe_b64encode(hashlib.sha256(password.encode()).digest())
+
+
+# Function to load the saved preferences as plain Python values
+def load_config(config_file=CONFIG_FILE):
+    from delta import DEFAULT_MIN_SIZE as DELTA_MIN_SIZE
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    prefs = config['Preferences'] if 'Preferences' in config else {}
+    codec = prefs.get('compression', 'gzip') or 'gzip'
+    try:
+        level = int(prefs.get('compression_level', ''))
+    except ValueError:
+        level = DEFAULT_LEVELS.get(codec)
+    return {
+        'source_dirs': split_source_dirs(prefs.get('source_dirs', '')),
+        'backup_dir': prefs.get('backup_dir', ''),
+        'frequency': prefs.get('frequency', ''),
+        'encryption_enabled': config.getboolean('Preferences', 'encryption_enabled', fallback=False),
+        'content_hash': config.getboolean('Preferences', 'content_hash', fallback=False),
+        'compression': codec,
+        'compression_level': level,
+        'archive_format': prefs.get('archive_format', 'tar') or 'tar',
+        # Store already-compressed files instead of compressing them again
+        'adaptive_compression': config.getboolean('Preferences', 'adaptive_compression', fallback=True),
+        # Optional JSON-lines file, or Prometheus textfile if it ends in .prom, that every run is exported to
+        'metrics_export': prefs.get('metrics_export', ''),
+        # Grandfather-father-son retention applied after every backup (see retention.py); all 0 = keep everything
+        'keep_daily': config.getint('Preferences', 'keep_daily', fallback=0),
+        'keep_weekly': config.getint('Preferences', 'keep_weekly', fallback=0),
+        'keep_monthly': config.getint('Preferences', 'keep_monthly', fallback=0),
+        # Time budget of one `backup.py scrub` run, in minutes (see verify.py)
+        'scrub_minutes': config.getfloat('Preferences', 'scrub_minutes', fallback=30),
+        # Resource limits of backup runs (see governor.py); 0 or empty = unlimited
+        'read_limit': config.getfloat('Preferences', 'read_limit', fallback=0),
+        'write_limit': config.getfloat('Preferences', 'write_limit', fallback=0),
+        'nice': config.getint('Preferences', 'nice', fallback=0),
+        'io_class': prefs.get('io_class', ''),
+        'max_workers': config.getint('Preferences', 'max_workers', fallback=0),
+        'max_load': config.getfloat('Preferences', 'max_load', fallback=0),
+        'max_disk_await': config.getfloat('Preferences', 'max_disk_await', fallback=0),
+        # Changed files of at least this many MB are archived as block deltas by incrementals (see delta.py); 0 = never
+        'delta_min_size': config.getfloat('Preferences', 'delta_min_size', fallback=DELTA_MIN_SIZE),
+        # Scheduled jobs that may run at once, in total and per destination disk or host (see scheduler.py)
+        'max_concurrent_jobs': config.getint('Preferences', 'max_concurrent_jobs', fallback=2),
+        'max_jobs_per_destination': config.getint('Preferences', 'max_jobs_per_destination', fallback=1),
+    }
+
+
+def split_source_dirs(value):
+    return [path for path in value.split('; ') if path]
+
+
+def open_catalog():
+    return BackupCatalog(CATALOG_FILE, legacy_metadata_file=METADATA_FILE)
+
+
+def record_backup_metadata(backup_file, backup_type, size, backup_location, backup_folder, encrypted=False,
+                           source_set='', status='success', details=None, checksums=None):
+    if encrypted:
+        backup_file += ".enc"
+
+    with open_catalog() as catalog:
+        return catalog.add_backup(backup_file, backup_type, size, backup_location, backup_folder,
+                                  source_set=source_set, encrypted=encrypted, status=status, details=details,
+                                  checksums=checksums)
+
+
+def get_backup(backup_id):
+    with open_catalog() as catalog:
+        entry = catalog.get_backup(backup_id)
+    if entry is None:
+        raise BackupError(f"No backup with id {backup_id}.")
+    return entry
+
+
+def list_backups(limit=None, after=None, **filters):
+    with open_catalog() as catalog:
+        return catalog.list_backups(limit=limit, after=after, **filters)
+
+
+def format_backup_entry(entry):
+    status = "" if entry['status'] == 'success' else f" [{entry['status']}]"
+    return f"{entry['id']}. {entry['timestamp']} - {entry['backup_type']} - Size: {entry['size']} bytes{status}"
+
+
+def list_backup_versions(limit=None):
+    return [format_backup_entry(entry) for entry in list_backups(limit=limit)]
+
+
+def get_backup_path(entry):
+    import storage
+    backup_path = storage.join(entry['backup_location'], entry['backup_file'])
+    if backup_path.endswith(".enc") and not storage.exists(backup_path):
+        backup_path = backup_path.replace(".enc", "")
+    return backup_path
+
+
+# Function to open a new backup archive, compressing it in parallel and encrypting it on the fly when a password is given.
+# `backup_path` may be local or remote (see storage.py); it only appears there once the archive is complete.
+# `checksums`, a checksums.ArchiveChecksums, records block and file checksums for verify.py.
+# `governor`, a governor.Governor, paces the writes and caps the compression workers.
+@contextmanager
+def open_backup_for_writing(backup_path, password, codec="gzip", level=None, archive_format='tar', metrics=None,
+                            policy=None, checksums=None, governor=None):
+    import storage
+    output = storage.open_output(backup_path)
+    workers = governor.workers if governor is not None else None
+    try:
+        f = metrics.writer(output, 'write') if metrics is not None else output
+        if governor is not None:
+            f = governor.writer(f)
+        if checksums is not None:
+            f = checksums.writer(f)
+        if archive_format == 'seekable':
+            from seekable import SeekableArchiveWriter
+            with SeekableArchiveWriter(f, codec=codec, level=level, password=password, workers=workers,
+                                       metrics=metrics, policy=policy, governor=governor) as archive:
+                yield archive
+        else:
+            if password:
+                from stream_crypto import EncryptingWriter
+                writer = EncryptingWriter(f, password)
+                if metrics is not None:
+                    writer = metrics.writer(writer, 'encrypt')
+            else:
+                writer = f
+            compressor = ParallelCompressor(writer, codec=codec, level=level, workers=workers, metrics=metrics,
+                                            policy=policy)
+            try:
+                with tarfile.open(fileobj=compressor, mode="w|") as tar:
+                    yield checksums.tar(tar) if checksums is not None else tar
+            except BaseException:
+                compressor.abort()
+                raise
+            compressor.close()
+            if password:
+                writer.close()
+        if checksums is not None:
+            checksums.finish()
+        # Finishing a remote upload waits for the parts still in flight
+        with metrics.timed('write') if metrics is not None else nullcontext():
+            output.commit()
+    except BaseException:
+        output.abort()
+        raise
+
+
+# Function to open a backup archive as a plaintext stream, decrypting on the fly if needed
+@contextmanager
+def open_backup_for_reading(backup_file, password=None, metrics=None):
+    import storage
+    with storage.open_input(backup_file) as f:
+        if metrics is not None:
+            f = metrics.reader(f, 'read')
+        if not backup_file.endswith(".enc"):
+            yield f
+            return
+
+        if not password:
+            raise BackupError("Password is required for decryption.")
+
+        from stream_crypto import DecryptingReader, is_stream_encrypted
+        if is_stream_encrypted(f):
+            reader = DecryptingReader(f, password)
+            yield metrics.reader(reader, 'decrypt') if metrics is not None else reader
+        else:
+            # Legacy Fernet backups are a single token and can only be decrypted in memory
+            from cryptography.fernet import Fernet
+            cipher = Fernet(password_to_key(password))
+            yield io.BytesIO(cipher.decrypt(f.read()))
+
+
+# Function to encrypt an existing backup file in place
+def encrypt_backup_file(backup_path, password):
+    from stream_crypto import encrypt_file
+    encrypted_backup_path = backup_path + ".enc"
+    encrypt_file(backup_path, encrypted_backup_path, password)
+    os.remove(backup_path)  # Remove original file after encryption
+    return encrypted_backup_path
+
+
+# Function to decrypt an encrypted backup file in place
+def decrypt_backup_file(backup_path, password):
+    from stream_crypto import decrypt_file, is_stream_encrypted
+    decrypted_backup_path = backup_path.replace(".enc", "")
+    if is_stream_encrypted(backup_path):
+        decrypt_file(backup_path, decrypted_backup_path, password)
+    else:
+        # Legacy Fernet backups are a single token and can only be decrypted in memory
+        from cryptography.fernet import Fernet
+        cipher = Fernet(password_to_key(password))
+        with open(backup_path, 'rb') as encrypted_file:
+            decrypted_data = cipher.decrypt(encrypted_file.read())
+        with open(decrypted_backup_path, 'wb') as decrypted_file:
+            decrypted_file.write(decrypted_data)
+    os.remove(backup_path)  # Remove encrypted file after decryption
+    return decrypted_backup_path
+
+
+# Function to add a scanned file or directory to the archive under the source's folder name.
+# The archive entry is built from the stat result taken by the scanner, so the file is not stat'ed again.
+# With a delta.DeltaPolicy, a large file may be archived as a delta against its previous version.
+def add_scanned_entry(tar, source, scanned, scan_stats=None, metrics=None, policy=None, governor=None, deltas=None):
+    arcname = os.path.basename(source)
+    if scanned.path != '.':
+        arcname = f"{arcname}/{scanned.path}"
+
+    from seekable import SeekableArchiveWriter
+    if isinstance(tar, SeekableArchiveWriter):
+        if tar.add(arcname, scanned.abs_path, scanned.stat, deltas, (source, scanned.path)) and scan_stats is not None:
+            scan_stats.stat_calls_saved += 1
+        return
+
+    st = scanned.stat
+    tarinfo = tar.tarinfo(arcname)
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.mtime = st.st_mtime
+    tarinfo.uid, tarinfo.gid = st.st_uid, st.st_gid
+    tarinfo.uname, tarinfo.gname = lookup_owner_names(st.st_uid, st.st_gid)
+    if stat.S_ISREG(st.st_mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(scanned.abs_path)
+    else:
+        # Devices, fifos and sockets are rare enough to let tarfile handle them
+        tar.add(scanned.abs_path, arcname=arcname, recursive=False)
+        return
+
+    if scan_stats is not None:
+        scan_stats.stat_calls_saved += 1
+
+    if tarinfo.type == tarfile.REGTYPE:
+        with open(scanned.abs_path, 'rb') as f:
+            extents = data_extents(f, st)
+            if extents:
+                # The holes are recreated on restore (see extractor.py)
+                tarinfo.pax_headers = {SPARSE_PAX_KEY: format_extents(extents)}
+            if policy is not None:
+                policy.select(scanned.path, st.st_size, f)
+            reader = metrics.reader(f, 'read') if metrics is not None else f
+            if governor is not None:
+                reader = governor.reader(reader)
+            if deltas is not None:
+                reader, delta_size = deltas.prepare(source, scanned.path, st.st_size, reader)
+                if delta_size is not None:
+                    from delta import DELTA_PAX_KEY
+                    tarinfo.size = delta_size
+                    tarinfo.pax_headers = {DELTA_PAX_KEY: '1'}
+            tar.addfile(tarinfo, reader)
+            if deltas is not None:
+                deltas.finish(source, scanned.path, reader)
+    else:
+        tar.addfile(tarinfo)
+
+
+# Function to resolve user and group names once per id instead of once per file
+owner_name_cache = {}
+
+def lookup_owner_names(uid, gid):
+    key = (uid, gid)
+    if key not in owner_name_cache:
+        uname = gname = ""
+        try:
+            import pwd
+            import grp
+            uname = pwd.getpwuid(uid).pw_name
+            gname = grp.getgrgid(gid).gr_name
+        except (ImportError, KeyError):
+            pass
+        owner_name_cache[key] = (uname, gname)
+    return owner_name_cache[key]
+
+
+# Function to run a backup. `progress`, if given, is told about every archived entry
+# (see jobs.JobProgress) and may cancel the run by raising BackupCancelled.
+# `backup_dir` may be a local directory or an s3:// or sftp:// URL (see storage.py);
+# either way the archive only appears there once complete.
+# Per-stage timings are stored in the catalog entry and, if `metrics_export` names
+# a file, exported there (see metrics.py).
+# `governor`, a governor.Governor, limits the run's bandwidth, priority and workers
+# and pauses it while the system is busy; the time it was held back is recorded too.
+# Incremental runs take the changed paths from the change journal when its watcher
+# covered everything since the last run (see journal.py), unless `use_journal` is off.
+# Changed files of at least `delta_min_size` MB are archived as block deltas against
+# their previous version (see delta.py); 0 turns deltas off.
+def run_backup(source_dirs, backup_dir, backup_type='Full', password=None, codec='gzip', level=None, hash_files=False,
+               archive_format='tar', progress=None, metrics_export=None, adaptive=True, governor=None,
+               use_journal=True, delta_min_size=None):
+    import storage
+    from delta import DeltaPolicy, DEFAULT_MIN_SIZE as DELTA_MIN_SIZE
+    from seekable import EXTENSION as SEEKABLE_EXTENSION
+    from repository import Repository, backup_to_repository, repository_path, REPOSITORY_DIR, SNAPSHOT_EXTENSION
+    from journal import open_journal, scan_changes
+    if delta_min_size is None:
+        delta_min_size = DELTA_MIN_SIZE
+    if not source_dirs or not backup_dir:
+        raise BackupError("Please select source directories and backup destination.")
+    if backup_type not in ('Full', 'Incremental'):
+        raise BackupError(f"Unknown backup type: {backup_type}")
+    if archive_format not in ARCHIVE_FORMATS:
+        raise BackupError(f"Unknown archive format: {archive_format}")
+    if archive_format == 'repository' and storage.is_remote(backup_dir):
+        raise BackupError("The repository format needs a local or mounted destination.")
+
+    if archive_format == 'repository':
+        # Every snapshot is complete; only chunks the repository lacks are written either way
+        backup_type = 'Full'
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    extension = {'seekable': SEEKABLE_EXTENSION, 'repository': SNAPSHOT_EXTENSION}.get(archive_format, EXTENSIONS[codec])
+    backup_file = reserve_backup_name(backup_dir, f"backup_{timestamp}_{backup_type.lower()}", extension)
+    if archive_format == 'repository':
+        # Snapshots share one directory, so the name must not depend on the second alone
+        backup_file = os.path.join(REPOSITORY_DIR, 'snapshots', f"backup_{timestamp}_{os.urandom(4).hex()}{extension}")
+    backup_path = storage.join(backup_dir, backup_file)
+    if password:
+        # Encrypt on the fly if password is provided
+        backup_path += ".enc"
+
+    source_set = make_source_set(source_dirs)
+    scan_stats = ScanStats()
+    metrics = RunMetrics('backup')
+    policy = CompressionPolicy(codec, level) if adaptive else None
+    checksums = ArchiveChecksums(metrics=metrics) if archive_format != 'repository' else None
+    archived = [0]
+    details = {}
+    deltas = None
+    scan_workers = None
+    if governor is not None:
+        governor.apply_priority()
+        governor.watch(source_dirs + ([] if storage.is_remote(backup_dir) else [backup_dir]))
+        scan_workers = governor.workers
+
+    def archive_entry(tar, source, scanned):
+        add_scanned_entry(tar, source, scanned, scan_stats, metrics, policy, governor, deltas)
+        archived[0] += 1
+        if progress is not None:
+            progress.advance(scanned.path, scanned.stat.st_size if stat.S_ISREG(scanned.stat.st_mode) else 0)
+
+    lock = lock_source_set(source_set)
+    journal = None
+    try:
+        # A source that is gone must fail the run, not look like every file in it was deleted
+        for source in source_dirs:
+            if not os.path.isdir(source):
+                raise BackupError(f"Source directory does not exist: {source}")
+        if use_journal:
+            journal = open_journal(JOURNAL_FILE)
+        # Where the journal stands before anything is scanned; the manifest reflects at least that much afterwards
+        positions = journal.sync([os.path.abspath(source) for source in source_dirs]) if journal is not None else {}
+        with BackupManifest(MANIFEST_FILE) as manifest:
+            if backup_type == 'Full' and progress is not None:
+                # The previous state of the sources is a good estimate of what this run will read
+                for source in source_dirs:
+                    progress.add_totals(*manifest.source_totals(os.path.abspath(source)))
+            if archive_format != 'repository' and delta_min_size:
+                # Repository snapshots already store only the chunks that changed
+                deltas = DeltaPolicy(manifest, delta_min_size, encode=backup_type == 'Incremental')
+            if archive_format == 'repository':
+                with Repository(repository_path(backup_dir), password, codec, level, workers=scan_workers,
+                                metrics=metrics) as repository:
+                    repository.acquire()
+                    _, scans, archived[0] = backup_to_repository(repository, source_dirs, source_set,
+                                                                 os.path.basename(backup_path), scan_stats, progress,
+                                                                 metrics, policy, governor)
+                    details['repository'] = repository.stats
+                manifest.record_full(os.path.relpath(backup_path, backup_dir), scans, hash_files=hash_files)
+            elif backup_type == 'Full':
+                # Create the backup archive and remember every file's state for later incrementals
+                scans = {}
+                with open_backup_for_writing(backup_path, password, codec, level, archive_format, metrics,
+                                             policy, checksums, governor) as tar:
+                    for source in source_dirs:
+                        source = os.path.abspath(source)
+                        scanned_files = scans[source] = []
+                        for scanned in scan_tree(source, include_dirs=True, workers=scan_workers, stats=scan_stats):
+                            archive_entry(tar, source, scanned)
+                            if not stat.S_ISDIR(scanned.stat.st_mode):
+                                scanned_files.append(scanned)
+                manifest.record_full(os.path.basename(backup_path), scans, hash_files=hash_files,
+                                     signatures=deltas.signatures if deltas is not None else None)
+            else:
+                # Archive only what changed since the state recorded in the manifest
+                diffs = []
+                with open_backup_for_writing(backup_path, password, codec, level, archive_format, metrics,
+                                             policy, checksums, governor) as tar:
+                    for source in source_dirs:
+                        source = os.path.abspath(source)
+                        changes = journal.changes_since(source, positions.get(source)) if journal is not None else None
+                        if changes is None:
+                            scanned_files = scan_tree(source, workers=scan_workers, stats=scan_stats)
+                        else:
+                            scanned_files = scan_changes(source, changes, workers=scan_workers, stats=scan_stats)
+                        diff = manifest.diff(source, scanned_files, hash_files=hash_files, scope=changes,
+                                             on_change=lambda scanned, source=source: archive_entry(tar, source, scanned),
+                                             unreadable=scan_stats.unreadable)
+                        diffs.append(diff)
+                manifest.record_incremental(os.path.basename(backup_path), diffs,
+                                            deltas.signatures if deltas is not None else None,
+                                            deltas.patched if deltas is not None else ())
+                if journal is not None:
+                    details['change_journal'] = {
+                        'used': [source for source in map(os.path.abspath, source_dirs) if source not in journal.fallbacks],
+                        'full_scan': dict(journal.fallbacks)}
+            for source, position in positions.items():
+                journal.checkpoint(source, position)
+
+        size = storage.size(backup_path)
+        if archive_format == 'repository':
+            # What this version added to the repository: new packs plus the snapshot itself
+            size += details['repository']['bytes_stored']
+        if scan_stats.unreadable:
+            # Left as they were in the manifest; listed so the caller can report them
+            details['unreadable'] = sorted(scan_stats.unreadable)
+        details.update(scan=scan_stats.as_dict(), format=archive_format,
+                       metrics=finish_backup_metrics(metrics, scan_stats, archived[0], size, policy, governor, deltas))
+        if checksums is not None:
+            details['checksums'] = checksums.summary()
+        entry = record_backup_metadata(backup_file, backup_type, size, backup_dir, backup_file, encrypted=bool(password),
+                                       source_set=source_set, details=details, checksums=checksums)
+
+    except Exception as e:
+        # Log the failure in the catalog
+        status = 'cancelled' if isinstance(e, BackupCancelled) else 'failed'
+        entry = record_backup_metadata(backup_file, backup_type, 0, backup_dir, backup_file, source_set=source_set,
+                                       status=status, details={'error': str(e), 'metrics': finish_backup_metrics(
+                                           metrics, scan_stats, archived[0], 0, policy, governor, deltas)})
+        if metrics_export:
+            export_metrics(metrics_export, entry)
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        if lock is not None:
+            lock.close()
+
+    if metrics_export:
+        export_metrics(metrics_export, entry)
+    return entry
+
+
+# Archive names handed out by this process. Scheduled jobs start backups in parallel, and the
+# manifest tells runs apart by file name, so two runs in one second must not share a name.
+reserved_names = set()
+reserved_names_lock = threading.Lock()
+
+def reserve_backup_name(backup_dir, stem, extension):
+    import storage
+    with reserved_names_lock:
+        name = f"{stem}{extension}"
+        suffix = 1
+        while name in reserved_names or any(storage.exists(storage.join(backup_dir, candidate))
+                                            for candidate in (name, name + '.enc')):
+            suffix += 1
+            name = f"{stem}{suffix}{extension}"
+        reserved_names.add(name)
+        return name
+
+
+# Function to take the lock that keeps two backups of one source set from overlapping, whether
+# they come from the scheduler, cron, the command line or the GUI. Returns the open lock file;
+# closing it (or the process ending) releases the lock.
+def lock_source_set(source_set):
+    import hashlib
+    name = hashlib.blake2b(source_set.encode(), digest_size=8).hexdigest()
+    return acquire_lock(os.path.join(LOCK_DIR, f"{name}.lock"), f"A backup of {source_set} is already running")
+
+
+# Function to take an exclusive lock on file `path`, raising BackupRunning with `busy_message`
+# and the holder's pid if another process or thread holds it
+def acquire_lock(path, busy_message):
+    try:
+        import fcntl
+    except ImportError:
+        return None  # No advisory locks on Windows
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock_file = open(path, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.seek(0)
+        owner = lock_file.read().strip()
+        lock_file.close()
+        raise BackupRunning(busy_message + (f" ({owner})" if owner else ""))
+    lock_file.truncate(0)
+    lock_file.write(f"pid {os.getpid()} since {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    lock_file.flush()
+    return lock_file
+
+
+# Function to close a backup's metrics: the scanner's own counters become the 'scan' stage
+def finish_backup_metrics(metrics, scan_stats, files, archive_size, policy=None, governor=None, deltas=None):
+    metrics.add('scan', scan_stats.elapsed, scan_stats.cpu, scan_stats.bytes)
+    bytes_in = metrics.stages.get('read', {}).get('bytes', 0)
+    return metrics.finish(files=files, bytes_in=bytes_in, bytes_out=archive_size,
+                          compression_ratio=round(bytes_in / archive_size, 3) if archive_size and bytes_in else None,
+                          adaptive=policy.summary() if policy is not None else None,
+                          throttled=governor.summary() if governor is not None else None,
+                          delta=deltas.summary() if deltas is not None else None)
+
+
+# Function to check whether a tar member is one of `paths` or lies below one of them
+def member_selected(name, paths):
+    name = name.rstrip('/')
+    return any(name == path or name.startswith(path + '/') for path in paths)
+
+
+# Function to extract a backup archive (or only `paths` inside it, or only members accepted by
+# `predicate(name)`) into `restore_location`. Returns the restore's metrics (see metrics.py),
+# which are also exported if `metrics_export` is set. `workers` is the number of writer threads.
+def restore_backup(backup_file, restore_location, password=None, paths=None, progress=None, metrics_export=None,
+                   predicate=None, workers=None):
+    import storage
+    if not storage.exists(backup_file):
+        raise BackupError(f"Backup file does not exist: {backup_file}")
+    metrics = RunMetrics('restore')
+    record = {'backup_file': os.path.basename(backup_file), 'status': 'success'}
+    extracted = 0
+    try:
+        extracted = extract_archive(backup_file, restore_location, password, paths, predicate, progress, metrics,
+                                    workers)
+        if not extracted and paths and predicate is None:
+            raise BackupError(f"No entries match: {', '.join(paths)}")
+    except Exception as e:
+        record.update(status='cancelled' if isinstance(e, BackupCancelled) else 'failed', error=str(e))
+        raise
+    finally:
+        stages = metrics.stages
+        bytes_out = stages.get('extract', {}).get('bytes', 0)
+        elapsed = time.perf_counter() - metrics.started
+        record['metrics'] = metrics.finish(files=extracted,
+                                           bytes_in=stages.get('read', {}).get('bytes', 0),
+                                           bytes_out=bytes_out,
+                                           mb_per_second=round(bytes_out / elapsed / (1024 * 1024), 2) if elapsed else None)
+        if metrics_export:
+            export_metrics(metrics_export, record)
+    return record['metrics']
+
+
+# Function to extract the members of one archive that are below `paths` and accepted by
+# `predicate(name)`; returns the number of entries extracted. The archive is decoded on this
+# thread and written by a pool of `workers` writer threads (see extractor.py).
+def extract_archive(backup_file, restore_location, password=None, paths=None, predicate=None, progress=None,
+                    metrics=None, workers=None):
+    from repository import is_repository_snapshot, restore_snapshot
+    from seekable import SeekableArchiveReader, is_seekable_archive
+    from delta import DELTA_PAX_KEY
+    if is_repository_snapshot(backup_file):
+        return restore_snapshot(backup_file, restore_location, password, paths, predicate, progress, metrics, workers)
+    if is_seekable_archive(backup_file):
+        # Seekable archives read only the index and the blocks holding the requested paths
+        with SeekableArchiveReader(backup_file, password, metrics) as archive:
+            return len(archive.extract(restore_location, paths, predicate, progress, workers))
+
+    # Encrypted backups are decrypted straight into tarfile, nothing is written besides the restored files
+    with open_backup_for_reading(backup_file, password, metrics) as stream:
+        stream = open_decompressed_stream(stream)
+        if metrics is not None:
+            stream = metrics.reader(stream, 'decompress')
+        with tarfile.open(fileobj=stream, mode="r|") as tar, \
+                RestoreWriter(restore_location, workers, metrics) as writer:
+            wanted = [path.strip('/') for path in paths] if paths else None
+            extracted = 0
+            for member in tar:
+                if wanted and not member_selected(member.name, wanted):
+                    continue
+                if predicate is not None and not predicate(member.name.rstrip('/')):
+                    continue
+                if progress is not None:
+                    progress.check()
+                apply = lambda target, member=member: set_member_attributes(tar, member, target)
+                if member.isdir():
+                    writer.make_directory(member.name, apply)
+                elif member.isreg() and not member.issparse() and DELTA_PAX_KEY not in member.pax_headers:
+                    # Decompressed here, written by the writer pool
+                    output = writer.create(member.name, member.size,
+                                           parse_extents(member.pax_headers.get(SPARSE_PAX_KEY)))
+                    data = tar.extractfile(member)
+                    offset = 0
+                    for chunk in iter(lambda: data.read(CHUNK_SIZE), b""):
+                        writer.write(output, offset, chunk)
+                        offset += len(chunk)
+                    writer.close(output, apply)
+                else:
+                    # Links and deltas refer to files written before them
+                    writer.drain()
+                    with metrics.timed('extract') if metrics is not None else nullcontext():
+                        extract_member(tar, member, writer)
+                    if metrics is not None:
+                        metrics.add('extract', nbytes=member.size if member.isreg() else 0)
+                extracted += 1
+                if progress is not None:
+                    progress.advance(member.name, member.size if member.isreg() else 0)
+            writer.finish()
+            return extracted
+
+
+# Function to extract a tar member the restore writer does not write itself. A delta member is
+# applied to the version of the file that was restored before it (see delta.py); its metadata
+# joins the writer's final batch, after that of the version it replaces.
+def extract_member(tar, member, writer):
+    from delta import apply_delta, DELTA_PAX_KEY
+    if DELTA_PAX_KEY not in member.pax_headers:
+        tar.extract(member, path=writer.root, set_attrs=True)
+        return
+    target = writer.target(member.name)
+    apply_delta(tar.extractfile(member), target)
+    writer.defer(target, lambda target: set_member_attributes(tar, member, target))
+
+
+def set_member_attributes(tar, member, target):
+    tar.chown(member, target, False)    # only takes effect when running as root
+    tar.chmod(member, target)
+    tar.utime(member, target)
+
+
+# Function to list what a backup archive contains; seekable archives only read their index
+def list_archive_contents(backup_file, password=None):
+    from repository import is_repository_snapshot, list_snapshot_contents
+    from seekable import SeekableArchiveReader, is_seekable_archive
+    from delta import DELTA_PAX_KEY
+    if is_repository_snapshot(backup_file):
+        return list_snapshot_contents(backup_file, password)
+    if is_seekable_archive(backup_file):
+        with SeekableArchiveReader(backup_file, password) as archive:
+            return [{'path': entry['path'], 'type': entry['type'], 'size': entry.get('size', 0), 'mtime': entry['mtime']}
+                    for entry in archive.entries]
+
+    contents = []
+    with open_backup_for_reading(backup_file, password) as stream:
+        with tarfile.open(fileobj=open_decompressed_stream(stream), mode="r|") as tar:
+            for member in tar:
+                kind = ('dir' if member.isdir() else 'symlink' if member.issym() else
+                        'delta' if DELTA_PAX_KEY in member.pax_headers else 'file')
+                contents.append({'path': member.name, 'type': kind, 'size': member.size, 'mtime': member.mtime})
+    return contents
+
+
+# Function to restore one backup. Files an incremental stored as deltas need the version they
+# were made against, so those are rebuilt from the chain of backups up to this one first.
+def restore_backup_by_version(backup_id, restore_location, password=None, paths=None, progress=None,
+                              metrics_export=None, workers=None):
+    entry = get_backup(backup_id)
+    predicate = None
+    backup_metrics = entry['details'].get('metrics') or {}
+    if progress is not None and not paths and entry['details'].get('format', 'tar') == 'tar' and backup_metrics:
+        # A tar stream has no index to count; the backup's own totals give the restore an ETA
+        progress.add_totals(backup_metrics.get('files', 0), backup_metrics.get('bytes_in', 0))
+    if entry['backup_type'] == 'Incremental':
+        from point_in_time import patched_members, restore_chain_paths
+        patched = patched_members(entry, password)
+        if paths:
+            wanted = [path.strip('/') for path in paths]
+            patched = {name for name in patched if member_selected(name, wanted)}
+        if patched:
+            restore_chain_paths(entry, restore_location, password, patched, progress)
+            predicate = lambda name: name not in patched
+    restore_metrics = restore_backup(get_backup_path(entry), restore_location, password, paths,
+                                     progress, metrics_export, predicate, workers)
+    # Keep the latest restore's timings next to the backup they were measured on
+    with open_catalog() as catalog:
+        catalog.update_details(backup_id, last_restore=restore_metrics)
+    return restore_metrics
+
+
+# Function to delete a backup. If a later incremental depends on it, it is merged into
+# that incremental instead (see retention.py), so the chain stays restorable; the merged
+# catalog entry is returned in that case.
+def delete_backup(backup_id, password=None, progress=None):
+    entry = get_backup(backup_id)
+    if entry['status'] == 'success':
+        from retention import fold_into_successor
+        merged = fold_into_successor(entry, password, progress)
+        if merged is not None:
+            return merged
+
+    import storage
+    backup_path = storage.join(entry['backup_location'], entry['backup_file'])
+
+    # Check for both encrypted and decrypted file paths
+    if storage.exists(backup_path):
+        storage.remove(backup_path)
+    elif backup_path.endswith(".enc") and storage.exists(backup_path.replace(".enc", "")):
+        storage.remove(backup_path.replace(".enc", ""))
+    elif entry['status'] == 'success':
+        raise BackupError(f"Backup file does not exist: {backup_path}")
+
+    with open_catalog() as catalog:
+        catalog.delete_backup(backup_id)
+    with BackupManifest(MANIFEST_FILE) as manifest:
+        manifest.forget_runs([entry['backup_file']])
+    return None
+
+
+# Function to delete whole backup chains (a full backup plus its incrementals), keeping the newest `keep_full` per source set.
+# Chains are made of successful backups only; failed and cancelled runs older than the kept chains go with them.
+def prune_backups(keep_full):
+    if keep_full < 1:
+        raise BackupError("At least one full backup must be kept.")
+    import storage
+
+    removed = []
+    with open_catalog() as catalog:
+        for source_set in catalog.source_sets():
+            chains = []
+            unsuccessful = []
+            for entry in catalog.iter_backups(source_set=source_set):
+                if entry['status'] != 'success':
+                    unsuccessful.append(entry)
+                    continue
+                if entry['backup_type'] == 'Full' or not chains:
+                    chains.append([])
+                chains[-1].append(entry)
+
+            doomed = [entry for chain in chains[:-keep_full] for entry in chain]
+            if len(chains) > keep_full:
+                kept_from = (chains[-keep_full][0]['timestamp'], chains[-keep_full][0]['id'])
+                doomed += [entry for entry in unsuccessful if (entry['timestamp'], entry['id']) < kept_from]
+            for entry in doomed:
+                backup_path = get_backup_path(entry)
+                if storage.exists(backup_path):
+                    storage.remove(backup_path)
+                catalog.delete_backup(entry['id'])
+                removed.append(entry)
+    with BackupManifest(MANIFEST_FILE) as manifest:
+        manifest.forget_runs([entry['backup_file'] for entry in removed])
+    return removed
+
+
+# Function to delete the repository pack files that no remaining snapshot refers to.
+# Deleting or pruning repository backups only removes their snapshots; this frees the space.
+def collect_repository_garbage(backup_dir, password=None):
+    import storage
+    from repository import Repository, repository_path
+    path = repository_path(backup_dir)
+    if storage.is_remote(backup_dir) or not os.path.exists(os.path.join(path, 'config.json')):
+        raise BackupError(f"No backup repository in {backup_dir}")
+    with Repository(path, password) as repository:
+        repository.acquire()
+        return repository.garbage_collect()
@@ -0,0 +1,299 @@
+import os
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Parallel restore writer.
+#
+# The archive is read, decrypted and decompressed on the caller's thread;
+# file data is handed to a pool of writer threads in chunks and written with
+# os.pwrite at its offset, so several files, and several parts of one large
+# file, are written while the next data is being decoded. Where os.pwrite is
+# missing (Windows), each file's writes seek and write under a per-file lock.
+# At most MAX_PENDING bytes wait for a writer, which bounds memory.
+#
+#   preallocation  files of PREALLOCATE_MIN bytes and up get their space from
+#                  posix_fallocate before the first write, so they are laid
+#                  out contiguously and a full disk is reported up front.
+#   sparse files   backups record the data extents of files with holes
+#                  (SPARSE_PAX_KEY in tar, 'sparse' in seekable archives).
+#                  Only those extents are allocated and written; the rest
+#                  stays a hole. All-zero chunks are never written to a
+#                  preallocated or sparse file, as they read back as zeros.
+#   metadata       mode, mtime and ownership are applied in one batch once
+#                  the data is written: files on the writer pool, then
+#                  directories, deepest first, so their times stick.
+#
+# Files are created by the caller's thread, in archive order, so links and
+# deltas that refer to them find them; drain() waits for their data.
+SPARSE_PAX_KEY = 'ABU.sparse'
+SPARSE_MIN = 1024 * 1024            # smaller files are not checked for holes
+PREALLOCATE_MIN = 16 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+MAX_PENDING = 64 * 1024 * 1024
+DEFAULT_WRITERS = 8
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)
+
+
+class ExtractError(ValueError):
+    pass
+
+
+# Function to find the data extents [(offset, length)] of an open file with holes, or None
+# if it has none (or the platform cannot tell). The file position is reset to 0.
+def data_extents(f, st):
+    if st.st_size < SPARSE_MIN or not hasattr(os, 'SEEK_DATA') or st.st_blocks * 512 >= st.st_size:
+        return None
+    fd = f.fileno()
+    extents = []
+    offset = 0
+    try:
+        while offset < st.st_size:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), st.st_size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno != errno.ENXIO:  # ENXIO: no data after `offset`
+            return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    if extents == [(0, st.st_size)]:
+        return None
+    return extents
+
+
+def format_extents(extents):
+    return ','.join(f"{offset}:{length}" for offset, length in extents)
+
+
+def parse_extents(value):
+    if not value:
+        return []
+    return [tuple(map(int, item.split(':'))) for item in value.split(',')]
+
+
+def is_zeros(data):
+    return not data or (data[0] == 0 and data[-1] == 0 and data.count(0) == len(data))
+
+
+class _OutputFile:
+    def __init__(self, target, fd, size, extents, skip_zeros):
+        self.target = target
+        self.fd = fd
+        self.size = size
+        self.extents = extents
+        self.skip_zeros = skip_zeros
+        self.pending = 0
+        self.closing = False
+        self.finalizing = False
+        self.closed = False
+        self.lock = None if hasattr(os, 'pwrite') else threading.Lock()
+
+
+class RestoreWriter:
+    def __init__(self, restore_location, workers=None, metrics=None):
+        self.root = os.path.abspath(restore_location)
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=workers or DEFAULT_WRITERS, thread_name_prefix='restore')
+        self.condition = threading.Condition()
+        self.pending_bytes = 0
+        self.pending_tasks = 0
+        self.error = None
+        self.open_files = set()
+        self.directories = set()    # created or checked to lie inside the restore location
+        self.metadata = []          # (target, apply) for files, in archive order
+        self.directory_metadata = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        self.executor.shutdown(wait=True)
+
+    # Absolute path of archive member `name`, refusing anything outside the restore location
+    def target(self, name):
+        target = os.path.abspath(os.path.join(self.root, name))
+        if target != self.root and not target.startswith(self.root + os.sep):
+            raise ExtractError(f"Refusing to extract outside the restore location: {name}")
+        return target
+
+    # Create the parent directory of `target`, making sure no symlink leads it out of the restore location
+    def _parent(self, target):
+        parent = os.path.dirname(target)
+        if parent in self.directories:
+            return
+        os.makedirs(parent, exist_ok=True)
+        real = os.path.realpath(parent)
+        if real != os.path.realpath(self.root) and not real.startswith(os.path.realpath(self.root) + os.sep):
+            raise ExtractError(f"Refusing to extract through a link outside the restore location: {target}")
+        self.directories.add(parent)
+
+    def make_directory(self, name, apply=None):
+        target = self.target(name)
+        os.makedirs(target, exist_ok=True)
+        self.directories.add(target)
+        if apply is not None:
+            self.directory_metadata.append((target, apply))
+        return target
+
+    # Create (or truncate) a file of `size` bytes; `extents` lists its data regions if it is sparse
+    def create(self, name, size, extents=None):
+        self._raise_error()
+        target = self.target(name)
+        self._parent(target)
+        if os.path.islink(target):
+            os.remove(target)
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        output = _OutputFile(target, fd, size, extents, skip_zeros=bool(extents))
+        self.open_files.add(output)
+        if size >= PREALLOCATE_MIN and hasattr(os, 'posix_fallocate'):
+            try:
+                for offset, length in (extents or [(0, size)]):
+                    os.posix_fallocate(fd, offset, length)
+                output.skip_zeros = True
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+        return output
+
+    # Queue `data` to be written at `offset` of `output`
+    def write(self, output, offset, data):
+        if output.skip_zeros and is_zeros(data):
+            return
+        if output.extents:
+            end = offset + len(data)
+            for start, length in output.extents:
+                low, high = max(start, offset), min(start + length, end)
+                if low < high:
+                    self._submit(output, low, data[low - offset:high - offset])
+        else:
+            self._submit(output, offset, data)
+
+    def _submit(self, output, offset, data):
+        with self.condition:
+            while self.pending_bytes and self.pending_bytes + len(data) > MAX_PENDING and self.error is None:
+                self.condition.wait()
+            self._raise_error()
+            self.pending_bytes += len(data)
+            self.pending_tasks += 1
+            output.pending += 1
+        self.executor.submit(self._write, output, offset, data)
+
+    def _write(self, output, offset, data):
+        try:
+            if self.error is None:
+                if self.metrics is not None:
+                    with self.metrics.timed('extract'):
+                        self._pwrite(output, data, offset)
+                    self.metrics.add('extract', nbytes=len(data))
+                else:
+                    self._pwrite(output, data, offset)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            with self.condition:
+                self.pending_bytes -= len(data)
+                self.pending_tasks -= 1
+                output.pending -= 1
+                finish = output.closing and not output.pending
+                self.condition.notify_all()
+            if finish:
+                self._finalize(output)
+
+    # Write `data` at `offset` of `output`; where os.pwrite is missing (Windows) the
+    # seek and write are done together under the file's lock
+    @staticmethod
+    def _pwrite(output, data, offset):
+        view = memoryview(data)
+        if output.lock is not None:
+            with output.lock:
+                os.lseek(output.fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(output.fd, view):]
+            return
+        while view:
+            written = os.pwrite(output.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    # No more data for `output`; `apply(target)` sets its metadata in the final batch
+    def close(self, output, apply=None):
+        if apply is not None:
+            self.metadata.append((output.target, apply))
+        with self.condition:
+            output.closing = True
+            finish = not output.pending
+        if finish:
+            self._finalize(output)
+
+    def _finalize(self, output):
+        with self.condition:
+            if output.finalizing:
+                return
+            output.finalizing = True
+        try:
+            if self.error is None:
+                # Trailing holes and skipped zeros still count towards the size
+                os.ftruncate(output.fd, output.size)
+        except OSError as e:
+            self._fail(e)
+        finally:
+            os.close(output.fd)
+            with self.condition:
+                output.closed = True
+                if self.error is None:
+                    self.open_files.discard(output)
+                self.condition.notify_all()
+
+    # Queue metadata for something written outside the writer (a delta, say), after what came before it
+    def defer(self, target, apply):
+        self.metadata.append((target, apply))
+
+    # Wait until everything queued so far is on disk
+    def drain(self):
+        with self.condition:
+            while (self.pending_tasks or any(not output.closed for output in self.open_files if output.closing)) \
+                    and self.error is None:
+                self.condition.wait()
+        self._raise_error()
+
+    # Wait for the data, then apply all metadata
+    def finish(self):
+        self.drain()
+        if self.open_files:
+            raise ExtractError("Files were left open at the end of the restore")
+        # A path restored more than once (a file and its deltas) gets the last metadata
+        latest = {}
+        for target, apply in self.metadata:
+            latest[target] = apply
+        list(self.executor.map(lambda item: item[1](item[0]), latest.items()))
+        for target, apply in sorted(self.directory_metadata, key=lambda item: item[0], reverse=True):
+            apply(target)
+
+    # Stop after a failure or cancel: wait for the writers and remove files that are incomplete
+    def abort(self):
+        with self.condition:
+            if self.error is None:
+                self.error = ExtractError("Restore aborted")
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
+        for output in list(self.open_files):
+            if not output.finalizing:
+                output.finalizing = output.closed = True
+                os.close(output.fd)
+            if os.path.exists(output.target):
+                os.remove(output.target)
+        self.open_files.clear()
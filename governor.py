@@ -0,0 +1,229 @@
+import os
+import time
+import shutil
+import threading
+import subprocess
+
+# Resource governor for backup runs, so a backup on a busy server does not
+# starve the services next to it.
+#
+#   bandwidth  token buckets cap the bytes read from the sources and the
+#              bytes written to the destination (MB/s). Threads borrow
+#              against the bucket and sleep off the debt, so several reader
+#              threads share one limit.
+#   priority   the backup's threads run at a lower CPU priority (nice) and,
+#              on Linux, in the idle or best-effort I/O class (ionice).
+#              Both apply to the calling thread and the threads it starts
+#              afterwards, so a GUI's own thread is not affected.
+#   workers    compression, chunking and scanning pools are capped.
+#   pressure   once per second the 1-minute load average (per CPU) and the
+#              average I/O wait of the disks the backup touches
+#              (/proc/diskstats) are sampled. While either is above its
+#              threshold, every backup thread pauses, for a bit longer each
+#              time (up to MAX_BACKOFF), so the backup yields to the service
+#              but always makes some progress.
+# Time spent waiting is counted per reason as wall time (overlapping waits of
+# several threads count once) and stored with the run's metrics.
+CHECK_INTERVAL = 1.0
+BACKOFF = 0.5
+MAX_BACKOFF = 4.0
+IO_CLASSES = {'idle': '3', 'best-effort': '2'}
+DISKSTATS = '/proc/diskstats'
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = burst or max(self.rate / 4, 256 * 1024)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take `amount` tokens; returns how long the caller has to wait to pay them back
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# Major/minor numbers of the block devices holding `paths`
+def devices_of(paths):
+    devices = set()
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        devices.add((os.major(st.st_dev), os.minor(st.st_dev)))
+    return devices
+
+
+# {(major, minor): (I/Os completed, milliseconds spent on them)} from /proc/diskstats
+def read_diskstats():
+    stats = {}
+    with open(DISKSTATS, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 11:
+                continue
+            ios = int(fields[3]) + int(fields[7])
+            ticks = int(fields[6]) + int(fields[10])
+            stats[(int(fields[0]), int(fields[1]))] = (ios, ticks)
+    return stats
+
+
+class Governor:
+    def __init__(self, read_limit=0, write_limit=0, nice=0, io_class='', max_workers=0, max_load=0.0,
+                 max_disk_await=0.0):
+        self.read_bucket = TokenBucket(read_limit * 1024 * 1024) if read_limit else None
+        self.write_bucket = TokenBucket(write_limit * 1024 * 1024) if write_limit else None
+        self.nice = nice
+        self.io_class = io_class
+        if io_class and io_class not in IO_CLASSES:
+            raise ValueError(f"Unknown I/O class: {io_class} (use {' or '.join(IO_CLASSES)})")
+        self.max_workers = max_workers
+        self.max_load = max_load
+        self.max_disk_await = max_disk_await
+        self.devices = set()
+        self.disk_sample = None
+        self.lock = threading.Lock()
+        self.next_check = 0.0
+        self.paused_until = 0.0
+        self.backoff = BACKOFF
+        self.throttled = {'read': 0.0, 'write': 0.0, 'load': 0.0, 'await': 0.0}
+        self.waiting_until = dict.fromkeys(self.throttled, 0.0)
+        self.applied = []
+
+    @property
+    def workers(self):
+        return self.max_workers or None
+
+    # Lower the priority of the calling thread and the threads it starts from now on
+    def apply_priority(self):
+        if self.nice and hasattr(os, 'nice'):
+            current = os.nice(0)
+            if self.nice > current:
+                os.nice(self.nice - current)
+            self.applied.append(f"nice {max(self.nice, current)}")
+        if self.io_class:
+            ionice = shutil.which('ionice')
+            if ionice is None:
+                self.applied.append("ionice unavailable")
+            else:
+                command = [ionice, '-c', IO_CLASSES[self.io_class], '-p', str(threading.get_native_id())]
+                if self.io_class == 'best-effort':
+                    command[3:3] = ['-n', '7']
+                result = subprocess.run(command, capture_output=True)
+                self.applied.append(f"ionice {self.io_class}" if result.returncode == 0 else "ionice failed")
+
+    # Watch the disks holding `paths` for I/O wait
+    def watch(self, paths):
+        if self.max_disk_await and os.path.exists(DISKSTATS):
+            self.devices |= devices_of(paths)
+
+    def reader(self, fileobj):
+        return GovernedReader(fileobj, self)
+
+    def writer(self, fileobj):
+        return GovernedWriter(fileobj, self)
+
+    def _disk_await(self):
+        sample = read_diskstats()
+        previous, self.disk_sample = self.disk_sample, sample
+        if previous is None:
+            return 0.0
+        worst = 0.0
+        for device in self.devices:
+            if device not in sample or device not in previous:
+                continue
+            ios = sample[device][0] - previous[device][0]
+            if ios > 0:
+                worst = max(worst, (sample[device][1] - previous[device][1]) / ios)
+        return worst
+
+    # Sample system pressure at most once per CHECK_INTERVAL and pause every thread while it is too high
+    def _check_pressure(self):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_check:
+                return
+            reason = None
+            if self.max_load and hasattr(os, 'getloadavg'):
+                if os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load:
+                    reason = 'load'
+            if self.devices and self._disk_await() > self.max_disk_await and reason is None:
+                reason = 'await'
+            if reason is None:
+                self.backoff = BACKOFF
+                self.next_check = now + CHECK_INTERVAL
+                return
+            self.paused_until = now + self.backoff
+            self.next_check = self.paused_until + CHECK_INTERVAL
+            self._account(reason, now, self.paused_until)
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    # Add the part of [start, end) not already counted for `reason`; call with the lock held
+    def _account(self, reason, start, end):
+        self.throttled[reason] += max(0.0, end - max(start, self.waiting_until[reason]))
+        self.waiting_until[reason] = max(self.waiting_until[reason], end)
+
+    # Account for `nbytes` just read or about to be written, sleeping as long as the limits require
+    def pace(self, bucket, kind, nbytes):
+        if self.max_load or self.devices:
+            self._check_pressure()
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if bucket is not None and nbytes:
+            delay = bucket.reserve(nbytes)
+            if delay > 0:
+                now = time.monotonic()
+                with self.lock:
+                    self._account(kind, now, now + delay)
+                time.sleep(delay)
+
+    def summary(self):
+        with self.lock:
+            throttled = {reason: round(seconds, 3) for reason, seconds in self.throttled.items()}
+        return dict(throttled, total=round(sum(throttled.values()), 3), applied=self.applied)
+
+
+class GovernedReader:
+    def __init__(self, fileobj, governor):
+        self.fileobj = fileobj
+        self.governor = governor
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.governor.pace(self.governor.read_bucket, 'read', len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+class GovernedWriter:
+    def __init__(self, fileobj, governor):
+        self.fileobj = fileobj
+        self.governor = governor
+
+    def write(self, data):
+        self.governor.pace(self.governor.write_bucket, 'write', len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+# Function to build the governor configured in user_config.ini, or None when nothing is limited
+def governor_from_config(config, **overrides):
+    settings = {key: config[key] for key in ('read_limit', 'write_limit', 'nice', 'io_class', 'max_workers',
+                                             'max_load', 'max_disk_await')}
+    settings.update((key, value) for key, value in overrides.items() if value is not None)
+    return Governor(**settings) if any(settings.values()) else None
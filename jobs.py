@@ -0,0 +1,149 @@
+import sys
+import queue
+import threading
+import time
+
+from engine import BackupCancelled
+
+# Background jobs for the GUI.
+#
+# A job runs an engine call (run_backup, restore_backup, ...) on a worker
+# thread and passes it a JobProgress. The engine reports every archived or
+# restored entry to it; the progress object turns that into throttled
+# ('progress', snapshot) events on a thread-safe queue, which the Tk side
+# drains with root.after, so no Tk call is ever made off the main thread.
+# Cancelling only sets a flag: the engine sees it at the next entry (or
+# block), raises BackupCancelled and cleans up after itself.
+PROGRESS_INTERVAL = 0.1
+
+
+class JobProgress:
+    def __init__(self, events=None, interval=PROGRESS_INTERVAL):
+        self.events = events
+        self.interval = interval
+        self.cancel_event = threading.Event()
+        self.files = 0
+        self.bytes = 0
+        self.total_files = None
+        self.total_bytes = None
+        self.current = ''
+        self.started = time.monotonic()
+        self.last_report = 0.0
+
+    # Totals are optional; without them the job reports throughput but no ETA
+    def add_totals(self, files=0, total_bytes=0):
+        self.total_files = (self.total_files or 0) + files
+        self.total_bytes = (self.total_bytes or 0) + total_bytes
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise BackupCancelled("Cancelled by user")
+
+    def advance(self, path, size=0):
+        self.check()
+        self.files += 1
+        self.bytes += size
+        self.current = path
+        now = time.monotonic()
+        if self.events is not None and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.events.put(('progress', self.snapshot()))
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        bytes_per_second = self.bytes / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total_bytes and bytes_per_second > 0:
+            eta = max(self.total_bytes - self.bytes, 0) / bytes_per_second
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'total_files': self.total_files,
+            'total_bytes': self.total_bytes,
+            'current': self.current,
+            'elapsed': elapsed,
+            'mb_per_second': bytes_per_second / (1024 * 1024),
+            'files_per_second': self.files / elapsed if elapsed > 0 else 0.0,
+            'eta': eta,
+        }
+
+
+# Progress for command line runs: one status line, rewritten in place on stderr
+class ConsoleProgress(JobProgress):
+    def __init__(self, stream=None, interval=1.0):
+        super().__init__(interval=interval)
+        self.stream = stream if stream is not None else sys.stderr
+        self.shown = False
+
+    def advance(self, path, size=0):
+        super().advance(path, size)
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.show()
+
+    def show(self):
+        snapshot = self.snapshot()
+        self.stream.write(f"\r{format_progress(snapshot)}\033[K")
+        self.stream.flush()
+        self.shown = True
+
+    def done(self):
+        if self.shown:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+
+
+def format_progress(snapshot):
+    return (f"{snapshot['files']} files, {snapshot['bytes'] / (1024 * 1024):.1f} MiB  |  "
+            f"{snapshot['mb_per_second']:.1f} MB/s, {snapshot['files_per_second']:.0f} files/s  |  "
+            f"ETA {format_eta(snapshot['eta'])}")
+
+
+# One engine call on a daemon thread; `target` must accept a `progress` keyword
+class BackgroundJob:
+    def __init__(self, name, target, *args, **kwargs):
+        self.name = name
+        self.events = queue.Queue()
+        self.progress = JobProgress(self.events)
+        self.thread = threading.Thread(target=self._run, args=(target, args, kwargs), name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.progress.cancel()
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+    def _run(self, target, args, kwargs):
+        try:
+            result = target(*args, progress=self.progress, **kwargs)
+        except BackupCancelled:
+            self.events.put(('cancelled', self.progress.snapshot()))
+        except Exception as e:
+            self.events.put(('failed', str(e)))
+        else:
+            self.events.put(('done', result))
+
+    # Return every event queued since the last call, without blocking
+    def poll(self):
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
@@ -0,0 +1,463 @@
+import os
+import sys
+import stat
+import time
+import uuid
+import errno
+import ctypes
+import select
+import struct
+import sqlite3
+from collections import namedtuple
+
+from scanner import ScannedFile, ScanStats, scan_tree
+
+# Change journal kept by a watcher daemon, so incremental backups look only at
+# what changed instead of walking the whole tree.
+#
+# `backup.py watch` puts an inotify watch on every directory of the source
+# directories and records each created, modified, deleted or renamed path in
+# an SQLite journal, at most once per second and once per path. A directory
+# that appears (created or moved in) is recorded as a subtree, so the backup
+# walks just that subtree; everything else is a single path the backup
+# lstat()s and compares with the manifest.
+#
+# The journal is only trusted when it provably saw everything since the last
+# backup of a source:
+#   - every watcher start, queue overflow and unmount opens a new session,
+#     and a journal position from an older session is never used;
+#   - every backup waits until the watcher has written a heartbeat taken
+#     after the backup started (so every event from before the start is in
+#     the journal), and records that position as its checkpoint once the
+#     manifest is updated;
+#   - the next incremental uses the journal only if its checkpoint belongs to
+#     the running session, and reads every path recorded after it.
+# In every other case (watcher down or restarted, events lost, source never
+# backed up while watched) the backup walks the full tree, which also makes
+# the next run able to use the journal again.
+#
+# inotify does not see writes through shared memory maps or changes made by
+# other machines on network file systems; use `--full-scan` for such trees.
+# Next to the other state files (engine.APP_DIR), whatever directory a run starts in
+JOURNAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'change_journal.db')
+FLUSH_INTERVAL = 1.0        # seconds between journal writes (and heartbeats)
+SYNC_TIMEOUT = 5.0          # how long a backup waits for the watcher to catch up
+STALE_AFTER = 30.0          # a heartbeat older than this means the watcher is down
+READ_SIZE = 64 * 1024
+MAX_READS = 256             # inotify reads per flush while events keep coming
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY,
+    session TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    pid INTEGER,
+    heartbeat REAL,
+    seq INTEGER NOT NULL DEFAULT 0,
+    checkpoint_session TEXT,
+    checkpoint_seq INTEGER
+);
+CREATE TABLE IF NOT EXISTS changes (
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    tree INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (source, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS changes_seq ON changes (source, seq);
+"""
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_UNMOUNT = 0x2000
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT = struct.Struct('iIII')
+
+JournalPosition = namedtuple('JournalPosition', ['session', 'seq'])
+# Paths that changed in a source since its last backup; for every path in
+# `trees` the whole subtree below it is rescanned
+JournalChanges = namedtuple('JournalChanges', ['paths', 'trees'])
+
+
+class JournalError(OSError):
+    pass
+
+
+# inotify is reached through libc and only exists on Linux
+def load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _child(parent, name):
+    return f"{parent}/{name}" if parent else name
+
+
+# Function to check whether `path` lies below one of `trees`
+def in_tree(path, trees):
+    parts = path.split('/')
+    return any('/'.join(parts[:depth]) in trees for depth in range(1, len(parts)))
+
+
+class ChangeJournal:
+    def __init__(self, path=JOURNAL_FILE):
+        # The watcher and backups use the journal at the same time
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # A power loss also stops the watcher, whose restart opens a new session,
+        # so losing the last writes can never hide a change
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.fallbacks = {}     # source -> why its changes must be found by a full scan
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Wait until the watcher has recorded every change made before this call, and
+    # return {source: JournalPosition} for each of `sources` it watches
+    def sync(self, sources, timeout=SYNC_TIMEOUT):
+        requested = time.time()
+        deadline = time.monotonic() + timeout
+        while True:
+            positions = {}
+            waiting = []
+            rows = {row[0]: row[1:] for row in self.conn.execute(
+                "SELECT source, session, status, error, heartbeat, seq FROM sources")}
+            for source in sources:
+                session, status, error, heartbeat, seq = rows.get(source, (None, None, None, None, None))
+                if session is None:
+                    self.fallbacks[source] = "not watched"
+                elif status != 'watching':
+                    self.fallbacks[source] = error or f"watcher {status}"
+                elif heartbeat >= requested:
+                    positions[source] = JournalPosition(session, seq)
+                    self.fallbacks.pop(source, None)
+                elif requested - heartbeat > STALE_AFTER:
+                    self.fallbacks[source] = "watcher not running"
+                else:
+                    waiting.append(source)
+            if not waiting:
+                return positions
+            if time.monotonic() >= deadline:
+                self.fallbacks.update((source, "watcher did not catch up") for source in waiting)
+                return positions
+            time.sleep(0.1)
+
+    # What changed in `source` since its last backup, or None if the journal
+    # does not cover all of that time (see self.fallbacks for why)
+    def changes_since(self, source, position):
+        if position is None:
+            return None
+        row = self.conn.execute("SELECT checkpoint_session, checkpoint_seq FROM sources WHERE source = ?",
+                                (source,)).fetchone()
+        if row is None or row[0] != position.session:
+            self.fallbacks[source] = "no backup since the watcher started"
+            return None
+        paths, trees = set(), set()
+        for path, tree in self.conn.execute(
+                "SELECT path, tree FROM changes WHERE source = ? AND seq > ?", (source, row[1])):
+            (trees if tree else paths).add(path)
+        # A new session clears the changes, so they are complete only if the session did not change meanwhile
+        session = self.conn.execute("SELECT session FROM sources WHERE source = ?", (source,)).fetchone()[0]
+        if session != position.session:
+            self.fallbacks[source] = "watcher restarted during the backup"
+            return None
+        # A subtree inside another one is rescanned with it
+        trees = {tree for tree in trees if not in_tree(tree, trees)}
+        return JournalChanges({path for path in paths if not in_tree(path, trees)}, trees)
+
+    # Record that the manifest reflects every change up to `position`
+    def checkpoint(self, source, position):
+        with self.conn:
+            self.conn.execute("UPDATE sources SET checkpoint_session = ?, checkpoint_seq = ? WHERE source = ?",
+                              (position.session, position.seq, source))
+            self.conn.execute("DELETE FROM changes WHERE source = ? AND seq <= ?", (source, position.seq))
+
+    # Start a new session for `source`; positions from earlier sessions are no longer trusted
+    def start_session(self, source):
+        row = self.conn.execute("SELECT status, pid, heartbeat FROM sources WHERE source = ?", (source,)).fetchone()
+        if row is not None and row[0] in ('starting', 'watching') and row[1] != os.getpid() and row[2] \
+                and time.time() - row[2] < STALE_AFTER and _process_alive(row[1]):
+            raise JournalError(f"{source} is already watched by process {row[1]}")
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO sources (source, session, status, pid, heartbeat) VALUES (?, ?, 'starting', ?, ?) "
+                "ON CONFLICT (source) DO UPDATE SET session = excluded.session, status = excluded.status, "
+                "error = NULL, pid = excluded.pid, heartbeat = excluded.heartbeat",
+                (source, uuid.uuid4().hex, os.getpid(), time.time()))
+            self.conn.execute("DELETE FROM changes WHERE source = ?", (source,))
+
+    def set_status(self, sources, status, error=None):
+        with self.conn:
+            self.conn.executemany("UPDATE sources SET status = ?, error = ? WHERE source = ? AND pid = ?",
+                                  ((status, error, source, os.getpid()) for source in sources))
+
+    # Mark the sources of this process that are still being watched as stopped
+    def stop(self):
+        with self.conn:
+            self.conn.execute("UPDATE sources SET status = 'stopped' WHERE pid = ? AND status IN ('starting', 'watching')",
+                              (os.getpid(),))
+
+    # Write a batch of {(source, path): whole subtree?} and, if given, the heartbeat
+    # time before which every event has been read
+    def record(self, changes, heartbeat=None):
+        with self.conn:
+            seqs = {}
+            for source in {source for source, _ in changes}:
+                self.conn.execute("UPDATE sources SET seq = seq + 1 WHERE source = ?", (source,))
+                seqs[source] = self.conn.execute("SELECT seq FROM sources WHERE source = ?", (source,)).fetchone()[0]
+            self.conn.executemany(
+                "INSERT INTO changes (source, path, tree, seq) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (source, path) DO UPDATE SET tree = MAX(tree, excluded.tree), seq = excluded.seq",
+                ((source, path, tree, seqs[source]) for (source, path), tree in changes.items()))
+            if heartbeat is not None:
+                self.conn.execute("UPDATE sources SET heartbeat = ? WHERE pid = ? AND status = 'watching'",
+                                  (heartbeat, os.getpid()))
+
+    def status(self):
+        rows = self.conn.execute(
+            "SELECT s.source, s.status, s.error, s.heartbeat, s.session = s.checkpoint_session, "
+            "(SELECT COUNT(*) FROM changes c WHERE c.source = s.source AND c.seq > COALESCE(s.checkpoint_seq, -1)) "
+            "FROM sources s ORDER BY s.source")
+        return [{'source': source, 'status': status, 'error': error, 'heartbeat': heartbeat,
+                 'usable': bool(usable), 'pending': pending}
+                for source, status, error, heartbeat, usable, pending in rows]
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Function to open the change journal if a watcher ever ran, else None
+def open_journal(path=JOURNAL_FILE):
+    return ChangeJournal(path) if os.path.exists(path) else None
+
+
+# Function to yield a ScannedFile for every file among `changes` (a JournalChanges)
+# that still exists, walking the changed subtrees with the parallel scanner. As with
+# scan_tree, what cannot be read is added to `stats.unreadable` rather than left to look deleted.
+def scan_changes(source, changes, workers=None, stats=None):
+    stats = stats if stats is not None else ScanStats()
+    if not os.path.isdir(source):
+        raise JournalError(f"Source directory does not exist: {source}")
+    for path in sorted(changes.paths):
+        started = time.perf_counter()
+        try:
+            st = os.lstat(os.path.join(source, path))
+        except OSError as e:
+            st = None   # Deleted; the manifest diff notices the missing file
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                stats.unreadable.append(os.path.join(source, path))
+        stats.stat_calls += 1
+        stats.elapsed += time.perf_counter() - started
+        if st is not None and not stat.S_ISDIR(st.st_mode):
+            stats.files += 1
+            stats.bytes += st.st_size
+            yield ScannedFile(path, os.path.join(source, path), st)
+    for tree in sorted(changes.trees):
+        abs_path = os.path.join(source, tree)
+        try:
+            st = os.lstat(abs_path)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                stats.unreadable.append(abs_path)
+            continue
+        stats.stat_calls += 1
+        if not stat.S_ISDIR(st.st_mode):
+            # Replaced by a file since
+            yield ScannedFile(tree, abs_path, st)
+            continue
+        try:
+            for scanned in scan_tree(abs_path, workers=workers, stats=stats):
+                yield scanned._replace(path=f"{tree}/{scanned.path}")
+        except OSError:
+            stats.unreadable.append(abs_path)  # The subtree itself could not be listed
+
+
+# Watcher daemon keeping the change journal of `sources` (see `backup.py watch`)
+class ChangeWatcher:
+    def __init__(self, sources, path=JOURNAL_FILE):
+        self.libc = load_inotify()
+        if self.libc is None:
+            raise JournalError("The change journal needs Linux inotify")
+        self.sources = sorted({os.path.abspath(source) for source in sources})
+        for source in self.sources:
+            if not os.path.isdir(source):
+                raise JournalError(f"Source directory does not exist: {source}")
+            if in_tree(source, set(self.sources)):
+                raise JournalError(f"Nested source directories cannot be watched: {source}")
+        self.path = path
+        self.journal = None
+        self.fd = -1
+        self.watches = {}       # watch descriptor -> (source, directory path relative to it)
+        self.pending = {}       # (source, path) -> 1 if the whole subtree changed, else 0
+        self.restart = set()    # sources whose watches must be rebuilt in a new session
+        self.lost = set()       # sources whose directory was moved or deleted
+
+    def _add_watch(self, source, directory):
+        abs_path = os.path.join(source, directory)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(abs_path), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = (source, directory)
+            return
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+            raise JournalError("Out of inotify watches; raise the fs.inotify.max_user_watches sysctl")
+        if error not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+            raise OSError(error, os.strerror(error), abs_path)
+        # Vanished or unreadable: its parent's events or the scanner's errors cover it
+
+    # Watch `directory` and every directory below it, each before it is listed, so
+    # nothing created during the walk is missed
+    def _watch_tree(self, source, directory):
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            self._add_watch(source, directory)
+            try:
+                with os.scandir(os.path.join(source, directory)) as entries:
+                    stack += [_child(directory, entry.name) for entry in entries if entry.is_dir(follow_symlinks=False)]
+            except OSError:
+                continue
+
+    def _unwatch_tree(self, source, directory):
+        prefix = directory + '/'
+        for wd, (watched_source, watched) in list(self.watches.items()):
+            if watched_source == source and (watched == directory or watched.startswith(prefix)):
+                del self.watches[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _start(self, source):
+        self.journal.start_session(source)
+        self._watch_tree(source, '')
+        self.journal.set_status([source], 'watching')
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped; nothing recorded before can be trusted
+            self.restart.update(self.sources)
+            return
+        watch = self.watches.get(wd)
+        if watch is None:
+            return
+        source, directory = watch
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            if not directory:
+                self.lost.add(source)
+            return
+        if mask & IN_UNMOUNT:
+            self.restart.add(source)
+            return
+        if not name:
+            # The directory itself changed; its parent reports that too
+            if not directory and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.lost.add(source)
+            return
+        path = _child(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(source, path)
+            elif mask & IN_MOVED_FROM:
+                self._unwatch_tree(source, path)
+            elif not mask & IN_DELETE:
+                return
+            self.pending[(source, path)] = 1
+        elif (source, path) not in self.pending:
+            self.pending[(source, path)] = 0
+
+    # Read every queued event; returns False if events kept coming after MAX_READS reads
+    def _drain(self):
+        for _ in range(MAX_READS):
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return True
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                self._handle(wd, mask, os.fsdecode(name))
+        return False
+
+    def _flush(self, heartbeat):
+        for source in self.lost - self.restart:
+            if os.path.isdir(source):
+                self.restart.add(source)
+            else:
+                self._unwatch_tree(source, '')
+                self.journal.set_status([source], 'failed', "source directory was moved or deleted")
+        for source in self.restart:
+            self.pending = {key: tree for key, tree in self.pending.items() if key[0] != source}
+            self._unwatch_tree(source, '')
+            self._start(source)
+        self.lost.clear()
+        self.restart.clear()
+        if self.pending or heartbeat is not None:
+            self.journal.record(self.pending, heartbeat)
+            self.pending = {}
+
+    # Watch until `stop` (a threading.Event) is set or the process is interrupted
+    def run(self, stop=None, on_ready=None):
+        self.journal = ChangeJournal(self.path)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            self.journal.close()
+            raise OSError(error, os.strerror(error))
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        try:
+            for source in self.sources:
+                self._start(source)
+            if on_ready is not None:
+                on_ready(len(self.watches))
+            while stop is None or not stop.is_set():
+                poller.poll(FLUSH_INTERVAL * 1000)
+                # Every event from before this moment is read by the drain below
+                now = time.time()
+                self._flush(now if self._drain() else None)
+        except JournalError as e:
+            self.journal.set_status(self.sources, 'failed', str(e))
+            raise
+        finally:
+            self.journal.stop()
+            os.close(self.fd)
+            self.journal.close()
@@ -1,28 +1,26 @@
 import os
-import tarfile
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from datetime import datetime, timedelta
-import csv
-import json
+from tkinter import filedialog, messagebox, ttk, simpledialog
+from datetime import datetime
 import configparser
-import time
-from tkinter import simpledialog
-import matplotlib.pyplot as plt
-import platform
 import subprocess
-from cryptography.fernet import Fernet
-import hashlib
-import base64
-from PIL import Image, ImageTk
 import ttkbootstrap as tb
+import engine
+from engine import BackupError, CONFIG_FILE
+from compression import CODECS, DEFAULT_LEVELS
+from jobs import BackgroundJob, format_progress
+from metrics import STAGE_ORDER
+from governor import governor_from_config
+from scheduler import Scheduler, job_name, load_jobs, save_job, remove_job, install_trigger, remove_trigger
 
 # Constants
-STATS_FILE = 'backup_stats.csv'
-CONFIG_FILE = 'user_config.ini'
+CLI_SCRIPT = os.path.join(engine.APP_DIR, 'backup.py')
+RESTORE_PAGE_SIZE = 200
+STATISTICS_LIMIT = 1000
+JOB_POLL_INTERVAL = 100  # ms between checks of a running job's progress queue
 
-def password_to_key(password):
-    return base64.urlsafe_b64encode(hashlib.sha256(password.encode()).digest())
+# The backup or restore currently running in the background, if any
+current_job = None
 
 
 # Splash screen display
@@ -44,6 +42,8 @@ def init_main_window(root):
     frame = tb.Frame(root, padding="10 10 10 10")
     frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
     
+    from PIL import Image, ImageTk
+
     logo_img = Image.open("assets/logo.png")
     logo_img = logo_img.resize((50, 50), Image.LANCZOS)
     logo = ImageTk.PhotoImage(logo_img)
@@ -63,167 +63,190 @@ def init_main_window(root):
     tb.Label(frame, text="Backup Frequency:").grid(row=3, column=0, sticky='w')
     frequency_options = tb.Combobox(frame, textvariable=backup_frequency, values=["Daily", "Weekly", "Monthly"], bootstyle="info")
     frequency_options.grid(row=3, column=1)
+    tb.Combobox(frame, textvariable=archive_format, values=list(engine.ARCHIVE_FORMATS), width=10, bootstyle="info").grid(row=3, column=2)
 
-    tb.Checkbutton(frame, text="Enable Encryption", variable=encryption_enabled, bootstyle="success-round-toggle").grid(row=4, columnspan=3, sticky='w')
+    tb.Checkbutton(frame, text="Enable Encryption", variable=encryption_enabled, bootstyle="success-round-toggle").grid(row=4, columnspan=2, sticky='w')
+    tb.Checkbutton(frame, text="Detect Changes by Content Hash", variable=content_hashing, bootstyle="success-round-toggle").grid(row=4, column=2, sticky='w')
 
     tb.Label(frame, text="Password for Encryption:").grid(row=5, column=0, sticky='w')
     global password_entry
     password_entry = tb.Entry(frame, show='*')
     password_entry.grid(row=5, column=1)
 
+    tb.Label(frame, text="Compression (codec / level):").grid(row=6, column=0, sticky='w')
+    tb.Combobox(frame, textvariable=compression_codec, values=list(CODECS), bootstyle="info").grid(row=6, column=1)
+    tb.Spinbox(frame, textvariable=compression_level, from_=0, to=22, width=5).grid(row=6, column=2)
+    tb.Checkbutton(frame, text="Skip Already-Compressed Files", variable=adaptive_compression, bootstyle="success-round-toggle").grid(row=5, column=2, sticky='w')
+
     full_backup_icon = Image.open("assets/backup_icon.png")
     full_backup_icon = full_backup_icon.resize((20, 20), Image.LANCZOS)
     full_backup_image = ImageTk.PhotoImage(full_backup_icon)
     
-    tb.Button(frame, text="Run Full Backup", image=full_backup_image, compound="left", command=run_full_backup, bootstyle="success").grid(row=6, column=0, pady=5)
-    tb.Button(frame, text="Run Incremental Backup", command=run_incremental_backup, bootstyle="info").grid(row=6, column=1, pady=5)
-    tb.Button(frame, text="Show Backup Statistics", command=show_backup_statistics, bootstyle="warning").grid(row=6, column=2, pady=5)
-    tb.Button(frame, text="Restore Backup", command=show_restore_window, bootstyle="danger").grid(row=7, column=0, pady=5)
-    tb.Button(frame, text="Save Preferences", command=save_user_preferences, bootstyle="primary").grid(row=7, column=1, pady=5)
-    tb.Button(frame, text="Preview Backup Schedule", command=show_backup_preview, bootstyle="info").grid(row=7, column=2, pady=5)
+    tb.Button(frame, text="Run Full Backup", image=full_backup_image, compound="left", command=run_full_backup, bootstyle="success").grid(row=7, column=0, pady=5)
+    tb.Button(frame, text="Run Incremental Backup", command=run_incremental_backup, bootstyle="info").grid(row=7, column=1, pady=5)
+    tb.Button(frame, text="Show Backup Statistics", command=show_backup_statistics, bootstyle="warning").grid(row=7, column=2, pady=5)
+    tb.Button(frame, text="Restore Backup", command=show_restore_window, bootstyle="danger").grid(row=8, column=0, pady=5)
+    tb.Button(frame, text="Save Preferences", command=save_user_preferences, bootstyle="primary").grid(row=8, column=1, pady=5)
+    tb.Button(frame, text="Preview Backup Schedule", command=show_backup_preview, bootstyle="info").grid(row=8, column=2, pady=5)
     
     # tb.Button(frame, text="List Backup Versions", command=list_backup_versions_ui, bootstyle="info").grid(row=7, column=3, pady=5)
     # tb.Button(frame, text="Restore by Version", command=restore_by_version_ui, bootstyle="danger").grid(row=8, column=3, pady=5)
-    # tb.Button(frame, text="Restore by Date", command=restore_by_date_ui, bootstyle="danger").grid(row=9, column=3, pady=5)
+    tb.Button(frame, text="Restore by Date", command=restore_by_date_ui, bootstyle="danger").grid(row=9, column=0, pady=5)
 
 
     logo_label_bottom = tk.Label(frame, image=logo)
     logo_label_bottom.image = logo
-    logo_label_bottom.grid(row=8, column=0, columnspan=3)
-
-def record_backup_metadata(backup_file, backup_type, size, backup_location, backup_folder, encrypted=False):
-    metadata_file = 'backup_metadata.json'
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    if encrypted:
-        backup_file += ".enc"
-    
-    metadata = {
-        'timestamp': timestamp,
-        'backup_file': backup_file,
-        'backup_type': backup_type,
-        'size': size,
-        'backup_location': backup_location,
-        'backup_folder': backup_folder
-    }
-
-    # Check if metadata file exists
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as f:
-            all_metadata = json.load(f)
-    else:
-        all_metadata = []
-
-    all_metadata.append(metadata)
-
-    with open(metadata_file, 'w') as f:
-        json.dump(all_metadata, f, indent=4)
-
-def load_backup_metadata():
-    metadata_file = 'backup_metadata.json'
-    
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as f:
-            return json.load(f)
-    else:
-        return []
-
-def list_backup_versions():
-    metadata = load_backup_metadata()
-    
-    version_list = []
-    for i, entry in enumerate(metadata):
-        version_list.append(f"{i+1}. {entry['timestamp']} - {entry['backup_type']} - Size: {entry['size']} bytes")
-    
-    return version_list
+    logo_label_bottom.grid(row=10, column=0, columnspan=3)
 
+# Restore window: a Treeview that fetches catalog pages only as they are scrolled into view
 def show_restore_window():
-    backups = load_backup_metadata()
+    first_page = engine.list_backups(limit=RESTORE_PAGE_SIZE)
     
-    if not backups:
+    if not first_page:
         messagebox.showinfo("No Backups", "No backup versions found.")
         return
     
     restore_window = tk.Toplevel()
     restore_window.title("Restore Backups")
-    
-    for i, backup in enumerate(backups):
-        backup_info = f"{i+1}. {backup['timestamp']} - {backup['backup_type']} - Size: {backup['size']} bytes"
-        backup_label = tk.Label(restore_window, text=backup_info)
-        backup_label.grid(row=i, column=0, sticky='w')
-        
-        restore_button = tk.Button(restore_window, text="Restore", command=lambda i=i: prompt_restore_path(i))
-        restore_button.grid(row=i, column=1)
-        
-        delete_button = tk.Button(restore_window, text="Delete", command=lambda i=i: delete_backup(i))
-        delete_button.grid(row=i, column=2)
-
-def prompt_restore_path(version_number):
+
+    columns = ("timestamp", "type", "size", "status")
+    tree = ttk.Treeview(restore_window, columns=columns, show="headings", height=20)
+    for column, heading, width in zip(columns, ("Date", "Type", "Size (bytes)", "Status"), (160, 100, 120, 80)):
+        tree.heading(column, text=heading)
+        tree.column(column, width=width)
+    tree.grid(row=0, column=0, columnspan=2, sticky='nsew')
+
+    scrollbar = ttk.Scrollbar(restore_window, orient="vertical", command=tree.yview)
+    scrollbar.grid(row=0, column=2, sticky='ns')
+
+    pages = {'last': None, 'done': False}
+
+    def append_page(page):
+        for backup in page:
+            tree.insert("", "end", iid=str(backup['id']),
+                        values=(backup['timestamp'], backup['backup_type'], backup['size'], backup['status']))
+        if page:
+            pages['last'] = page[-1]
+        pages['done'] = len(page) < RESTORE_PAGE_SIZE
+
+    def on_scroll(first, last):
+        scrollbar.set(first, last)
+        # Fetch the next page once the view gets close to the end of what is loaded
+        if float(last) > 0.9 and not pages['done']:
+            append_page(engine.list_backups(limit=RESTORE_PAGE_SIZE, after=pages['last']))
+
+    def selected_backup_id():
+        selection = tree.selection()
+        if not selection:
+            messagebox.showerror("Error", "Please select a backup first.")
+            return None
+        return int(selection[0])
+
+    def restore_selected():
+        backup_id = selected_backup_id()
+        if backup_id is not None:
+            prompt_restore_path(backup_id)
+
+    def delete_selected():
+        backup_id = selected_backup_id()
+        if backup_id is None:
+            return
+
+        def on_deleted(merged):
+            tree.delete(str(backup_id))
+            # The backup that absorbed the deleted one may have become a synthetic full
+            if merged and tree.exists(str(merged['id'])):
+                tree.item(str(merged['id']), values=(merged['timestamp'], merged['backup_type'], merged['size'],
+                                                     merged['status']))
+
+        delete_backup(backup_id, on_deleted)
+
+    def verify_selected():
+        backup_id = selected_backup_id()
+        if backup_id is not None:
+            verify_backup(backup_id)
+
+    tree.configure(yscrollcommand=on_scroll)
+    append_page(first_page)
+
+    tk.Label(restore_window, text="Only restore path (optional):").grid(row=1, column=0, sticky='w')
+    tk.Entry(restore_window, textvariable=restore_path, width=40).grid(row=1, column=1, sticky='w')
+    tk.Button(restore_window, text="Restore", command=restore_selected).grid(row=2, column=0)
+    tk.Button(restore_window, text="Delete", command=delete_selected).grid(row=2, column=1)
+    tk.Button(restore_window, text="Verify", command=verify_selected).grid(row=3, column=0)
+    restore_window.rowconfigure(0, weight=1)
+    restore_window.columnconfigure(0, weight=1)
+
+def prompt_restore_path(backup_id):
     restore_location = filedialog.askdirectory(title="Select Restore Location")
     if restore_location:
-        restore_backup_by_version(version_number, restore_location)
+        restore_backup_by_version(backup_id, restore_location)
     
-def restore_backup_by_version(version_number, restore_location):
-    metadata = load_backup_metadata()
-    if 0 <= version_number < len(metadata):
-        backup_file = metadata[version_number]['backup_file']
-        backup_location = metadata[version_number]['backup_location']
-        backup_path = os.path.join(backup_location, backup_file)
-        if not os.path.exists(backup_path) and backup_path.endswith(".enc"):
-            backup_path = backup_path.replace(".enc", "")
-        restore_backup(backup_path, restore_location)  # Call the restore_backup function that takes two arguments
-    else:
-        messagebox.showerror("Error", "Invalid version number selected.")
-
-def restore_backup(backup_file, restore_location):
+def restore_backup_by_version(backup_id, restore_location):
     try:
-        # Debug statement to check the file path
-        print(f"Attempting to restore backup from: {backup_file}")
-
-        # If it's an encrypted file, decrypt it first
-        if backup_file.endswith(".enc"):
-            decrypted_backup_file = decrypt_backup_file(backup_file)
-            if not decrypted_backup_file:  # Decryption failed, stop the restore process
-                return
-            backup_file = decrypted_backup_file  # Use decrypted file path for extraction
-
-        # Debug statement to check if the file exists
-        if not os.path.exists(backup_file):
-            print(f"Backup file does not exist: {backup_file}")
-            messagebox.showerror("Restore Failed", f"Backup file does not exist: {backup_file}")
+        backup = engine.get_backup(backup_id)
+    except BackupError as e:
+        messagebox.showerror("Error", str(e))
+        return
+    paths = [restore_path.get().strip()] if restore_path.get().strip() else None
+    # Files stored as deltas are rebuilt from the backups before this one
+    start_job("Restore", engine.restore_backup_by_version,
+              lambda result: messagebox.showinfo("Restore Completed", f"Backup restored to {restore_location}"),
+              backup['id'], restore_location, password_entry.get(), paths,
+              metrics_export=engine.load_config()['metrics_export'])
+
+# Function to restore the state of the selected source directories as of a chosen date
+def restore_by_date_ui():
+    from point_in_time import restore_to_time
+
+    timestamp = simpledialog.askstring("Restore by Date", "Restore the state as of (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS):")
+    if not timestamp:
+        return
+    restore_location = filedialog.askdirectory(title="Select Restore Location")
+    if not restore_location:
+        return
+    source_dirs = engine.split_source_dirs(selected_dirs.get()) or None
+    start_job("Restore", restore_to_time,
+              lambda chain: messagebox.showinfo("Restore Completed", f"State of {timestamp} restored from {len(chain)} backup(s) to {restore_location}"),
+              timestamp, restore_location, password_entry.get(), source_dirs=source_dirs)
+
+# Function to delete a backup; one that a later incremental depends on is merged into it instead
+def delete_backup(backup_id, on_deleted):
+    from retention import chain_successor
+
+    try:
+        entry = engine.get_backup(backup_id)
+    except BackupError as e:
+        messagebox.showerror("Error", str(e))
+        return
+    if entry['status'] == 'success' and chain_successor(entry) is not None:
+        if not messagebox.askyesno("Merge Backup", "The next incremental backup depends on this one. It will be "
+                                   "merged into that backup so later versions stay restorable. Continue?"):
             return
 
-        # Extract the backup file
-        with tarfile.open(backup_file, "r:gz") as tar:
-            tar.extractall(path=restore_location)
-
-        messagebox.showinfo("Restore Completed", f"Backup restored to {restore_location}")
-
-    except Exception as e:
-        messagebox.showerror("Restore Failed", f"Error: {str(e)}")
-        
-def delete_backup(version_number):
-    metadata = load_backup_metadata()
-    if 0 <= version_number < len(metadata):
-        backup_file = metadata[version_number]['backup_file']
-        backup_location = metadata[version_number]['backup_location']
-        backup_path = os.path.join(backup_location, backup_file)
-        
-        # Check for both encrypted and decrypted file paths
-        if os.path.exists(backup_path):
-            os.remove(backup_path)
-        elif backup_path.endswith(".enc") and os.path.exists(backup_path.replace(".enc", "")):
-            os.remove(backup_path.replace(".enc", ""))
+    def on_done(merged):
+        if merged:
+            messagebox.showinfo("Backup Deleted", f"Backup has been merged into {merged['backup_file']}.")
         else:
-            messagebox.showerror("Error", f"Backup file does not exist: {backup_path}")
-            return
-        
-        del metadata[version_number]
-        with open('backup_metadata.json', 'w') as f:
-            json.dump(metadata, f, indent=4)
-        messagebox.showinfo("Backup Deleted", "Backup has been deleted.")
-    else:
-        messagebox.showerror("Error", "Invalid version number selected.")
+            messagebox.showinfo("Backup Deleted", "Backup has been deleted.")
+        on_deleted(merged)
+
+    start_job("Delete", engine.delete_backup, on_done, backup_id, password_entry.get())
+
+# Function to check that a backup is intact without restoring it (see verify.py)
+def verify_backup(backup_id):
+    from verify import verify
+
+    def on_done(results):
+        result = results[0]
+        if result['status'] == 'ok':
+            messagebox.showinfo("Backup Verified", f"{result['backup_file']} is intact "
+                                f"({result['level']} check, {result['files']} files, {result['bytes']} bytes read).")
+        else:
+            messagebox.showerror("Verification Failed", f"{result['backup_file']}: {result['status']}\n" +
+                                 "\n".join(result['errors'][:10]))
+
+    start_job("Verify", verify, on_done, [backup_id], password_entry.get(), deep=True)
 
 # Function to load user preferences from a config file
 def load_user_preferences():
@@ -235,85 +258,66 @@ def load_user_preferences():
             backup_location.set(config['Preferences'].get('backup_dir', ''))
             backup_frequency.set(config['Preferences'].get('frequency', ''))
             encryption_enabled.set(config['Preferences'].getboolean('encryption_enabled', False))
+            content_hashing.set(config['Preferences'].getboolean('content_hash', False))
+            compression_codec.set(config['Preferences'].get('compression', 'gzip'))
+            compression_level.set(config['Preferences'].get('compression_level', str(DEFAULT_LEVELS['gzip'])))
+            archive_format.set(config['Preferences'].get('archive_format', 'tar'))
+            adaptive_compression.set(config['Preferences'].getboolean('adaptive_compression', True))
 
 # Function to save user preferences to a config file
 def save_user_preferences():
     config = configparser.ConfigParser()
-    config['Preferences'] = {
+    # Keep settings that have no widget (e.g. metrics_export) when rewriting the file
+    config.read(CONFIG_FILE)
+    config.read_dict({'Preferences': {
         'source_dirs': selected_dirs.get(),
         'backup_dir': backup_location.get(),
         'frequency': backup_frequency.get(),
-        'encryption_enabled': encryption_enabled.get()
-    
-    }
+        'encryption_enabled': encryption_enabled.get(),
+        'content_hash': content_hashing.get(),
+        'compression': compression_codec.get(),
+        'compression_level': compression_level.get(),
+        'archive_format': archive_format.get(),
+        'adaptive_compression': adaptive_compression.get()
+    }})
     with open(CONFIG_FILE, 'w') as configfile:
         config.write(configfile)
     messagebox.showinfo("Preferences Saved", "Your preferences have been saved.")
 
+# Function to show every scheduled job with its next run; the selected directories' job can be cancelled
 def show_backup_preview():
-    frequency = backup_frequency.get()
-    frequency_map = {
-        "Daily": timedelta(days=1),
-        "Weekly": timedelta(weeks=1),
-        "Monthly": timedelta(weeks=4)
-    }
-
-    if frequency in frequency_map:
-        next_backup = datetime.now() + frequency_map[frequency]
-        preview_text = f"Next Backup: {next_backup.strftime('%Y-%m-%d %H:%M:%S')}\nFrequency: {frequency}"
-    else:
-        preview_text = "Please select a backup frequency."
-
-    cancel_button = messagebox.askyesno("Backup Schedule Preview", f"{preview_text}\n\nDo you want to cancel the upcoming backup?")
+    try:
+        jobs = Scheduler().status()
+    except ValueError as e:
+        messagebox.showerror("Schedule Error", str(e))
+        return
+    if not jobs:
+        messagebox.showinfo("Backup Schedule Preview", "No backups are scheduled. Select a frequency and run an incremental backup to schedule one.")
+        return
+    lines = []
+    for job in jobs:
+        state = f", last run {job['status']}" if job['status'] else ""
+        missed = f", {job['missed']} missed" if job['missed'] else ""
+        lines.append(f"{job['name']}: next backup {datetime.fromtimestamp(job['next_run']).strftime('%Y-%m-%d %H:%M')} "
+                     f"({job['interval']}{state}{missed})")
+    name = job_name(engine.split_source_dirs(selected_dirs.get()))
+    if name not in {job['name'] for job in jobs}:
+        messagebox.showinfo("Backup Schedule Preview", "\n".join(lines))
+        return
+    cancel_button = messagebox.askyesno("Backup Schedule Preview", "\n".join(lines) + f"\n\nDo you want to cancel the scheduled backup of {name}?")
     if cancel_button:
         cancel_scheduled_backup()
 
+# Function to remove the job of the selected directories; the cron line or task goes when no job is left
 def cancel_scheduled_backup():
-    if platform.system() == "Linux" or platform.system() == "Darwin":
-        os.system('crontab -r')
-        messagebox.showinfo("Backup Canceled", "Scheduled backup has been canceled.")
-    elif platform.system() == "Windows":
-        task_name = "BackupTask"
-        command = f'schtasks /delete /tn {task_name} /f'
-        subprocess.run(command, shell=True)
-        messagebox.showinfo("Backup Canceled", "Scheduled backup has been canceled.")
-
-# Function to encrypt the backup file
-def encrypt_backup_file(backup_path):
-    password = password_entry.get()
-    if not password:
-        messagebox.showerror("Error", "Password is required for encryption.")
+    remove_job(job_name(engine.split_source_dirs(selected_dirs.get())))
+    try:
+        if not load_jobs():
+            remove_trigger(CLI_SCRIPT)
+    except (ValueError, OSError, subprocess.SubprocessError) as e:
+        messagebox.showerror("Schedule Error", str(e))
         return
-
-    key = password_to_key(password)
-    cipher = Fernet(key)
-
-    with open(backup_path, 'rb') as file:
-        original_file = file.read()
-        encrypted_file = cipher.encrypt(original_file)
-
-    encrypted_backup_path = backup_path + ".enc"
-    with open(encrypted_backup_path, 'wb') as file:
-        file.write(encrypted_file)
-
-    os.remove(backup_path)  # Remove original file after encryption
-    messagebox.showinfo("Backup Encrypted", f"Backup file encrypted and saved as {encrypted_backup_path}")
-
-# Function to get the last backup time from the statistics file
-def get_last_backup_time():
-    if os.path.exists(STATS_FILE):
-        with open(STATS_FILE, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            last_row = list(reader)[-1]
-            last_backup_time = last_row[0]
-            return time.mktime(datetime.strptime(last_backup_time, '%Y%m%d_%H%M%S').timetuple())
-    return 0
-
-# Function to record backup statistics
-def record_backup_stat(timestamp, size, success):
-    with open(STATS_FILE, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([timestamp, size, str(success)])
+    messagebox.showinfo("Backup Canceled", "Scheduled backup has been canceled.")
 
 # Function to choose directories for backup
 def choose_directories():
@@ -325,204 +329,224 @@ def choose_backup_location():
     dest_dir = filedialog.askdirectory()
     backup_location.set(dest_dir)
 
-# Function to run full backup (not incremental)
-def run_full_backup():
-    source_dirs = selected_dirs.get().split('; ')
+# Function to read the compression codec and level chosen in the UI
+def get_compression_settings():
+    codec = compression_codec.get() or "gzip"
+    try:
+        level = int(compression_level.get())
+    except ValueError:
+        level = DEFAULT_LEVELS.get(codec)
+    return codec, level
+
+# Function to run a backup through the engine and report the outcome
+def run_backup(backup_type):
+    source_dirs = engine.split_source_dirs(selected_dirs.get())
     backup_dir = backup_location.get()
 
     if not source_dirs or not backup_dir:
         messagebox.showerror("Input Error", "Please select source directories and backup destination.")
         return
 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_file = f"backup_{timestamp}_full.tar.gz"
-    backup_path = os.path.join(backup_dir, backup_file)
+    def on_done(result):
+        messagebox.showinfo("Backup Completed", f"{backup_type} backup saved as {result['backup_file']} in {backup_dir}")
+        if backup_type == 'Incremental':
+            # Schedule next backup according to specified frequency
+            schedule_backup(backup_frequency.get())
+        apply_retention_after_backup(result)
 
+    codec, level = get_compression_settings()
+    config = engine.load_config()
     try:
-        # Create tar.gz backup file
-        with tarfile.open(backup_path, "w:gz") as tar:
-            for source in source_dirs:
-                tar.add(source, arcname=os.path.basename(source))
-
-        password = password_entry.get()
-        if password:
-            # Encrypt if password is provided
-            encrypt_backup_file(backup_path)
-            encrypted_backup_path = backup_path + ".enc"
-            backup_path = encrypted_backup_path
-
-        # Get backup file size
-        size = os.path.getsize(backup_path)
-        
-        # Record backup metadata
-        backup_type = 'Full'
-        record_backup_metadata(backup_file, backup_type, size, backup_dir, backup_file, encrypted=bool(password))
-        
-        # Notify user of success
-        messagebox.showinfo("Backup Completed", f"Full backup saved as {backup_file} in {backup_dir}")
-
-    except Exception as e:
-        # Log failure in metadata with size = 0
-        record_backup_metadata(backup_file, 'Full', 0, backup_dir, backup_file)
-        messagebox.showerror("Backup Failed", f"Error: {str(e)}")
+        # Bandwidth, priority and load limits from user_config.ini (see governor.py)
+        governor = governor_from_config(config)
+    except ValueError as e:
+        messagebox.showerror("Configuration Error", str(e))
+        return
+    start_job(f"{backup_type} Backup", engine.run_backup, on_done, source_dirs, backup_dir, backup_type,
+              password=password_entry.get(), codec=codec, level=level, hash_files=content_hashing.get(),
+              archive_format=archive_format.get() or 'tar', metrics_export=config['metrics_export'],
+              adaptive=adaptive_compression.get(), governor=governor, delta_min_size=config['delta_min_size'])
 
-def run_incremental_backup():
-    source_dirs = selected_dirs.get().split('; ')
-    backup_dir = backup_location.get()
-    frequency = backup_frequency.get()
+# Function to apply the configured retention policy (keep_daily/keep_weekly/keep_monthly) after a backup
+def apply_retention_after_backup(result):
+    from retention import policy_from_config, apply_retention
 
-    if not source_dirs or not backup_dir:
-        messagebox.showerror("Input Error", "Please select source directories and backup destination.")
+    policy = policy_from_config(engine.load_config())
+    if policy is None:
         return
 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_file = f"backup_{timestamp}_incremental.tar.gz"
-    backup_path = os.path.join(backup_dir, backup_file)
+    def on_done(summary):
+        if summary['merged'] or summary['deleted']:
+            messagebox.showinfo("Retention", f"Merged expired backups into {len(summary['merged'])} kept version(s) and "
+                                f"deleted {len(summary['deleted'])} backup(s); {summary['bytes_freed']} bytes freed.")
 
-    last_backup_time = get_last_backup_time()
+    start_job("Retention", apply_retention, on_done, policy, password_entry.get(), source_set=result['source_set'])
 
-    try:
-        # Create tar.gz backup file for files modified since the last backup
-        with tarfile.open(backup_path, "w:gz") as tar:
-            for source in source_dirs:
-                for root, dirs, files in os.walk(source):
-                    for file in files:
-                        filepath = os.path.join(root, file)
-                        if os.path.getmtime(filepath) > last_backup_time:
-                            tar.add(filepath, arcname=os.path.relpath(filepath, source))
-
-        password = password_entry.get()
-        if password:
-            # Encrypt if password is provided
-            encrypt_backup_file(backup_path)
-            encrypted_backup_path = backup_path + ".enc"
-            backup_path = encrypted_backup_path
-
-        # Get backup file size
-        size = os.path.getsize(backup_path)
-        
-        # Record backup metadata
-        backup_type = 'Incremental'
-        record_backup_metadata(backup_file, backup_type, size, backup_dir, backup_file, encrypted=bool(password))
-
-        # Notify user of success
-        messagebox.showinfo("Backup Completed", f"Incremental backup saved as {backup_file} in {backup_dir}")
-
-    except Exception as e:
-        # Log failure in metadata with size = 0
-        record_backup_metadata(backup_file, 'Incremental', 0, backup_dir, backup_file)
-        messagebox.showerror("Backup Failed", f"Error: {str(e)}")
-
-    # Schedule next backup according to specified frequency
-    schedule_backup(frequency)
-
-# Function to schedule backup based on frequency
+# Function to run full backup (not incremental)
+def run_full_backup():
+    run_backup('Full')
+
+def run_incremental_backup():
+    run_backup('Incremental')
+
+# Function to run an engine call on a worker thread behind a progress window.
+# The window polls the job's event queue with after(), so Tk stays responsive;
+# `on_done(result)` runs on the Tk thread once the job has finished.
+def start_job(title, target, on_done, *args, **kwargs):
+    global current_job
+    if current_job is not None and current_job.is_running():
+        messagebox.showerror("Busy", f"{current_job.name} is still running.")
+        return
+    job = current_job = BackgroundJob(title, target, *args, **kwargs).start()
+
+    window = tk.Toplevel()
+    window.title(title)
+    status_text = tk.StringVar(value="Starting...")
+    current_text = tk.StringVar()
+
+    progress_bar = ttk.Progressbar(window, length=400, mode='indeterminate')
+    progress_bar.grid(row=0, column=0, padx=10, pady=10)
+    progress_bar.start()
+    tk.Label(window, textvariable=status_text).grid(row=1, column=0, sticky='w', padx=10)
+    tk.Label(window, textvariable=current_text, width=60, anchor='w').grid(row=2, column=0, sticky='w', padx=10)
+
+    def cancel():
+        job.cancel()
+        status_text.set("Cancelling...")
+        cancel_button.configure(state='disabled')
+
+    cancel_button = tb.Button(window, text="Cancel", command=cancel, bootstyle="danger")
+    cancel_button.grid(row=3, column=0, pady=10)
+    window.protocol("WM_DELETE_WINDOW", cancel)
+
+    def show_progress(snapshot):
+        if snapshot['total_bytes']:
+            if str(progress_bar['mode']) != 'determinate':
+                progress_bar.stop()
+                progress_bar.configure(mode='determinate', maximum=100)
+            progress_bar['value'] = min(100.0, 100.0 * snapshot['bytes'] / snapshot['total_bytes'])
+        status_text.set(format_progress(snapshot))
+        current_text.set(snapshot['current'])
+
+    def poll():
+        for kind, payload in job.poll():
+            if kind == 'progress':
+                show_progress(payload)
+                continue
+            window.destroy()
+            if kind == 'done':
+                on_done(payload)
+            elif kind == 'cancelled':
+                messagebox.showinfo(f"{title} Cancelled", f"{title} was cancelled after {payload['files']} files.")
+            else:
+                messagebox.showerror(f"{title} Failed", f"Error: {payload}")
+            return
+        window.after(JOB_POLL_INTERVAL, poll)
+
+    window.after(JOB_POLL_INTERVAL, poll)
+
+# Function to schedule incremental backups of the selected directories as their own job (see scheduler.py).
+# The job is saved in user_config.ini and cron or the Task Scheduler runs the headless scheduler; both
+# are updated in place, so scheduling again never adds a duplicate.
 def schedule_backup(frequency):
-    cron_command = generate_cron_command(frequency)
-    if platform.system() == "Linux" or platform.system() == "Darwin":
-        os.system(f'(crontab -l 2>/dev/null; echo "{cron_command}") | crontab -')
-        messagebox.showinfo("Backup Scheduled", f"Backup scheduled with cron: {cron_command}")
-    elif platform.system() == "Windows":
-        schedule_task_windows(frequency)
-        messagebox.showinfo("Backup Scheduled", f"Backup scheduled with Task Scheduler")
-
-# Function to generate cron command based on frequency
-def generate_cron_command(frequency):
-    script_path = os.path.abspath(__file__)
-    if frequency == 'Daily':
-        return f"0 0 * * * python3 {script_path}"
-    elif frequency == 'Weekly':
-        return f"0 0 * * 0 python3 {script_path}"
-    elif frequency == 'Monthly':
-        return f"0 0 1 * * python3 {script_path}"
-    return ""
-
-# Function to schedule tasks in Windows using Task Scheduler
-def schedule_task_windows(frequency):
-    task_name = "BackupTask"
-    script_path = os.path.abspath(__file__)
-    time_map = {'Daily': 'DAILY', 'Weekly': 'WEEKLY', 'Monthly': 'MONTHLY'}
-    time_interval = time_map.get(frequency, 'DAILY')
-
-    command = f'schtasks /create /tn {task_name} /tr "python {script_path}" /sc {time_interval} /f'
-    subprocess.run(command, shell=True)
+    if not frequency:
+        return
+    source_dirs = engine.split_source_dirs(selected_dirs.get())
+    try:
+        changed = save_job(job_name(source_dirs), source_dirs, backup_location.get(), frequency)
+        install_trigger(CLI_SCRIPT)
+    except (ValueError, OSError, subprocess.SubprocessError) as e:
+        messagebox.showerror("Schedule Error", f"Could not schedule the backup: {e}")
+        return
+    if changed:
+        messagebox.showinfo("Backup Scheduled", f"{frequency} backup of {job_name(source_dirs)} scheduled.")
 
 # Function to show backup statistics
 def show_backup_statistics():
-    metadata_file = 'backup_metadata.json'
-    
-    try:
-        if not os.path.exists(metadata_file):
-            raise FileNotFoundError
+    import matplotlib.pyplot as plt
 
-        with open(metadata_file, 'r') as f:
-            metadata = json.load(f)
+    try:
+        metadata = engine.list_backups(limit=STATISTICS_LIMIT)[::-1]
 
         if not metadata:
             raise FileNotFoundError
 
         dates, sizes, successes = [], [], []
+        # Stage breakdown and throughput only exist for runs that recorded metrics
+        timed_dates, stage_times, throughput, files_per_second = [], {stage: [] for stage in STAGE_ORDER}, [], []
 
         for entry in metadata:
             dates.append(entry['timestamp'])
             sizes.append(entry['size'])
-            successes.append(entry['size'] > 0)  # Assuming size > 0 indicates success
-
-        plt.figure(figsize=(10, 5))
-        plt.subplot(2, 1, 1)
+            successes.append(entry['status'] == 'success')
+            run_metrics = entry['details'].get('metrics')
+            if entry['status'] == 'success' and run_metrics and run_metrics.get('wall'):
+                timed_dates.append(entry['timestamp'])
+                for stage in STAGE_ORDER:
+                    stage_times[stage].append(run_metrics['stages'].get(stage, {}).get('wall', 0.0))
+                throughput.append(run_metrics['bytes_in'] / (1024 * 1024) / run_metrics['wall'])
+                files_per_second.append(run_metrics['files'] / run_metrics['wall'])
+
+        plt.figure(figsize=(14, 8))
+        plt.subplot(2, 2, 1)
         plt.plot(dates, sizes, marker='o')
         plt.title('Backup Size Over Time')
         plt.xlabel('Date')
         plt.ylabel('Size (bytes)')
         plt.xticks(rotation=45)
 
-        plt.subplot(2, 1, 2)
+        plt.subplot(2, 2, 2)
         plt.bar(dates, [1 if s else 0 for s in successes], color=['green' if s else 'red' for s in successes])
         plt.title('Backup Success Rates')
         plt.xlabel('Date')
         plt.ylabel('Success (1=Success, 0=Failure)')
         plt.xticks(rotation=45)
 
+        plt.subplot(2, 2, 3)
+        bottom = [0.0] * len(timed_dates)
+        for stage in STAGE_ORDER:
+            if any(stage_times[stage]):
+                plt.bar(timed_dates, stage_times[stage], bottom=bottom, label=stage)
+                bottom = [b + t for b, t in zip(bottom, stage_times[stage])]
+        plt.title('Time per Stage')
+        plt.xlabel('Date')
+        plt.ylabel('Seconds')
+        if timed_dates:
+            plt.legend(fontsize='small')
+        plt.xticks(rotation=45)
+
+        throughput_axis = plt.subplot(2, 2, 4)
+        throughput_axis.plot(timed_dates, throughput, marker='o', color='tab:blue')
+        throughput_axis.set_ylabel('MB/s', color='tab:blue')
+        files_axis = throughput_axis.twinx()
+        files_axis.plot(timed_dates, files_per_second, marker='x', color='tab:orange')
+        files_axis.set_ylabel('files/s', color='tab:orange')
+        throughput_axis.set_title('Throughput')
+        throughput_axis.set_xlabel('Date')
+        throughput_axis.tick_params(axis='x', labelrotation=45)
+
         plt.tight_layout()
         plt.show()
 
     except FileNotFoundError:
         messagebox.showerror("Error", "No backup statistics found.")
-        
-# Function to decrypt the backup file
-def decrypt_backup_file(backup_path):
-    password = password_entry.get()
-    if not password:
-        messagebox.showerror("Error", "Password is required for decryption.")
-        return None
-
-    key = password_to_key(password)
-    cipher = Fernet(key)
-
-    try:
-        with open(backup_path, 'rb') as encrypted_file:
-            encrypted_data = encrypted_file.read()
-            decrypted_data = cipher.decrypt(encrypted_data)
-
-        decrypted_backup_path = backup_path.replace(".enc", "")
-        with open(decrypted_backup_path, 'wb') as decrypted_file:
-            decrypted_file.write(decrypted_data)
-
-        os.remove(backup_path)  # Remove encrypted file after decryption
-        return decrypted_backup_path
 
-    except Exception as e:
-        messagebox.showerror("Decryption Failed", f"Error: {str(e)}")
-        return None
 # Main application logic
 def main():
     root = tb.Window(themename="superhero")
     
-    global selected_dirs, backup_location, backup_frequency, encryption_enabled, password_entry
+    global selected_dirs, backup_location, backup_frequency, encryption_enabled
+    global compression_codec, compression_level, content_hashing, archive_format, restore_path, adaptive_compression
     selected_dirs = tk.StringVar()
     backup_location = tk.StringVar()
     backup_frequency = tk.StringVar()
     encryption_enabled = tk.BooleanVar(value=False)
+    content_hashing = tk.BooleanVar(value=False)
+    compression_codec = tk.StringVar(value="gzip")
+    compression_level = tk.StringVar(value=str(DEFAULT_LEVELS["gzip"]))
+    archive_format = tk.StringVar(value="tar")
+    restore_path = tk.StringVar()
+    adaptive_compression = tk.BooleanVar(value=True)
 
     load_user_preferences()
     show_splash(root)
@@ -0,0 +1,320 @@
+import os
+import sqlite3
+import hashlib
+from collections import namedtuple
+from datetime import datetime
+
+
+# Persistent file-state manifest used by incremental backups.
+#
+# One row per file and source directory holds the state seen by the last
+# successful backup (size, mtime_ns, inode and an optional content hash).
+# An incremental run diffs a fresh scan against these rows in a single pass,
+# and only the rows that changed are written back. Every run also records
+# what it saw change (added, modified, patched, deleted, renamed) so later
+# restores can replay deletions and renames, and apply deltas (see delta.py)
+# on top of an earlier copy of a patched file. Large files also keep the
+# block signature of their last archived version, which the next delta is
+# computed against.
+MANIFEST_FILE = 'backup_manifest.db'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+FileState = namedtuple('FileState', ['path', 'size', 'mtime_ns', 'inode', 'hash'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hash BLOB,
+    PRIMARY KEY (source, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_inode ON files (source, inode);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    backup_file TEXT NOT NULL,
+    backup_type TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_backup_file ON runs (backup_file);
+CREATE TABLE IF NOT EXISTS changes (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    old_path TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_run ON changes (run_id, source);
+CREATE TABLE IF NOT EXISTS signatures (
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    run_id INTEGER,
+    data BLOB NOT NULL,
+    PRIMARY KEY (source, path)
+);
+CREATE INDEX IF NOT EXISTS signatures_run ON signatures (run_id);
+"""
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.digest()
+
+
+def state_from_scan(scanned, file_hash=None):
+    st = scanned.stat
+    return FileState(scanned.path, st.st_size, st.st_mtime_ns, st.st_ino, file_hash)
+
+
+# Result of comparing one source directory's scan with its manifest rows
+class ManifestDiff:
+    def __init__(self, source):
+        self.source = source
+        self.added = []      # ScannedFile
+        self.modified = []   # ScannedFile
+        self.renamed = []    # (old_path, ScannedFile)
+        self.deleted = []    # relative paths
+        self.unreadable = [] # relative paths the scan could not read; kept as they were
+        self.updates = []    # FileState rows to upsert
+        self.unchanged = 0
+
+    def files_to_archive(self):
+        return self.added + self.modified + [scanned for _, scanned in self.renamed]
+
+    def summary(self):
+        return {
+            'added': len(self.added),
+            'modified': len(self.modified),
+            'renamed': len(self.renamed),
+            'deleted': len(self.deleted),
+            'unreadable': len(self.unreadable),
+            'unchanged': self.unchanged,
+        }
+
+
+class BackupManifest:
+    def __init__(self, path=MANIFEST_FILE):
+        # Scheduled backups of other source sets may be recording their runs at the same time
+        self.conn = sqlite3.connect(path, timeout=300)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Number and total size of the files recorded for `source`
+    def source_totals(self, source):
+        return self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE source = ?", (source,)).fetchone()
+
+    def has_source(self, source):
+        row = self.conn.execute("SELECT 1 FROM files WHERE source = ? LIMIT 1", (source,)).fetchone()
+        return row is not None
+
+    def load_source(self, source):
+        rows = self.conn.execute(
+            "SELECT path, size, mtime_ns, inode, hash FROM files WHERE source = ?", (source,))
+        return {row[0]: FileState(*row) for row in rows}
+
+    # Stored state of the part of `source` covered by `scope` (a journal.JournalChanges):
+    # each changed path and everything below each changed subtree
+    def load_scope(self, source, scope):
+        if '' in scope.trees:
+            return self.load_source(source)
+        query = "SELECT path, size, mtime_ns, inode, hash FROM files WHERE source = ?"
+        states = {}
+        for tree in scope.trees:
+            # '0' follows '/', so this is every path below the tree
+            rows = self.conn.execute(query + " AND path > ? AND path < ?", (source, tree + '/', tree + '0'))
+            states.update((row[0], FileState(*row)) for row in rows)
+        for path in scope.paths | scope.trees:
+            row = self.conn.execute(query + " AND path = ?", (source, path)).fetchone()
+            if row is not None:
+                states[path] = FileState(*row)
+        return states
+
+    # Compare a scan of `source` with the stored state in one pass over the scan.
+    # `on_change` is called with every file that has to be archived as soon as
+    # it is seen, so archiving can overlap with the rest of the scan.
+    # With a `scope` (see load_scope), the scan covers only that part of the source.
+    # `unreadable` holds the absolute paths the scan could not read (ScanStats.unreadable,
+    # read once the scan is over); what was stored below them is neither deleted nor renamed.
+    def diff(self, source, scanned_files, hash_files=False, on_change=None, scope=None, unreadable=()):
+        previous = self.load_source(source) if scope is None else self.load_scope(source, scope)
+        diff = ManifestDiff(source)
+        candidates = []
+
+        for scanned in scanned_files:
+            st = scanned.stat
+            old = previous.pop(scanned.path, None)
+            if old is None:
+                candidates.append(scanned)
+                if on_change:
+                    on_change(scanned)
+            elif old.size == st.st_size and old.mtime_ns == st.st_mtime_ns and old.inode == st.st_ino:
+                diff.unchanged += 1
+            elif hash_files and old.hash is not None and old.size == st.st_size:
+                # Touched but possibly identical: only archive it if the content really changed
+                file_hash = hash_file(scanned.abs_path)
+                diff.updates.append(state_from_scan(scanned, file_hash))
+                if file_hash == old.hash:
+                    diff.unchanged += 1
+                else:
+                    diff.modified.append(scanned)
+                    if on_change:
+                        on_change(scanned)
+            else:
+                diff.modified.append(scanned)
+                if on_change:
+                    on_change(scanned)
+                diff.updates.append(state_from_scan(scanned, hash_file(scanned.abs_path) if hash_files else None))
+
+        for abs_path in unreadable:
+            relative = os.path.relpath(abs_path, source).replace(os.sep, '/')
+            if relative == '..' or relative.startswith('../'):
+                continue  # Another source's
+            diff.unreadable.append(relative)
+            for path in [path for path in previous if path == relative or path.startswith(relative + '/')]:
+                del previous[path]
+
+        # Whatever is left over was not seen by the scan; a new path with the
+        # same inode and size as a vanished one is treated as a rename
+        vanished = {(state.inode, state.size): state for state in previous.values()}
+        for scanned in candidates:
+            st = scanned.stat
+            old = vanished.pop((st.st_ino, st.st_size), None)
+            if old is not None:
+                diff.renamed.append((old.path, scanned))
+                previous.pop(old.path, None)
+            else:
+                diff.added.append(scanned)
+            diff.updates.append(state_from_scan(scanned, hash_file(scanned.abs_path) if hash_files else None))
+
+        diff.deleted = sorted(previous)
+        return diff
+
+    def _start_run(self, backup_file, backup_type):
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor = self.conn.execute(
+            "INSERT INTO runs (backup_file, backup_type, timestamp) VALUES (?, ?, ?)",
+            (backup_file, backup_type, timestamp))
+        return cursor.lastrowid
+
+    # Block signature of the last archived version of a file, or None
+    def signature(self, source, path):
+        row = self.conn.execute("SELECT data FROM signatures WHERE source = ? AND path = ?", (source, path)).fetchone()
+        return row[0] if row is not None else None
+
+    # Store {(source, path): signature bytes} for `run_id`; None drops a file's signature
+    def _store_signatures(self, run_id, signatures):
+        self.conn.executemany("DELETE FROM signatures WHERE source = ? AND path = ?",
+                              (key for key, data in signatures.items() if data is None))
+        self.conn.executemany("INSERT OR REPLACE INTO signatures (source, path, run_id, data) VALUES (?, ?, ?, ?)",
+                              ((source, path, run_id, data) for (source, path), data in signatures.items()
+                               if data is not None))
+
+    # Replace the stored state of every source with the files of a full backup
+    def record_full(self, backup_file, scans, hash_files=False, signatures=None):
+        with self.conn:
+            run_id = self._start_run(backup_file, 'Full')
+            for source, scanned_files in scans.items():
+                self.conn.execute("DELETE FROM files WHERE source = ?", (source,))
+                self.conn.execute("DELETE FROM signatures WHERE source = ?", (source,))
+                self.conn.executemany(
+                    "INSERT INTO files (source, path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                    ((source,) + tuple(state_from_scan(scanned, hash_file(scanned.abs_path) if hash_files else None))
+                     for scanned in scanned_files))
+            self._store_signatures(run_id, signatures or {})
+
+    # Apply only the changed rows of an incremental backup and log its changes.
+    # `patched` holds the (source, path) of modified files archived as deltas.
+    def record_incremental(self, backup_file, diffs, signatures=None, patched=()):
+        with self.conn:
+            run_id = self._start_run(backup_file, 'Incremental')
+            for diff in diffs:
+                source = diff.source
+                removed = diff.deleted + [old_path for old_path, _ in diff.renamed]
+                self.conn.executemany(
+                    "DELETE FROM files WHERE source = ? AND path = ?", ((source, path) for path in removed))
+                self.conn.executemany(
+                    "DELETE FROM signatures WHERE source = ? AND path = ?", ((source, path) for path in removed))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO files (source, path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                    ((source,) + tuple(state) for state in diff.updates))
+
+                changes = [(run_id, source, s.path, 'added', None) for s in diff.added]
+                changes += [(run_id, source, s.path, 'patched' if (source, s.path) in patched else 'modified', None)
+                            for s in diff.modified]
+                changes += [(run_id, source, s.path, 'renamed', old_path) for old_path, s in diff.renamed]
+                changes += [(run_id, source, path, 'deleted', None) for path in diff.deleted]
+                self.conn.executemany(
+                    "INSERT INTO changes (run_id, source, path, kind, old_path) VALUES (?, ?, ?, ?, ?)", changes)
+            self._store_signatures(run_id, signatures or {})
+
+    def has_run(self, backup_file):
+        row = self.conn.execute("SELECT 1 FROM runs WHERE backup_file = ? LIMIT 1", (backup_file,)).fetchone()
+        return row is not None
+
+    def changes_for_backup(self, backup_file):
+        return self.conn.execute(
+            "SELECT c.source, c.path, c.kind, c.old_path FROM changes c JOIN runs r ON r.id = c.run_id "
+            "WHERE r.backup_file = ?", (backup_file,)).fetchall()
+
+    # Fold the runs of merged backups into one run for the archive that replaced them.
+    # A synthetic full needs no change log; a merged incremental gets the net changes,
+    # with renames split into a deletion of the old path and an addition of the new one,
+    # and a file stays patched only if the merged archive holds no full copy of it.
+    # If any merged backup is unknown to the manifest, no run is recorded, so restores
+    # fall back to listing the new archive.
+    def merge_runs(self, backup_files, new_backup_file, backup_type):
+        runs = [[row[0] for row in self.conn.execute("SELECT id FROM runs WHERE backup_file = ?", (backup_file,))]
+                for backup_file in backup_files]
+        run_ids = sorted(run_id for ids in runs for run_id in ids)
+        net = {}
+        if backup_type == 'Incremental':
+            for run_id in run_ids:
+                for source, path, kind, old_path in self.conn.execute(
+                        "SELECT source, path, kind, old_path FROM changes WHERE run_id = ? ORDER BY rowid", (run_id,)):
+                    if kind == 'renamed':
+                        net[(source, old_path)] = 'deleted'
+                        kind = 'added'
+                    if kind == 'patched' and net.get((source, path)) in ('added', 'modified'):
+                        continue
+                    net[(source, path)] = kind
+        with self.conn:
+            self.conn.executemany("DELETE FROM changes WHERE run_id = ?", ((run_id,) for run_id in run_ids))
+            self.conn.executemany("DELETE FROM runs WHERE id = ?", ((run_id,) for run_id in run_ids))
+            new_run_id = None
+            if all(runs):
+                new_run_id = self._start_run(new_backup_file, backup_type)
+                self.conn.executemany(
+                    "INSERT INTO changes (run_id, source, path, kind, old_path) VALUES (?, ?, ?, ?, NULL)",
+                    ((new_run_id, source, path, kind) for (source, path), kind in net.items()))
+            # The merged archive holds the versions these signatures describe
+            self.conn.executemany("UPDATE signatures SET run_id = ? WHERE run_id = ?",
+                                  ((new_run_id, run_id) for run_id in run_ids))
+
+    # Forget the runs of deleted backups, and the signatures of the versions only they held
+    def forget_runs(self, backup_files):
+        with self.conn:
+            for backup_file in backup_files:
+                run_ids = [(row[0],) for row in self.conn.execute("SELECT id FROM runs WHERE backup_file = ?",
+                                                                  (backup_file,))]
+                self.conn.executemany("DELETE FROM changes WHERE run_id = ?", run_ids)
+                self.conn.executemany("DELETE FROM signatures WHERE run_id = ?", run_ids)
+                self.conn.executemany("DELETE FROM runs WHERE id = ?", run_ids)
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Per-stage timing and I/O counters for backup and restore runs.
+#
+# Each layer of the pipeline (source reads, compression, encryption, writes
+# to the destination, and the reverse on restore) is wrapped in a timed
+# section named after its stage. Sections nest: time spent in an inner stage
+# on the same thread is subtracted from the outer one, so every stage gets
+# its own wall and CPU time even though the layers call into each other.
+# Compression runs on worker threads and is timed there, so its wall time is
+# busy time summed over the workers and can exceed the run's wall time.
+# Repository backups add a 'chunk' stage: finding chunk boundaries and hashing.
+# 'checksum' is hashing files and stored blocks for later verification (see checksums.py).
+STAGE_ORDER = ('scan', 'read', 'chunk', 'checksum', 'compress', 'encrypt', 'write', 'decrypt', 'decompress',
+               'extract')
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RunMetrics:
+    def __init__(self, operation):
+        self.operation = operation
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.summary = {}
+
+    def add(self, name, wall=0.0, cpu=0.0, nbytes=0, calls=0):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'wall': 0.0, 'cpu': 0.0, 'bytes': 0, 'calls': 0}
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['bytes'] += nbytes
+            stage['calls'] += calls
+
+    # Start and stop an exclusive timing on the calling thread; the file wrappers
+    # below call these directly because they run once per read or write
+    def start(self):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append([0.0, 0.0, time.perf_counter(), time.thread_time()])
+        return stack
+
+    def stop(self, stack, name, nbytes=0):
+        nested_wall, nested_cpu, wall_start, cpu_start = stack.pop()
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start
+        if stack:
+            stack[-1][0] += wall
+            stack[-1][1] += cpu
+        self.add(name, wall - nested_wall, cpu - nested_cpu, nbytes, 1)
+
+    # Time the enclosed code as stage `name`, excluding nested timed sections on this thread
+    @contextmanager
+    def timed(self, name):
+        stack = self.start()
+        try:
+            yield
+        finally:
+            self.stop(stack, name)
+
+    def reader(self, fileobj, name):
+        return TimedReader(fileobj, self, name)
+
+    def writer(self, fileobj, name):
+        return TimedWriter(fileobj, self, name)
+
+    # Close the run: total wall/CPU time, peak memory and the caller's counters
+    def finish(self, **counters):
+        self.summary = {
+            'wall': round(time.perf_counter() - self.started, 4),
+            'cpu': round(time.process_time() - self.cpu_started, 4),
+            'peak_rss': peak_rss_bytes(),
+        }
+        self.summary.update(counters)
+        return self.as_dict()
+
+    def as_dict(self):
+        with self.lock:
+            stages = {name: {'wall': round(stage['wall'], 4), 'cpu': round(stage['cpu'], 4),
+                             'bytes': stage['bytes'], 'calls': stage['calls']}
+                      for name, stage in self.stages.items()}
+        return dict(self.summary, operation=self.operation, stages=stages)
+
+
+# File-like wrappers that time every read or write as one stage
+class TimedReader:
+    def __init__(self, fileobj, metrics, name):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.name = name
+
+    def read(self, size=-1):
+        stack = self.metrics.start()
+        try:
+            data = self.fileobj.read(size)
+        except BaseException:
+            self.metrics.stop(stack, self.name)
+            raise
+        self.metrics.stop(stack, self.name, len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+class TimedWriter:
+    def __init__(self, fileobj, metrics, name):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.name = name
+
+    def write(self, data):
+        stack = self.metrics.start()
+        try:
+            return self.fileobj.write(data)
+        finally:
+            self.metrics.stop(stack, self.name, len(data))
+
+    def close(self):
+        with self.metrics.timed(self.name):
+            self.fileobj.close()
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+# Append a finished run to a JSON-lines file, or rewrite a Prometheus textfile
+# (for node_exporter's textfile collector) when the path ends in .prom
+def export_metrics(path, record):
+    if path.endswith('.prom'):
+        write_prometheus_textfile(path, record)
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _prometheus_labels(labels):
+    return ','.join(f'{key}="{str(value)}"' for key, value in labels.items())
+
+
+def write_prometheus_textfile(path, record):
+    # Restores carry their metrics at the top level, catalog entries inside 'details'
+    metrics = record.get('metrics') or (record.get('details') or {}).get('metrics', {})
+    labels = {'operation': metrics.get('operation', 'backup'), 'backup_type': record.get('backup_type', '')}
+    base = _prometheus_labels(labels)
+    lines = []
+
+    def gauge(name, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for sample_labels, value in samples:
+            if value is not None:
+                lines.append(f"{name}{{{sample_labels}}} {value}")
+
+    gauge('backup_last_run_success', "1 if the last run succeeded", [(base, int(record.get('status') == 'success'))])
+    gauge('backup_last_run_timestamp_seconds', "Unix time the last run finished", [(base, int(time.time()))])
+    gauge('backup_last_run_duration_seconds', "Wall time of the last run", [(base, metrics.get('wall'))])
+    gauge('backup_last_run_cpu_seconds', "Process CPU time of the last run", [(base, metrics.get('cpu'))])
+    gauge('backup_last_run_files', "Files processed by the last run", [(base, metrics.get('files'))])
+    gauge('backup_last_run_bytes_in', "Bytes read by the last run", [(base, metrics.get('bytes_in'))])
+    gauge('backup_last_run_bytes_out', "Bytes written by the last run", [(base, metrics.get('bytes_out'))])
+    gauge('backup_last_run_compression_ratio', "Input bytes per output byte", [(base, metrics.get('compression_ratio'))])
+    gauge('backup_last_run_peak_rss_bytes', "Peak resident memory of the process", [(base, metrics.get('peak_rss'))])
+    adaptive = metrics.get('adaptive') or {}
+    gauge('backup_last_run_files_stored_uncompressed', "Files the adaptive policy stored without compression",
+          [(base, adaptive.get('files_stored'))])
+    gauge('backup_last_run_compression_cpu_saved_seconds', "Estimated CPU time saved by adaptive compression",
+          [(base, adaptive.get('cpu_saved'))])
+    throttled = metrics.get('throttled') or {}
+    gauge('backup_last_run_throttled_seconds', "Wall time the resource governor held the last run back",
+          [(_prometheus_labels(dict(labels, reason=reason)), throttled.get(reason))
+           for reason in ('read', 'write', 'load', 'await', 'total')])
+    delta = metrics.get('delta') or {}
+    gauge('backup_last_run_delta_files', "Large files the last run stored as block deltas", [(base, delta.get('files'))])
+    gauge('backup_last_run_delta_ratio', "Delta bytes stored per byte of the files they describe",
+          [(base, delta.get('ratio'))])
+    stages = metrics.get('stages', {})
+    for field, help_text in (('wall', "Wall time per pipeline stage"), ('cpu', "CPU time per pipeline stage"),
+                             ('bytes', "Bytes through each pipeline stage")):
+        unit = 'bytes' if field == 'bytes' else f'{field}_seconds'
+        gauge(f'backup_last_run_stage_{unit}', help_text,
+              [(_prometheus_labels(dict(labels, stage=name)), stage[field]) for name, stage in sorted(stages.items())])
+
+    # Write next to the target and rename, so the collector never reads a partial file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temporary, path)
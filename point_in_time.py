@@ -0,0 +1,157 @@
+import os
+from datetime import datetime
+
+import engine
+import storage
+from engine import BackupError
+from catalog import make_source_set
+from manifest import BackupManifest
+from seekable import SeekableArchiveReader, is_seekable_archive
+
+# Point-in-time restore across a full backup and its incrementals.
+#
+# The chain for a moment T is the newest successful full backup at or before
+# T plus every incremental of the same source set taken after it, up to T.
+# Walking the chain from newest to oldest, each path is claimed by the first
+# archive that holds it, unless a newer run recorded it as deleted (or
+# renamed away). Every archive then extracts only the paths it won, so each
+# file is written exactly once. A file an incremental stored as a delta (see
+# delta.py) does not claim its path: the next older copy is restored too and
+# the deltas are applied on top of it in order. Archives are read oldest
+# first, each one front to back, which keeps the reads sequential.
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+# Function to turn user input into a catalog timestamp; a bare date means the end of that day
+def parse_timestamp(value):
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            moment = datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        if fmt == '%Y-%m-%d':
+            moment = moment.replace(hour=23, minute=59, second=59)
+        return moment.strftime('%Y-%m-%d %H:%M:%S')
+    raise BackupError(f"Unrecognised date: {value} (use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)")
+
+
+# Function to find the full backup and incrementals that make up the state at `timestamp`
+def resolve_chain(timestamp, source_dirs=None, source_set=None):
+    with engine.open_catalog() as catalog:
+        if source_set is None:
+            source_set = make_source_set(source_dirs) if source_dirs else None
+        if source_set is None:
+            candidates = {entry['source_set'] for entry in
+                          catalog.list_backups(limit=None, until=timestamp, backup_type='Full', status='success')}
+            if len(candidates) > 1:
+                raise BackupError("Backups of several source sets exist; choose the source directories to restore.")
+            source_set = candidates.pop() if candidates else ''
+
+        fulls = catalog.list_backups(limit=1, until=timestamp, backup_type='Full', status='success',
+                                     source_set=source_set)
+        if not fulls:
+            raise BackupError(f"No full backup exists at or before {timestamp}.")
+        full = fulls[0]
+        incrementals = [entry for entry in catalog.iter_backups(since=full['timestamp'], until=timestamp,
+                                                                backup_type='Incremental', status='success',
+                                                                source_set=source_set)
+                        if (entry['timestamp'], entry['id']) > (full['timestamp'], full['id'])]
+    return [full] + incrementals
+
+
+def _arcname(source, path):
+    return f"{os.path.basename(source)}/{path}"
+
+
+# Function to list the member names of one archive, and those of them stored as deltas,
+# preferring the manifest's record of the run
+def archive_members(entry, changes, password):
+    if changes is not None:
+        return ({_arcname(source, path) for source, path, kind, _ in changes if kind != 'deleted'},
+                {_arcname(source, path) for source, path, kind, _ in changes if kind == 'patched'})
+
+    backup_path = engine.get_backup_path(entry)
+    if is_seekable_archive(backup_path):
+        with SeekableArchiveReader(backup_path, password) as archive:
+            items = archive.entries
+    else:
+        items = engine.list_archive_contents(backup_path, password)
+    return ({item['path'].rstrip('/') for item in items},
+            {item['path'] for item in items if item['type'] == 'delta'})
+
+
+# Function to find the members of one incremental that are stored as deltas
+def patched_members(entry, password=None):
+    with BackupManifest(engine.MANIFEST_FILE) as manifest:
+        if manifest.has_run(entry['backup_file']):
+            return archive_members(entry, manifest.changes_for_backup(entry['backup_file']), password)[1]
+    # Unknown to the manifest: only list the archive if the run made deltas at all
+    if not (entry['details'].get('metrics') or {}).get('delta') and 'synthetic' not in entry['details']:
+        return set()
+    return archive_members(entry, None, password)[1]
+
+
+# Function to decide which archive of the chain provides each path
+def plan_chain_restore(chain, password=None):
+    plan = []
+    claimed = set()
+    deleted = set()
+    with BackupManifest(engine.MANIFEST_FILE) as manifest:
+        for entry in reversed(chain[1:]):
+            changes = manifest.changes_for_backup(entry['backup_file'])
+            # A run with nothing recorded is either empty or unknown to this manifest
+            members, patched = archive_members(entry, changes if changes or manifest.has_run(entry['backup_file'])
+                                               else None, password)
+            winners = members - claimed - deleted
+            claimed |= members - patched
+            plan.append((entry, winners))
+            for source, path, kind, old_path in changes:
+                if kind == 'deleted':
+                    deleted.add(_arcname(source, path))
+                elif kind == 'renamed':
+                    deleted.add(_arcname(source, old_path))
+    # The full backup provides everything no incremental claimed or deleted
+    plan.append((chain[0], None))
+    plan.reverse()
+    return plan, claimed | deleted
+
+
+# Function to restore the state as of `timestamp` into `restore_location`
+def restore_to_time(timestamp, restore_location, password=None, source_dirs=None, paths=None, progress=None):
+    timestamp = parse_timestamp(timestamp)
+    chain = resolve_chain(timestamp, source_dirs)
+    restore_chain(chain, restore_location, password, paths, progress)
+    return chain
+
+
+# Function to restore the members `names` as of the incremental `entry`, from the chain it ends
+def restore_chain_paths(entry, restore_location, password, names, progress=None):
+    chain = [item for item in resolve_chain(entry['timestamp'], source_set=entry['source_set'])
+             if (item['timestamp'], item['id']) <= (entry['timestamp'], entry['id'])]
+    restore_chain(chain, restore_location, password, progress=progress, names=names)
+
+
+# Function to restore a chain as planned by plan_chain_restore; `names`, if given, limits it to those members.
+# `paths` are matched against the whole chain, so an archive need not hold every one of them.
+def restore_chain(chain, restore_location, password=None, paths=None, progress=None, names=None):
+    plan, excluded_from_full = plan_chain_restore(chain, password)
+    wanted = [path.strip('/') for path in paths] if paths else None
+    extracted = 0
+    for entry, winners in plan:
+        if names is not None:
+            winners = {name for name in names if name not in excluded_from_full} if winners is None else winners & names
+        if wanted and winners is not None:
+            winners = {name for name in winners if engine.member_selected(name, wanted)}
+        backup_path = engine.get_backup_path(entry)
+        if not storage.exists(backup_path):
+            raise BackupError(f"Backup file does not exist: {backup_path}")
+        if winners is None:
+            predicate = lambda name: name not in excluded_from_full and (not wanted or engine.member_selected(name, wanted))
+        elif not winners:
+            continue
+        else:
+            predicate = winners.__contains__
+        extracted += engine.extract_archive(backup_path, restore_location, password, predicate=predicate,
+                                            progress=progress)
+    if wanted and not extracted:
+        raise BackupError(f"No entries match: {', '.join(paths)}")
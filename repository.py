@@ -0,0 +1,978 @@
+import os
+import json
+import stat
+import struct
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import deque, OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import storage
+from compression import compress_block, decompress_block, check_codec, default_workers, DEFAULT_LEVELS, CODECS
+from scanner import scan_tree
+from extractor import RestoreWriter, data_extents
+
+# Deduplicating backup repository.
+#
+# File contents are cut into variable-size chunks with content-defined
+# chunking (FastCDC: a gear rolling hash over a 32-byte window, normalised
+# with a stricter cut mask before the average chunk size and a looser one
+# after it), so an insertion only changes the chunks around it. Every chunk
+# is stored once, under the BLAKE2b hash of its plaintext (keyed with the
+# repository key when encrypted), as a blob in a pack file:
+#
+#   <repository>/config.json              chunker parameters, gear seed, key check
+#   <repository>/packs/xx/<pack id>.pack  MAGIC | blobs | sealed blob table | table length | FOOTER_MAGIC
+#   <repository>/snapshots/<name>.snap    one backup version: sources and their root trees
+#   <repository>/index.db                 SQLite chunk index: blob id -> (pack, offset, length)
+#   <repository>/index.bloom              Bloom filter over the index, kept in memory while writing
+#
+# A blob is one codec byte (0 = stored) plus the compressed data, AES-GCM
+# sealed with the blob id as associated data when the repository has a
+# password. Directories are stored as tree blobs (JSON, sorted by name) that
+# list each entry's metadata and either its chunk ids or its subtree id, so
+# an unchanged directory is the same blob in every snapshot and a snapshot
+# only adds the trees and chunks that changed. Files whose size, mtime and
+# inode match the previous snapshot reuse its chunk list without being read.
+#
+# Dedup lookups check the chunks written in this session, then the Bloom
+# filter (which rules out almost every new chunk without touching disk),
+# and only then the SQLite index. Pack tables make the index rebuildable
+# from the packs alone.
+MAGIC = b"ABUREPO"
+PACK_MAGIC = b"ABUPACK"
+PACK_FOOTER_MAGIC = b"ABUPIDX"
+SNAPSHOT_MAGIC = b"ABUSNAP"
+FORMAT_VERSION = 1
+SNAPSHOT_EXTENSION = ".snap"
+REPOSITORY_DIR = 'repository'
+NONCE_SIZE = 12
+SALT_SIZE = 16
+ID_SIZE = 32
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+NORMALIZATION = 2           # mask bits added before, and removed after, the average size
+HASH_WINDOW = 32            # the gear hash is 32 bits wide, so a cut depends on the last 32 bytes
+HASH_SEGMENT = 256 * 1024   # bytes hashed per numpy pass
+PACK_SIZE = 16 * 1024 * 1024
+PACK_CACHE = 16             # open pack files kept while restoring
+LOOKUP_BATCH = 500          # blob ids per index query when verifying
+
+BLOOM_BITS_PER_CHUNK = 10
+BLOOM_HASHES = 7
+BLOOM_MIN_BITS = 1 << 23
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    hash BLOB PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    raw_length INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chunks_pack ON chunks (pack);
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class RepositoryError(ValueError):
+    pass
+
+
+# numpy is optional; without it the chunker falls back to a (much slower) pure Python loop
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def repository_path(backup_dir):
+    return os.path.join(backup_dir, REPOSITORY_DIR)
+
+
+def is_repository_snapshot(path):
+    if storage.is_remote(path):
+        return False  # Repositories are only kept on local or mounted storage
+    with open(path, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+# A snapshot lives in <repository>/snapshots/
+def snapshot_repository(snapshot_path):
+    return os.path.dirname(os.path.dirname(os.path.abspath(snapshot_path)))
+
+
+# Time a pipeline stage when the caller asked for metrics (see metrics.py)
+def _timed(metrics, stage, size):
+    if metrics is None:
+        return nullcontext()
+    metrics.add(stage, nbytes=size)
+    return metrics.timed(stage)
+
+
+def _spread_mask(bits):
+    # Spread the mask bits over the upper 30 bits of the hash, which depend on the most input bytes
+    return sum(1 << (31 - (i * 30) // bits) for i in range(bits))
+
+
+# Content-defined chunker (FastCDC with normalised chunking)
+class Chunker:
+    def __init__(self, seed, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        if not HASH_WINDOW <= min_size < avg_size < max_size:
+            raise RepositoryError("Chunk sizes must satisfy 32 <= min < avg < max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = avg_size.bit_length() - 1
+        self.mask_small = _spread_mask(bits + NORMALIZATION)
+        self.mask_large = _spread_mask(bits - NORMALIZATION)
+        self.gear = [int.from_bytes(hashlib.blake2b(seed + struct.pack(">H", i), digest_size=4).digest(), 'big')
+                     for i in range(256)]
+        self.numpy = load_numpy()
+        if self.numpy is not None:
+            self.gear_array = self.numpy.array(self.gear, dtype=self.numpy.uint32)
+
+    # Length of the chunk starting at `start`, or None if more data is needed to decide;
+    # `final` means no more data follows `data`
+    def cut(self, data, start, final):
+        available = len(data) - start
+        if not available or (available < self.max_size and not final):
+            return None
+        if available <= self.min_size:
+            return available
+        normal = start + self.avg_size
+        limit = start + min(available, self.max_size)
+        find = self._find_numpy if self.numpy is not None else self._find_python
+        position = find(data, start + self.min_size, min(normal, limit), self.mask_small)
+        if position is None and normal < limit:
+            position = find(data, normal, limit, self.mask_large)
+        return (position + 1 if position is not None else limit) - start
+
+    # First position in [begin, end) whose windowed gear hash has none of `mask`'s bits set
+    def _find_numpy(self, data, begin, end, mask):
+        numpy = self.numpy
+        view = numpy.frombuffer(data, dtype=numpy.uint8)
+        mask = numpy.uint32(mask)
+        for segment_start in range(begin, end, HASH_SEGMENT):
+            segment_end = min(segment_start + HASH_SEGMENT, end)
+            lookback = segment_start - (HASH_WINDOW - 1)
+            h = self.gear_array[view[lookback:segment_end]]
+            # Prefix doubling: after the step for `shift`, h[i] sums the gear values of the last
+            # 2 * shift bytes, each shifted by its age, which is the rolling hash (h << 1) + gear[b]
+            shift = 1
+            while shift < HASH_WINDOW:
+                h[shift:] += h[:-shift] << numpy.uint32(shift)
+                shift <<= 1
+            hits = numpy.flatnonzero((h[HASH_WINDOW - 1:] & mask) == 0)
+            if len(hits):
+                return segment_start + int(hits[0])
+        return None
+
+    def _find_python(self, data, begin, end, mask):
+        gear = self.gear
+        h = 0
+        for i in range(begin - (HASH_WINDOW - 1), begin):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        for i in range(begin, end):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+            if not h & mask:
+                return i
+        return None
+
+    # Yield the chunks of a file object as bytes
+    def chunks(self, fileobj):
+        buffer = bytearray()
+        final = False
+        while True:
+            # Keep at least one maximum-size chunk buffered, so every cut sees all its candidates
+            while not final and len(buffer) < self.max_size * 2:
+                data = fileobj.read(self.max_size * 2 - len(buffer))
+                final = not data
+                buffer += data
+            start = 0
+            while True:
+                length = self.cut(buffer, start, final)
+                if not length:
+                    break
+                yield bytes(buffer[start:start + length])
+                start += length
+            del buffer[:start]
+            if final:
+                return
+
+
+# Bloom filter over blob ids; ids are uniform hashes, so their bytes serve as the hash functions
+class BloomFilter:
+    def __init__(self, bits, count=0, data=None):
+        self.bits = bits
+        self.mask = bits - 1
+        self.count = count
+        self.data = bytearray(data) if data is not None else bytearray(bits // 8)
+
+    @classmethod
+    def sized_for(cls, chunks):
+        bits = BLOOM_MIN_BITS
+        while bits < chunks * BLOOM_BITS_PER_CHUNK * 2 and bits < 1 << 32:
+            bits <<= 1
+        return cls(bits)
+
+    def _positions(self, blob_id):
+        for i in range(BLOOM_HASHES):
+            yield int.from_bytes(blob_id[i * 4:i * 4 + 4], 'big') & self.mask
+
+    def add(self, blob_id):
+        for position in self._positions(blob_id):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, blob_id):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(blob_id))
+
+    def is_full(self):
+        return self.count * BLOOM_BITS_PER_CHUNK > self.bits
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            bits, count = struct.unpack(">QQ", f.read(16))
+            data = f.read()
+        if len(data) != bits // 8:
+            raise RepositoryError("Truncated Bloom filter")
+        return cls(bits, count, data)
+
+    def save(self, path):
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(struct.pack(">QQ", self.bits, self.count))
+            f.write(self.data)
+        os.replace(temporary, path)
+
+
+# Pack file being filled; blobs are appended as they arrive and the pack is
+# named after its own hash once complete
+class _PackWriter:
+    def __init__(self, repository):
+        self.repository = repository
+        self.temporary = os.path.join(repository.path, 'packs', f"tmp-{os.getpid()}-{id(self):x}")
+        self.f = open(self.temporary, 'wb')
+        if repository.governor is not None:
+            self.f = repository.governor.writer(self.f)
+        self.digest = hashlib.blake2b(digest_size=ID_SIZE)
+        self.offset = 0
+        self.blobs = []     # [id, offset, length, raw length]
+        self._write(PACK_MAGIC + bytes([FORMAT_VERSION]))
+
+    def _write(self, data):
+        self.f.write(data)
+        self.digest.update(data)
+        self.offset += len(data)
+
+    def add(self, blob_id, stored, raw_length):
+        self.blobs.append((blob_id, self.offset, len(stored), raw_length))
+        self._write(stored)
+
+    def finish(self):
+        table = json.dumps([[blob_id.hex(), offset, length, raw_length]
+                            for blob_id, offset, length, raw_length in self.blobs], separators=(',', ':')).encode()
+        sealed_table = self.repository.seal(table, b"pack-table")
+        self._write(sealed_table)
+        self._write(struct.pack(">Q", len(sealed_table)) + PACK_FOOTER_MAGIC)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        name = self.digest.hexdigest()
+        target = self.repository.pack_path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(self.temporary, target)
+        return name, self.offset
+
+    def discard(self):
+        self.f.close()
+        if os.path.exists(self.temporary):
+            os.remove(self.temporary)
+
+
+class Repository:
+    def __init__(self, path, password=None, codec="gzip", level=None, workers=None, metrics=None):
+        self.path = path
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        check_codec(codec, self.level)
+        self.metrics = metrics
+        self.policy = None      # CompressionPolicy told about every sealed chunk, see backup_to_repository
+        self.governor = None    # governor.Governor pacing source reads and pack writes, see backup_to_repository
+        self.workers = workers or default_workers()
+        self.lock = threading.Lock()
+        self.pack = None
+        self.session = {}       # blob id -> raw length, for blobs written (or being written) by this session
+        self.bloom = None
+        self.bloom_dirty = False
+        self.pack_handles = OrderedDict()
+        self.stats = {'chunks_new': 0, 'chunks_reused': 0, 'bytes_new': 0, 'bytes_reused': 0,
+                      'bytes_stored': 0, 'packs_written': 0, 'files_unchanged': 0}
+        self.lock_file = None
+
+        config_file = os.path.join(path, 'config.json')
+        if not os.path.exists(config_file):
+            self._initialise(config_file, password)
+        with open(config_file, 'r') as f:
+            self.config = json.load(f)
+        if self.config.get('magic') != MAGIC.decode() or self.config.get('version') != FORMAT_VERSION:
+            raise RepositoryError(f"Not a supported backup repository: {path}")
+        self._unlock(password)
+        self.chunker = Chunker(bytes.fromhex(self.config['gear_seed']), **self.config['chunker'])
+
+        self.index = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.executescript(INDEX_SCHEMA)
+
+    def _initialise(self, config_file, password):
+        for directory in ('packs', 'snapshots'):
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+        config = {
+            'magic': MAGIC.decode(),
+            'version': FORMAT_VERSION,
+            'chunker': {'min_size': MIN_CHUNK_SIZE, 'avg_size': AVG_CHUNK_SIZE, 'max_size': MAX_CHUNK_SIZE},
+            # A per-repository gear table keeps chunk boundaries from revealing file contents
+            'gear_seed': os.urandom(16).hex(),
+            'encrypted': bool(password),
+        }
+        if password:
+            salt = os.urandom(SALT_SIZE)
+            config['salt'] = salt.hex()
+            config['key_check'] = self._derive_keys(password, salt)[2].hex()
+        temporary = f"{config_file}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(config, f, indent=2)
+        os.replace(temporary, config_file)
+
+    @staticmethod
+    def _derive_keys(password, salt):
+        from stream_crypto import derive_stream_key
+        master = derive_stream_key(password, salt)
+        return tuple(hashlib.blake2b(purpose, key=master, digest_size=32).digest()
+                     for purpose in (b"encrypt", b"blob-id", b"key-check"))
+
+    def _unlock(self, password):
+        self.cipher = None
+        self.id_key = b""
+        if not self.config['encrypted']:
+            if password:
+                raise RepositoryError("This repository was created without encryption; clear the password.")
+            return
+        if not password:
+            raise RepositoryError("Password is required for decryption.")
+        encrypt_key, self.id_key, check = self._derive_keys(password, bytes.fromhex(self.config['salt']))
+        if check.hex() != self.config['key_check']:
+            raise RepositoryError("Wrong password for this repository")
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.cipher = AESGCM(encrypt_key)
+
+    def close(self):
+        for handle in self.pack_handles.values():
+            handle.close()
+        self.pack_handles.clear()
+        self.index.close()
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Writers take an exclusive lock, so two backups never fill the same repository at once
+    def acquire(self):
+        try:
+            import fcntl
+        except ImportError:
+            return  # No advisory locks on Windows
+        self.lock_file = open(os.path.join(self.path, 'lock'), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise RepositoryError("The repository is in use by another backup")
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def pack_path(self, name):
+        return os.path.join(self.path, 'packs', name[:2], name + '.pack')
+
+    def blob_id(self, data):
+        return hashlib.blake2b(data, digest_size=ID_SIZE, key=self.id_key).digest()
+
+    # Compress (unless that does not help) and, with a password, encrypt one blob
+    def seal(self, raw, aad, level=None):
+        level = self.level if level is None else level
+        with _timed(self.metrics, 'compress', len(raw)):
+            compressed = compress_block(raw, self.codec, level)
+        if len(compressed) < len(raw):
+            data = bytes([CODECS.index(self.codec) + 1]) + compressed
+        else:
+            data = b"\0" + raw
+        if self.cipher is None:
+            return data
+        with _timed(self.metrics, 'encrypt', len(data)):
+            nonce = os.urandom(NONCE_SIZE)
+            return nonce + self.cipher.encrypt(nonce, data, aad)
+
+    def unseal(self, stored, aad):
+        if self.cipher is not None:
+            from cryptography.exceptions import InvalidTag
+            with _timed(self.metrics, 'decrypt', len(stored)):
+                try:
+                    stored = self.cipher.decrypt(stored[:NONCE_SIZE], stored[NONCE_SIZE:], aad)
+                except InvalidTag:
+                    raise RepositoryError("Wrong password or corrupted repository data")
+        if not stored[0]:
+            return stored[1:]
+        with _timed(self.metrics, 'decompress', len(stored)):
+            return decompress_block(stored[1:], CODECS[stored[0] - 1])
+
+    # --- chunk index ---
+
+    def _load_bloom(self):
+        count = self._chunk_count()
+        bloom_file = os.path.join(self.path, 'index.bloom')
+        try:
+            bloom = BloomFilter.load(bloom_file)
+            if bloom.count == count and not bloom.is_full():
+                self.bloom = bloom
+                return
+        except (OSError, struct.error, RepositoryError):
+            pass
+        self._rebuild_bloom(count)
+
+    def _rebuild_bloom(self, count=None):
+        count = self._chunk_count() if count is None else count
+        self.bloom = BloomFilter.sized_for(count)
+        for (blob_id,) in self.index.execute("SELECT hash FROM chunks"):
+            self.bloom.add(blob_id)
+        self.bloom_dirty = True
+
+    def _chunk_count(self):
+        row = self.index.execute("SELECT value FROM info WHERE key = 'chunks'").fetchone()
+        return row[0] if row else 0
+
+    def _lookup(self, blob_id):
+        return self.index.execute(
+            "SELECT packs.name, chunks.offset, chunks.length, chunks.raw_length FROM chunks "
+            "JOIN packs ON packs.id = chunks.pack WHERE chunks.hash = ?", (blob_id,)).fetchone()
+
+    def has_blob(self, blob_id):
+        if blob_id in self.session:
+            return True
+        if self.bloom is None:
+            self._load_bloom()
+        if blob_id not in self.bloom:
+            return False
+        return self._lookup(blob_id) is not None
+
+    # Store a blob unless the repository already has it; returns True if it was new.
+    # Safe to call from several threads: sealing runs unlocked, index and pack updates locked.
+    def store(self, blob_id, raw, level=None, aad=None):
+        with self.lock:
+            if self.has_blob(blob_id):
+                self.stats['chunks_reused'] += 1
+                self.stats['bytes_reused'] += len(raw)
+                return False
+            self.session[blob_id] = len(raw)
+        cpu_start = time.thread_time()
+        stored = self.seal(raw, blob_id if aad is None else aad, level)
+        if self.policy is not None and level is not None:
+            self.policy.record_block(level, len(raw), time.thread_time() - cpu_start)
+        with self.lock:
+            if self.pack is None:
+                self.pack = _PackWriter(self)
+            with _timed(self.metrics, 'write', len(stored)):
+                self.pack.add(blob_id, stored, len(raw))
+            self.stats['chunks_new'] += 1
+            self.stats['bytes_new'] += len(raw)
+            self.stats['bytes_stored'] += len(stored)
+            if self.pack.offset >= PACK_SIZE:
+                self._finish_pack()
+        return True
+
+    # Called with the lock held: the pack is made durable before the index refers to it
+    def _finish_pack(self):
+        pack, self.pack = self.pack, None
+        with _timed(self.metrics, 'write', 0):
+            name, size = pack.finish()
+        with self.index:
+            cursor = self.index.execute("INSERT OR IGNORE INTO packs (name, size) VALUES (?, ?)", (name, size))
+            pack_id = cursor.lastrowid or self.index.execute(
+                "SELECT id FROM packs WHERE name = ?", (name,)).fetchone()[0]
+            self.index.executemany(
+                "INSERT OR IGNORE INTO chunks (hash, pack, offset, length, raw_length) VALUES (?, ?, ?, ?, ?)",
+                [(blob_id, pack_id, offset, length, raw_length) for blob_id, offset, length, raw_length in pack.blobs])
+            self.index.execute("INSERT INTO info (key, value) VALUES ('chunks', ?) ON CONFLICT (key) "
+                               "DO UPDATE SET value = (SELECT COUNT(*) FROM chunks)", (len(pack.blobs),))
+        for blob_id, _, _, _ in pack.blobs:
+            self.bloom.add(blob_id)
+        self.bloom_dirty = True
+        self.stats['packs_written'] += 1
+
+    # Finish the open pack and persist the Bloom filter; everything stored so far is then durable
+    def flush(self):
+        with self.lock:
+            if self.pack is not None:
+                self._finish_pack()
+            if self.bloom is not None and self.bloom_dirty:
+                if self.bloom.is_full() or self.bloom.count != self._chunk_count():
+                    self._rebuild_bloom()
+                self.bloom.save(os.path.join(self.path, 'index.bloom'))
+                self.bloom_dirty = False
+
+    # Drop the pack being written; packs already finished stay usable by the next run
+    def abort(self):
+        with self.lock:
+            if self.pack is not None:
+                self.pack.discard()
+                self.pack = None
+        self.flush()
+
+    # --- reading ---
+
+    def _pack_handle(self, name):
+        handle = self.pack_handles.pop(name, None)
+        if handle is None:
+            handle = open(self.pack_path(name), 'rb')
+            if len(self.pack_handles) >= PACK_CACHE:
+                self.pack_handles.popitem(last=False)[1].close()
+        self.pack_handles[name] = handle
+        return handle
+
+    def load_blob(self, blob_id):
+        location = self._lookup(blob_id)
+        if location is None:
+            raise RepositoryError(f"Blob {blob_id.hex()} is missing from the repository")
+        name, offset, length, raw_length = location
+        with _timed(self.metrics, 'read', length):
+            handle = self._pack_handle(name)
+            handle.seek(offset)
+            stored = handle.read(length)
+        raw = self.unseal(stored, blob_id)
+        if len(raw) != raw_length or self.blob_id(raw) != blob_id:
+            raise RepositoryError(f"Blob {blob_id.hex()} in pack {name} is corrupted")
+        return raw
+
+    def load_tree(self, tree_id):
+        return json.loads(self.load_blob(bytes.fromhex(tree_id)))['entries']
+
+    def store_tree(self, entries):
+        data = json.dumps({'entries': entries}, sort_keys=True, separators=(',', ':')).encode()
+        blob_id = self.blob_id(data)
+        self.store(blob_id, data)
+        return blob_id.hex()
+
+    # --- snapshots ---
+
+    def snapshot_names(self):
+        directory = os.path.join(self.path, 'snapshots')
+        return sorted(name for name in os.listdir(directory)
+                      if name.endswith(SNAPSHOT_EXTENSION) or name.endswith(SNAPSHOT_EXTENSION + '.enc'))
+
+    def write_snapshot(self, name, snapshot):
+        data = json.dumps(snapshot, sort_keys=True, separators=(',', ':')).encode()
+        flags = 1 if self.cipher is not None else 0
+        target = os.path.join(self.path, 'snapshots', name)
+        temporary = target + '.part'
+        with open(temporary, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + bytes([FORMAT_VERSION, flags]) + self.seal(data, b"snapshot"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, target)
+        return target
+
+    def read_snapshot(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise RepositoryError(f"Not a repository snapshot: {path}")
+        version = data[len(SNAPSHOT_MAGIC)]
+        if version != FORMAT_VERSION:
+            raise RepositoryError(f"Unsupported snapshot format version {version}")
+        return json.loads(self.unseal(data[len(SNAPSHOT_MAGIC) + 2:], b"snapshot"))
+
+    # Newest snapshot of the same source set, whose trees let unchanged files skip reading
+    def latest_snapshot(self, source_set):
+        for name in reversed(self.snapshot_names()):
+            snapshot = self.read_snapshot(os.path.join(self.path, 'snapshots', name))
+            if snapshot['source_set'] == source_set:
+                return snapshot
+        return None
+
+    # Yield (path, node) for every entry below `tree_id`, depth first, paths relative to the tree
+    def walk(self, tree_id, prefix=''):
+        for node in self.load_tree(tree_id):
+            path = f"{prefix}{node['name']}"
+            yield path, node
+            if node['type'] == 'dir':
+                yield from self.walk(node['tree'], path + '/')
+
+    # Entries of every source in a snapshot, named like tar members: <source folder>/<path>
+    def snapshot_entries(self, snapshot):
+        for source in snapshot['sources']:
+            root = source['name']
+            yield root, {'name': root, 'type': 'dir', 'tree': source['tree'], **source['meta']}
+            yield from self.walk(source['tree'], root + '/')
+
+    # Ids (hex) of every tree and chunk that `snapshots` use; loading the trees verifies them
+    def referenced_blobs(self, snapshots):
+        referenced = set()
+        for snapshot in snapshots:
+            pending = [source['tree'] for source in snapshot['sources']]
+            while pending:
+                tree_id = pending.pop()
+                if tree_id in referenced:
+                    continue  # Unchanged subtree shared with a snapshot already walked
+                referenced.add(tree_id)
+                for node in self.load_tree(tree_id):
+                    if node['type'] == 'dir':
+                        pending.append(node['tree'])
+                    elif node['type'] == 'file':
+                        referenced.update(node['chunks'])
+        return referenced
+
+    # --- verification ---
+
+    # Where the blobs `blob_ids` (hex) are stored: {pack name: [(id, offset, length, raw length)]},
+    # plus the ids the index does not know
+    def blob_locations(self, blob_ids):
+        packs = {}
+        found = set()
+        wanted = [bytes.fromhex(blob_id) for blob_id in blob_ids]
+        # Looked up in batches, so the cost follows the snapshot's size rather than the index's
+        for start in range(0, len(wanted), LOOKUP_BATCH):
+            batch = wanted[start:start + LOOKUP_BATCH]
+            for blob_id, name, offset, length, raw_length in self.index.execute(
+                    "SELECT chunks.hash, packs.name, offset, length, raw_length FROM chunks "
+                    f"JOIN packs ON packs.id = chunks.pack WHERE chunks.hash IN ({','.join('?' * len(batch))})",
+                    batch):
+                packs.setdefault(name, []).append((blob_id, offset, length, raw_length))
+                found.add(blob_id.hex())
+        return packs, set(blob_ids) - found
+
+    # Check a pack file against its name, the BLAKE2b of its contents, and decode `blobs` from it.
+    # Safe to call from several threads. Returns (problems, bytes read).
+    def verify_pack(self, name, blobs=()):
+        try:
+            with open(self.pack_path(name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return [f"pack {name} is missing"], 0
+        problems = []
+        if hashlib.blake2b(data, digest_size=ID_SIZE).hexdigest() != name:
+            problems.append(f"pack {name} is corrupted")
+        for blob_id, offset, length, raw_length in blobs:
+            try:
+                raw = self.unseal(data[offset:offset + length], blob_id)
+            except Exception as e:
+                problems.append(f"blob {blob_id.hex()} in pack {name} cannot be decoded: {e}")
+                continue
+            if len(raw) != raw_length or self.blob_id(raw) != blob_id:
+                problems.append(f"blob {blob_id.hex()} in pack {name} is corrupted")
+        return problems, len(data)
+
+    # --- garbage collection ---
+
+    # Delete packs no snapshot references any more; returns (packs removed, bytes freed).
+    # Packs that are only partly referenced are kept whole.
+    def garbage_collect(self):
+        referenced = self.referenced_blobs(self.read_snapshot(os.path.join(self.path, 'snapshots', name))
+                                           for name in self.snapshot_names())
+
+        removed = freed = 0
+        live_packs = set()
+        for pack_id, blob_id in self.index.execute("SELECT pack, hash FROM chunks"):
+            if blob_id.hex() in referenced:
+                live_packs.add(pack_id)
+        for pack_id, name, size in self.index.execute("SELECT id, name, size FROM packs").fetchall():
+            if pack_id in live_packs:
+                continue
+            with self.index:
+                self.index.execute("DELETE FROM chunks WHERE pack = ?", (pack_id,))
+                self.index.execute("DELETE FROM packs WHERE id = ?", (pack_id,))
+                self.index.execute("UPDATE info SET value = (SELECT COUNT(*) FROM chunks) WHERE key = 'chunks'")
+            handle = self.pack_handles.pop(name, None)
+            if handle is not None:
+                handle.close()
+            if os.path.exists(self.pack_path(name)):
+                os.remove(self.pack_path(name))
+            removed += 1
+            freed += size
+        if removed:
+            with self.lock:
+                self._rebuild_bloom()
+            self.flush()
+        return removed, freed
+
+    # Rebuild index.db from the pack tables, e.g. after the index was lost
+    def rebuild_index(self):
+        with self.index:
+            self.index.execute("DELETE FROM chunks")
+            self.index.execute("DELETE FROM packs")
+            for directory, _, names in os.walk(os.path.join(self.path, 'packs')):
+                for name in names:
+                    if not name.endswith('.pack'):
+                        continue
+                    path = os.path.join(directory, name)
+                    with open(path, 'rb') as f:
+                        f.seek(-(8 + len(PACK_FOOTER_MAGIC)), os.SEEK_END)
+                        footer = f.read()
+                        if not footer.endswith(PACK_FOOTER_MAGIC):
+                            continue  # Incomplete pack from an interrupted run
+                        table_length = struct.unpack(">Q", footer[:8])[0]
+                        f.seek(-(8 + len(PACK_FOOTER_MAGIC) + table_length), os.SEEK_END)
+                        table = json.loads(self.unseal(f.read(table_length), b"pack-table"))
+                    cursor = self.index.execute("INSERT INTO packs (name, size) VALUES (?, ?)",
+                                                (name[:-len('.pack')], os.path.getsize(path)))
+                    self.index.executemany(
+                        "INSERT OR IGNORE INTO chunks (hash, pack, offset, length, raw_length) VALUES (?, ?, ?, ?, ?)",
+                        [(bytes.fromhex(blob_id), cursor.lastrowid, offset, length, raw_length)
+                         for blob_id, offset, length, raw_length in table])
+            self.index.execute("INSERT INTO info (key, value) VALUES ('chunks', (SELECT COUNT(*) FROM chunks)) "
+                               "ON CONFLICT (key) DO UPDATE SET value = excluded.value")
+        with self.lock:
+            self._rebuild_bloom()
+        self.flush()
+
+
+def _node_meta(st):
+    return {'mode': stat.S_IMODE(st.st_mode), 'mtime_ns': st.st_mtime_ns, 'uid': st.st_uid, 'gid': st.st_gid}
+
+
+# One backup of `source_dirs` into `repository` as a new snapshot.
+#
+# Files are chunked and stored on a thread pool (hashing, compression and
+# encryption all release the GIL) while the scan continues; directories are
+# turned into tree blobs bottom-up once all their files are stored. Returns
+# (snapshot path, {source: [ScannedFile of every non-directory]}, files).
+def backup_to_repository(repository, source_dirs, source_set, snapshot_name, scan_stats=None, progress=None,
+                         metrics=None, policy=None, governor=None):
+    parent = repository.latest_snapshot(source_set)
+    parent_roots = {source['path']: source['tree'] for source in parent['sources']} if parent else {}
+    executor = ThreadPoolExecutor(max_workers=repository.workers, thread_name_prefix='chunk')
+    cancelled = threading.Event()
+    repository.policy = policy
+    repository.governor = governor
+    pending = deque()
+    scans = {}
+    files = [0]
+
+    def store_file(abs_path, size, node):
+        chunk_ids = []
+        with open(abs_path, 'rb') as f:
+            extents = data_extents(f, os.fstat(f.fileno()))
+            if extents:
+                node['sparse'] = extents
+            level = None
+            if policy is not None:
+                with policy.lock:
+                    level = policy.select(abs_path, size, f)
+            if metrics is not None:
+                f = metrics.reader(f, 'read')
+            if governor is not None:
+                f = governor.reader(f)
+            chunks = repository.chunker.chunks(f)
+            while not cancelled.is_set():
+                # Finding the cut point and hashing the chunk are the 'chunk' stage
+                with _timed(metrics, 'chunk', 0):
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    blob_id = repository.blob_id(chunk)
+                if metrics is not None:
+                    metrics.add('chunk', nbytes=len(chunk))
+                repository.store(blob_id, chunk, level)
+                chunk_ids.append(blob_id.hex())
+        node['chunks'] = chunk_ids
+        node['size'] = size
+
+    def finish_oldest():
+        future, relative, size = pending.popleft()
+        future.result()
+        files[0] += 1
+        if progress is not None:
+            progress.advance(relative, size)
+
+    try:
+        sources = []
+        for source in source_dirs:
+            source = os.path.abspath(source)
+            scanned_files = scans[source] = []
+            parent_trees = {'.': parent_roots.get(source)}
+            parent_listings = {}
+
+            # The parent snapshot's entries in directory `relative`, loaded on first use
+            def parent_listing(relative):
+                if relative not in parent_listings:
+                    tree_id = parent_trees.get(relative)
+                    if tree_id is None and relative != '.':
+                        head, name = os.path.split(relative)
+                        node = parent_listing(head or '.').get(name)
+                        tree_id = node['tree'] if node and node['type'] == 'dir' else None
+                    parent_listings[relative] = ({node['name']: node for node in repository.load_tree(tree_id)}
+                                                 if tree_id else {})
+                return parent_listings[relative]
+
+            directories = {'.': []}
+            directory_meta = {}
+            for scanned in scan_tree(source, include_dirs=True, stats=scan_stats,
+                                     workers=governor.workers if governor is not None else None):
+                st = scanned.stat
+                head, name = os.path.split(scanned.path)
+                node = {'name': name, **_node_meta(st)}
+                if stat.S_ISDIR(st.st_mode):
+                    node['type'] = 'dir'
+                    directories.setdefault(scanned.path, [])
+                    directory_meta[scanned.path] = node
+                    files[0] += 1
+                    if progress is not None:
+                        progress.advance(scanned.path)
+                    continue
+                directories.setdefault(head or '.', []).append(node)
+                scanned_files.append(scanned)
+                if stat.S_ISLNK(st.st_mode):
+                    node['type'] = 'symlink'
+                    node['linkname'] = os.readlink(scanned.abs_path)
+                    files[0] += 1
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    directories[head or '.'].pop()  # Devices, fifos and sockets are not stored
+                    continue
+                node['type'] = 'file'
+                node['inode'] = st.st_ino
+                old = parent_listing(head or '.').get(name)
+                if (old and old['type'] == 'file' and old['size'] == st.st_size
+                        and old['mtime_ns'] == st.st_mtime_ns and old.get('inode') == st.st_ino):
+                    node['size'] = old['size']
+                    node['chunks'] = old['chunks']
+                    if 'sparse' in old:
+                        node['sparse'] = old['sparse']
+                    with repository.lock:
+                        repository.stats['files_unchanged'] += 1
+                        repository.stats['bytes_reused'] += st.st_size
+                    files[0] += 1
+                    if progress is not None:
+                        progress.advance(scanned.path, st.st_size)
+                    continue
+                pending.append((executor.submit(store_file, scanned.abs_path, st.st_size, node),
+                                scanned.path, st.st_size))
+                while pending and (pending[0][0].done() or len(pending) > repository.workers * 4):
+                    finish_oldest()
+            while pending:
+                finish_oldest()
+
+            # Children before parents, so every subtree id is known when its parent is stored
+            for relative in sorted(directories, key=lambda path: path.count('/') if path != '.' else -1,
+                                   reverse=True):
+                entries = sorted(directories[relative], key=lambda node: node['name'])
+                tree_id = repository.store_tree(entries)
+                if relative == '.':
+                    root_tree = tree_id
+                else:
+                    head = os.path.split(relative)[0] or '.'
+                    directory_meta[relative]['tree'] = tree_id
+                    directories[head].append(directory_meta[relative])
+            sources.append({'path': source, 'name': os.path.basename(source), 'tree': root_tree,
+                            'meta': _node_meta(os.stat(source))})
+
+        repository.flush()
+        snapshot = {'version': FORMAT_VERSION, 'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'source_set': source_set, 'sources': sources, 'stats': repository.stats}
+        return repository.write_snapshot(snapshot_name, snapshot), scans, files[0]
+    except BaseException:
+        cancelled.set()
+        executor.shutdown(cancel_futures=True)
+        repository.abort()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+
+def _apply_meta(target, node):
+    try:
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            os.chown(target, node['uid'], node['gid'])
+        os.chmod(target, node['mode'])
+        os.utime(target, ns=(node['mtime_ns'], node['mtime_ns']))
+    except OSError:
+        pass
+
+
+# Restore a snapshot (or the entries below `paths` in it, further filtered by
+# `predicate(path)`) into `restore_location`; returns the number of entries restored.
+# Chunks are loaded on this thread and written by a pool of `workers` (see extractor.py).
+def restore_snapshot(snapshot_path, restore_location, password=None, paths=None, predicate=None, progress=None,
+                     metrics=None, workers=None):
+    wanted = [path.strip('/') for path in paths] if paths else None
+    with Repository(snapshot_repository(snapshot_path), password, metrics=metrics) as repository:
+        snapshot = repository.read_snapshot(snapshot_path)
+        selected = []
+        for path, node in repository.snapshot_entries(snapshot):
+            if wanted and not any(path == want or path.startswith(want + '/') for want in wanted):
+                continue
+            if predicate is not None and not predicate(path):
+                continue
+            selected.append((path, node))
+        if wanted and not selected:
+            raise RepositoryError(f"No entries match: {', '.join(paths)}")
+        if progress is not None:
+            progress.add_totals(len(selected), sum(node.get('size', 0) for _, node in selected))
+
+        with RestoreWriter(restore_location, workers, metrics) as writer:
+            for path, node in selected:
+                if progress is not None:
+                    progress.check()
+                apply = lambda target, node=node: _apply_meta(target, node)
+                if node['type'] == 'dir':
+                    writer.make_directory(path, apply)
+                elif node['type'] == 'symlink':
+                    target = writer.target(path)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(node['linkname'], target)
+                else:
+                    output = writer.create(path, node['size'], node.get('sparse'))
+                    offset = 0
+                    for chunk_id in node['chunks']:
+                        chunk = repository.load_blob(bytes.fromhex(chunk_id))
+                        writer.write(output, offset, chunk)
+                        offset += len(chunk)
+                    writer.close(output, apply)
+                if progress is not None:
+                    progress.advance(path, node.get('size', 0))
+            writer.finish()
+        return len(selected)
+
+
+# Entries of a snapshot in the shape list_archive_contents returns
+def list_snapshot_contents(snapshot_path, password=None):
+    with Repository(snapshot_repository(snapshot_path), password) as repository:
+        snapshot = repository.read_snapshot(snapshot_path)
+        return [{'path': path, 'type': node['type'], 'size': node.get('size', 0), 'mtime': node['mtime_ns'] / 1e9}
+                for path, node in repository.snapshot_entries(snapshot)]
@@ -0,0 +1,317 @@
+import os
+import tarfile
+from collections import namedtuple
+from datetime import datetime
+
+import engine
+import storage
+from engine import BackupError
+from compression import open_decompressed_stream
+from manifest import BackupManifest
+from checksums import ArchiveChecksums
+from point_in_time import plan_chain_restore
+from delta import DELTA_PAX_KEY
+from extractor import SPARSE_PAX_KEY, format_extents, parse_extents
+from seekable import SeekableArchiveWriter, SeekableArchiveReader, is_seekable_archive
+from repository import is_repository_snapshot
+
+# Grandfather-father-son retention with synthetic-full compaction.
+#
+# Every successful backup is a restore point. The policy keeps the newest
+# point of each of the last `daily` days, `weekly` ISO weeks and `monthly`
+# months that have backups (and always the newest backup of a source set).
+# Within a chain (a full backup and the incrementals after it) a kept
+# incremental still needs everything before it, so expired backups are not
+# simply deleted:
+#   - a chain with no kept point is deleted whole;
+#   - expired backups after the chain's last kept point are deleted;
+#   - expired backups before a kept point are merged into it. The kept
+#     point's archive is rewritten as a synthetic full (when the merged run
+#     starts at the full backup) or as one merged incremental, by streaming
+#     the newest version of every path out of the existing archives, the
+#     same way a point-in-time restore picks them. Sources are not read. A
+#     file stored as deltas keeps its last full copy and every delta after
+#     it, in order, so the merged archive may hold a path more than once.
+# The merged archive is complete on disk before the catalog is switched to
+# it in one transaction, and old archives are removed only after that, so a
+# crash at any point leaves every chain restorable.
+RetentionPolicy = namedtuple('RetentionPolicy', ['daily', 'weekly', 'monthly'])
+
+PERIODS = (
+    ('daily', lambda moment: moment.date()),
+    ('weekly', lambda moment: moment.isocalendar()[:2]),
+    ('monthly', lambda moment: (moment.year, moment.month)),
+)
+
+
+def policy_from_config(config):
+    policy = RetentionPolicy(config['keep_daily'], config['keep_weekly'], config['keep_monthly'])
+    return policy if any(policy) else None
+
+
+# Function to choose the restore points to keep; `entries` are one source set's backups, newest first.
+# Returns {backup id: [reasons]}.
+def select_retained(entries, policy):
+    kept = {}
+    if entries:
+        kept[entries[0]['id']] = ['newest']
+    for name, period_of in PERIODS:
+        limit = getattr(policy, name)
+        periods = set()
+        for entry in entries:
+            if len(periods) >= limit:
+                break
+            period = period_of(datetime.strptime(entry['timestamp'], '%Y-%m-%d %H:%M:%S'))
+            if period not in periods:
+                periods.add(period)
+                kept.setdefault(entry['id'], []).append(name)
+    return kept
+
+
+def split_chains(entries):
+    chains = []
+    for entry in entries:
+        if entry['backup_type'] == 'Full' or not chains:
+            chains.append([])
+        chains[-1].append(entry)
+    return chains
+
+
+def _is_snapshot(entry):
+    return entry.get('details', {}).get('format') == 'repository'
+
+
+# Function to plan retention for one source set; `entries` oldest first.
+# Returns (kept ids, backups to delete, segments to merge into their last backup).
+def plan_retention(entries, policy):
+    kept = select_retained(entries[::-1], policy)
+    deletions, merges = [], []
+    for chain in split_chains(entries):
+        positions = [index for index, entry in enumerate(chain) if entry['id'] in kept]
+        if not positions:
+            deletions.extend(chain)
+            continue
+        deletions.extend(chain[positions[-1] + 1:])
+        start = 0
+        for position in positions:
+            segment = chain[start:position + 1]
+            start = position + 1
+            if len(segment) < 2:
+                continue
+            if any(_is_snapshot(entry) for entry in segment):
+                # Repository snapshots share their chunks and cannot be merged; keep the run whole
+                for entry in segment:
+                    kept.setdefault(entry['id'], ['needed by a later backup'])
+                continue
+            merges.append(segment)
+    return kept, deletions, merges
+
+
+def _member_meta(member):
+    kind = ('dir' if member.isdir() else 'symlink' if member.issym() else
+            'delta' if DELTA_PAX_KEY in member.pax_headers else 'file')
+    meta = {'path': member.name.rstrip('/'), 'type': kind, 'mode': member.mode, 'mtime': member.mtime,
+            'uid': member.uid, 'gid': member.gid, 'linkname': member.linkname}
+    if SPARSE_PAX_KEY in member.pax_headers:
+        meta['sparse'] = parse_extents(member.pax_headers[SPARSE_PAX_KEY])
+    return meta
+
+
+def _entry_tarinfo(entry):
+    tarinfo = tarfile.TarInfo(entry['path'])
+    tarinfo.mode = entry['mode']
+    tarinfo.mtime = entry['mtime']
+    tarinfo.uid, tarinfo.gid = entry['uid'], entry['gid']
+    tarinfo.uname, tarinfo.gname = engine.lookup_owner_names(entry['uid'], entry['gid'])
+    if entry['type'] == 'dir':
+        tarinfo.type = tarfile.DIRTYPE
+    elif entry['type'] == 'symlink':
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = entry['linkname']
+    else:
+        tarinfo.size = entry['size']
+        if entry['type'] == 'delta':
+            tarinfo.pax_headers = {DELTA_PAX_KEY: '1'}
+        elif entry.get('sparse'):
+            tarinfo.pax_headers = {SPARSE_PAX_KEY: format_extents(entry['sparse'])}
+    return tarinfo
+
+
+# Function to stream the members of one archive accepted by `predicate(name)` into `archive`;
+# returns the number of members copied
+def copy_members(backup_path, password, archive, predicate, progress=None):
+    copied = 0
+    seekable_output = isinstance(archive, SeekableArchiveWriter)
+    if is_seekable_archive(backup_path):
+        with SeekableArchiveReader(backup_path, password) as reader:
+            for entry in reader.entries:
+                if not predicate(entry['path']):
+                    continue
+                fileobj = reader.open_entry(entry) if entry['type'] in ('file', 'delta') else None
+                if seekable_output:
+                    archive.add_entry(entry, fileobj)
+                else:
+                    archive.addfile(_entry_tarinfo(entry), fileobj)
+                copied += 1
+                if progress is not None:
+                    progress.advance(entry['path'], entry.get('size', 0))
+        return copied
+
+    with engine.open_backup_for_reading(backup_path, password) as stream:
+        with tarfile.open(fileobj=open_decompressed_stream(stream), mode="r|") as tar:
+            for member in tar:
+                name = member.name.rstrip('/')
+                if not predicate(name):
+                    continue
+                fileobj = tar.extractfile(member) if member.isreg() else None
+                if seekable_output:
+                    if not (member.isreg() or member.isdir() or member.issym()):
+                        continue  # Seekable archives do not store devices or fifos
+                    archive.add_entry(_member_meta(member), fileobj)
+                else:
+                    archive.addfile(member, fileobj)
+                copied += 1
+                if progress is not None:
+                    progress.advance(name, member.size if member.isreg() else 0)
+    return copied
+
+
+def _merged_file_name(target, backup_type, archive_format, codec):
+    stamp = datetime.strptime(target['timestamp'], '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d_%H%M%S')
+    kind = 'synthetic' if backup_type == 'Full' else 'merged'
+    extension = '.abx' if archive_format == 'seekable' else engine.EXTENSIONS[codec]
+    name = f"backup_{stamp}_{kind}{extension}"
+    suffix = 1
+    while any(storage.exists(storage.join(target['backup_location'], candidate))
+              for candidate in (name, name + '.enc')):
+        suffix += 1
+        name = f"backup_{stamp}_{kind}{suffix}{extension}"
+    return name
+
+
+def _archive_settings(backup_path):
+    if is_seekable_archive(backup_path):
+        return 'seekable', None
+    return 'tar', 'zstd' if '.tar.zst' in os.path.basename(backup_path) else 'gzip'
+
+
+# Function to merge consecutive backups of one chain into the last of them. The
+# merged archive keeps the last backup's id and timestamp; it becomes a synthetic
+# full if the segment starts with the full backup. Returns the updated catalog entry.
+def merge_segment(segment, password=None, progress=None):
+    target = segment[-1]
+    paths = [engine.get_backup_path(entry) for entry in segment]
+    for entry, backup_path in zip(segment, paths):
+        if not storage.exists(backup_path):
+            raise BackupError(f"Backup file does not exist: {backup_path}")
+        if is_repository_snapshot(backup_path):
+            raise BackupError("Repository snapshots cannot be merged with other backups.")
+        if entry['encrypted'] and not password:
+            raise BackupError("Password is required to merge encrypted backups.")
+
+    backup_type = 'Full' if segment[0]['backup_type'] == 'Full' else 'Incremental'
+    archive_format, codec = _archive_settings(paths[-1])
+    if codec is None:
+        with SeekableArchiveReader(paths[-1], password if target['encrypted'] else None) as reader:
+            codec = reader.codec
+    backup_file = _merged_file_name(target, backup_type, archive_format, codec)
+    output_password = password if target['encrypted'] else None
+    backup_path = storage.join(target['backup_location'], backup_file + ('.enc' if output_password else ''))
+
+    plan, excluded = plan_chain_restore(segment, password)
+    members = 0
+    checksums = ArchiveChecksums()
+    with engine.open_backup_for_writing(backup_path, output_password, codec, None, archive_format,
+                                        checksums=checksums) as archive:
+        for (entry, winners), source_path in zip(plan, paths):
+            if winners is None:
+                predicate = lambda name: name not in excluded
+            elif not winners:
+                continue
+            else:
+                predicate = winners.__contains__
+            if progress is not None:
+                progress.check()
+            members += copy_members(source_path, password if entry['encrypted'] else None, archive, predicate,
+                                    progress)
+
+    details = dict(target['details'], format=archive_format, checksums=checksums.summary(), synthetic={
+        'merged': [entry['backup_file'] for entry in segment],
+        'members': members,
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    recorded_file = os.path.basename(backup_path)
+    with engine.open_catalog() as catalog:
+        merged = catalog.merge_backups(target['id'], [entry['id'] for entry in segment[:-1]], recorded_file,
+                                       backup_type, storage.size(backup_path), details, checksums)
+    with BackupManifest(engine.MANIFEST_FILE) as manifest:
+        manifest.merge_runs([entry['backup_file'] for entry in segment], recorded_file, backup_type)
+    # Only now that the catalog points at the merged archive are the old ones removed
+    for backup_path in paths:
+        if storage.exists(backup_path):
+            storage.remove(backup_path)
+    return merged
+
+
+# Function to find the backup that depends on `entry`: the next backup of its chain, if any
+def chain_successor(entry):
+    with engine.open_catalog() as catalog:
+        for later in catalog.iter_backups(since=entry['timestamp'], source_set=entry['source_set'], status='success'):
+            if (later['timestamp'], later['id']) > (entry['timestamp'], entry['id']):
+                return later if later['backup_type'] == 'Incremental' else None
+    return None
+
+
+# Function to fold a backup into the incremental that depends on it, so deleting it
+# breaks no chain. Returns the merged successor, or None if nothing depends on it.
+def fold_into_successor(entry, password=None, progress=None):
+    successor = chain_successor(entry)
+    if successor is None:
+        return None
+    return merge_segment([entry, successor], password, progress)
+
+
+def _delete_backups(entries):
+    with engine.open_catalog() as catalog:
+        for entry in entries:
+            catalog.delete_backup(entry['id'])
+    with BackupManifest(engine.MANIFEST_FILE) as manifest:
+        manifest.forget_runs([entry['backup_file'] for entry in entries])
+    freed = 0
+    for entry in entries:
+        backup_path = engine.get_backup_path(entry)
+        if storage.exists(backup_path):
+            freed += storage.size(backup_path)
+            storage.remove(backup_path)
+    return freed
+
+
+# Function to apply `policy` to every source set (or only `source_set`). With `dry_run`
+# nothing is changed. Returns a summary of what was (or would be) kept, merged and deleted.
+def apply_retention(policy, password=None, source_set=None, dry_run=False, progress=None):
+    summary = {'kept': 0, 'deleted': [], 'merged': [], 'bytes_freed': 0, 'repository_packs_removed': 0}
+    with engine.open_catalog() as catalog:
+        source_sets = [source_set] if source_set is not None else catalog.source_sets()
+        plans = [plan_retention(list(catalog.iter_backups(source_set=name, status='success')), policy)
+                 for name in source_sets]
+
+    repositories = set()
+    for kept, deletions, merges in plans:
+        summary['kept'] += len(kept)
+        summary['deleted'] += [entry['backup_file'] for entry in deletions]
+        summary['merged'] += [{'into': segment[-1]['backup_file'], 'backups': len(segment)} for segment in merges]
+        if dry_run:
+            continue
+        for segment in merges:
+            before = sum(storage.size(engine.get_backup_path(entry)) for entry in segment)
+            merged = merge_segment(segment, password, progress)
+            summary['bytes_freed'] += before - merged['size']
+        summary['bytes_freed'] += _delete_backups(deletions)
+        repositories.update(entry['backup_location'] for entry in deletions if _is_snapshot(entry))
+
+    # Deleted snapshots only free space once their unreferenced packs are collected
+    for backup_dir in sorted(repositories):
+        removed, freed = engine.collect_repository_garbage(backup_dir, password)
+        summary['repository_packs_removed'] += removed
+        summary['bytes_freed'] += freed
+    return summary
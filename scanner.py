@@ -0,0 +1,159 @@
+import os
+import time
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Parallel directory scanner built on os.scandir.
+#
+# Each directory is listed by one task on a thread pool and its
+# subdirectories are submitted as new tasks, so independent subtrees are
+# walked concurrently (a big win on network filesystems, where every listing
+# and stat is a round trip). The file type comes from the DirEntry for free,
+# every entry is stat'ed at most once, and that stat result travels with the
+# entry so the manifest and the archiver never stat the file again. Entries
+# are handed to the consumer through a bounded queue as soon as they are
+# found, so archiving starts while the scan is still running.
+#
+# A source that cannot be listed fails the scan. Anything below it that
+# cannot be read is skipped and its absolute path is recorded in
+# ScanStats.unreadable: its files were not seen, which does not mean they
+# were deleted (see BackupManifest.diff).
+ScannedFile = namedtuple('ScannedFile', ['path', 'abs_path', 'stat'])
+
+DEFAULT_QUEUE_SIZE = 10000
+_DONE = object()
+
+
+def default_scan_workers():
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+# Per-run scan statistics
+class ScanStats:
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.unreadable = []    # absolute paths of directories and entries that could not be read
+        self.stat_calls = 0
+        self.stat_calls_saved = 0
+        self.elapsed = 0.0
+        self.cpu = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'files': self.files,
+            'dirs': self.dirs,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'unreadable': len(self.unreadable),
+            'stat_calls': self.stat_calls,
+            'stat_calls_saved': self.stat_calls_saved,
+            'seconds': round(self.elapsed, 3),
+            'cpu_seconds': round(self.cpu, 3),
+            'files_per_second': round(self.files_per_second, 1),
+        }
+
+
+# Walk `source` concurrently and yield a ScannedFile for every file (and directory, if asked).
+# Raises OSError if `source` itself cannot be listed.
+def scan_tree(source, include_dirs=False, workers=None, stats=None, queue_size=DEFAULT_QUEUE_SIZE):
+    stats = stats if stats is not None else ScanStats()
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    pending = [0]
+    finished_at = [None]
+    failure = [None]
+    pending_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=workers or default_scan_workers(), thread_name_prefix='scan')
+
+    def emit(item):
+        # Block while the consumer catches up, but give up if it went away
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def submit(directory):
+        with pending_lock:
+            pending[0] += 1
+        executor.submit(walk_directory, directory)
+
+    def walk_directory(directory):
+        files = dirs = size = stat_calls = errors = 0
+        unreadable = []
+        cpu_start = time.thread_time()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if stop.is_set():
+                        break
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if is_dir and not include_dirs:
+                            submit(entry.path)
+                            dirs += 1
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        stat_calls += 1
+                    except OSError:
+                        errors += 1  # Vanished or unreadable while scanning
+                        unreadable.append(entry.path)
+                        continue
+                    if is_dir:
+                        submit(entry.path)
+                        dirs += 1
+                    else:
+                        files += 1
+                        size += st.st_size
+                    emit(ScannedFile(os.path.relpath(entry.path, source).replace(os.sep, '/'), entry.path, st))
+        except OSError as e:
+            errors += 1
+            if directory == source:
+                failure[0] = e
+            else:
+                unreadable.append(directory)
+        finally:
+            with stats.lock:
+                stats.unreadable += unreadable
+                stats.files += files
+                stats.dirs += dirs
+                stats.bytes += size
+                stats.stat_calls += stat_calls
+                stats.errors += errors
+                stats.cpu += time.thread_time() - cpu_start
+            with pending_lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                finished_at[0] = time.perf_counter()
+                emit(_DONE)
+
+    started = time.perf_counter()
+    try:
+        if include_dirs:
+            st = os.lstat(source)
+            stats.stat_calls += 1
+            yield ScannedFile('.', source, st)
+        submit(source)
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            yield item
+        if failure[0] is not None:
+            raise failure[0]
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        stats.elapsed += (finished_at[0] or time.perf_counter()) - started
@@ -0,0 +1,440 @@
+import os
+import sys
+import time
+import queue
+import shlex
+import sqlite3
+import platform
+import threading
+import subprocess
+import configparser
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import engine
+import storage
+from engine import BackupError, BackupCancelled, BackupRunning
+from catalog import make_source_set
+from jobs import JobProgress
+
+# Built-in scheduler for unattended backups.
+#
+# Every source set is its own job with its own interval, defined in a
+# [job:<name>] section of user_config.ini:
+#
+#   [job:photos]
+#   source_dirs = /home/me/Pictures
+#   backup_dir = s3://backups/photos
+#   interval = weekly          # hourly, daily, weekly, monthly or 30m, 6h, 2d, 1w
+#   type = incremental         # or full
+#   catch_up = true            # run once after downtime instead of waiting for the next slot
+#
+# The GUI adds one such job for the selected directories when an incremental
+# backup is scheduled; other jobs are added by editing the file.
+#
+# `backup.py schedule` runs the scheduler as a daemon; `--once` starts what is
+# due, waits for it and exits, which is what the cron line or Windows task
+# installed by the GUI runs every few minutes. Due jobs run in parallel on
+# threads of this process, at most `max_concurrent_jobs` in total and at most
+# `max_jobs_per_destination` per destination disk (or remote host), so source
+# sets backed up to the same disk do not fight over it.
+#
+# A job is due `interval` after its last run started. When the scheduler was
+# down for a while, a job whose slot passed runs as soon as it is back (once,
+# however many slots were missed), or, with `catch_up = false`, at its next
+# slot; the missed runs are counted in the job's state. Runs that failed, were
+# cancelled or found the source set locked are retried after RETRY_DELAY.
+# Overlapping runs are prevented by lock files: one scheduler per machine, and
+# one backup per source set whoever started it (see engine.lock_source_set).
+# Job state lives in an SQLite file so restarts know when each job last ran.
+SCHEDULER_STATE_FILE = os.path.join(engine.APP_DIR, 'scheduler_state.db')
+SCHEDULER_LOCK = os.path.join(engine.LOCK_DIR, 'scheduler.lock')
+JOB_SECTION = 'job:'
+TICK = 60.0                 # longest sleep between checks for due jobs
+MISSED_AFTER = 300.0        # a run starting this late missed its slot
+RETRY_DELAY = 30 * 60.0
+TRIGGER_MINUTES = 15        # how often the installed cron line or task runs `schedule --once`
+TRIGGER_TASK = 'BackupScheduler'
+INTERVALS = {'hourly': 3600, 'daily': 86400, 'weekly': 7 * 86400, 'monthly': 30 * 86400}
+UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    source_set TEXT,
+    status TEXT,
+    error TEXT,
+    pid INTEGER,
+    last_run REAL,
+    last_success REAL,
+    last_backup_id INTEGER,
+    retry_at REAL,
+    runs INTEGER NOT NULL DEFAULT 0,
+    missed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+Job = namedtuple('Job', 'name source_dirs backup_dir interval backup_type archive_format catch_up enabled')
+
+
+class SchedulerError(ValueError):
+    pass
+
+
+# Function to turn 'daily', 'Weekly', '6h' or '90m' into seconds
+def parse_interval(value):
+    text = str(value).strip().lower()
+    if text in INTERVALS:
+        return INTERVALS[text]
+    try:
+        seconds = float(text[:-1]) * UNITS[text[-1]] if text[-1:] in UNITS else float(text) * 3600
+    except ValueError:
+        seconds = 0
+    if seconds < 60:
+        raise SchedulerError(f"Not a schedule interval: {value!r} (use hourly, daily, weekly, monthly or e.g. 6h)")
+    return seconds
+
+
+def format_interval(seconds):
+    for name, length in INTERVALS.items():
+        if seconds == length:
+            return name
+    for unit, length in sorted(UNITS.items(), key=lambda item: -item[1]):
+        if seconds % length == 0:
+            return f"{int(seconds // length)}{unit}"
+    return f"{seconds:.0f}s"
+
+
+# Function to read the jobs defined in the config file
+def load_jobs(config_file=engine.CONFIG_FILE):
+    parser = configparser.ConfigParser()
+    parser.read(config_file)
+    config = engine.load_config(config_file)
+    jobs = []
+    for section in parser.sections():
+        if not section.startswith(JOB_SECTION):
+            continue
+        values = parser[section]
+        name = section[len(JOB_SECTION):]
+        backup_type = values.get('type', 'incremental').strip().capitalize()
+        if backup_type not in ('Full', 'Incremental'):
+            raise SchedulerError(f"Job {name}: type must be full or incremental")
+        jobs.append(Job(name, engine.split_source_dirs(values.get('source_dirs', '')),
+                        values.get('backup_dir', config['backup_dir']), parse_interval(values.get('interval', 'daily')),
+                        backup_type, values.get('archive_format', config['archive_format']),
+                        parser.getboolean(section, 'catch_up', fallback=True),
+                        parser.getboolean(section, 'enabled', fallback=True)))
+    for job in jobs:
+        if not job.source_dirs or not job.backup_dir:
+            raise SchedulerError(f"Job {job.name} needs source_dirs and backup_dir")
+    return jobs
+
+
+# Function to name the job of a set of source directories, e.g. 'Pictures+Documents'
+def job_name(source_dirs):
+    return '+'.join(os.path.basename(os.path.abspath(source)) or 'root' for source in source_dirs)
+
+
+# Function to add or update job `name` in the config file; returns True if anything changed
+def save_job(name, source_dirs, backup_dir, interval, backup_type='incremental', config_file=engine.CONFIG_FILE):
+    parse_interval(interval)
+    parser = configparser.ConfigParser()
+    parser.read(config_file)
+    section = JOB_SECTION + name
+    values = {'source_dirs': '; '.join(source_dirs), 'backup_dir': backup_dir, 'interval': str(interval).lower(),
+              'type': backup_type.lower()}
+    if section in parser and all(parser[section].get(key) == value for key, value in values.items()):
+        return False
+    parser.read_dict({section: values})
+    with open(config_file, 'w') as f:
+        parser.write(f)
+    return True
+
+
+# Function to remove job `name` from the config file; returns True if it existed
+def remove_job(name, config_file=engine.CONFIG_FILE):
+    parser = configparser.ConfigParser()
+    parser.read(config_file)
+    if not parser.remove_section(JOB_SECTION + name):
+        return False
+    with open(config_file, 'w') as f:
+        parser.write(f)
+    return True
+
+
+# Function to tell which destinations compete for the same disk or host
+def destination_key(backup_dir):
+    if storage.is_remote(backup_dir):
+        parts = urlsplit(backup_dir)
+        return f"{parts.scheme}://{parts.netloc}"
+    try:
+        return f"device {os.stat(backup_dir).st_dev}"
+    except OSError:
+        return os.path.abspath(backup_dir)
+
+
+class SchedulerState:
+    def __init__(self, path=SCHEDULER_STATE_FILE):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get(self, name):
+        cursor = self.conn.execute("SELECT * FROM jobs WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def rows(self):
+        cursor = self.conn.execute("SELECT * FROM jobs ORDER BY name")
+        columns = [column[0] for column in cursor.description]
+        return {row[0]: dict(zip(columns, row)) for row in cursor}
+
+    # Runs a scheduler left 'running' when it stopped without finishing them are retried at once
+    def recover(self):
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET status = 'interrupted', retry_at = ? WHERE status = 'running'",
+                              (time.time(),))
+
+    def started(self, job, now, missed):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (name, source_set, status, pid, last_run, missed) VALUES (?, ?, 'running', ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET source_set = excluded.source_set, status = 'running', error = NULL, "
+                "pid = excluded.pid, last_run = excluded.last_run, retry_at = NULL, missed = missed + excluded.missed",
+                (job.name, make_source_set(job.source_dirs), os.getpid(), now, missed))
+
+    def finished(self, name, status, error=None, backup_id=None, retry_at=None):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, pid = NULL, retry_at = ?, runs = runs + 1, "
+                "last_success = CASE WHEN ? = 'success' THEN ? ELSE last_success END, "
+                "last_backup_id = COALESCE(?, last_backup_id) WHERE name = ?",
+                (status, error, retry_at, status, time.time(), backup_id, name))
+
+
+# Function to tell when `job` is next due, given its state `row`, and how many slots it missed by `now`
+def next_run(job, row, now):
+    if row is None or row['last_run'] is None:
+        return now, 0   # Never ran
+    due = row['last_run'] + job.interval
+    if row['retry_at'] is not None:
+        due = min(due, row['retry_at'])
+    missed = max(int((now - row['last_run']) // job.interval) - 1, 0)
+    if now - due > MISSED_AFTER and not job.catch_up:
+        # Skip to the next slot on the job's grid
+        due = row['last_run'] + job.interval * (int((now - row['last_run']) // job.interval) + 1)
+    return due, missed
+
+
+# Function to run one scheduled job like `backup.py run` would, including the retention policy
+def run_job(job, config, password=None, progress=None):
+    from governor import governor_from_config
+    from retention import policy_from_config, apply_retention
+    if config['encryption_enabled'] and not password:
+        raise BackupError("Encryption is enabled; provide --password-file or set BACKUP_PASSWORD for the scheduler.")
+    codec = config['compression']
+    entry = engine.run_backup(job.source_dirs, job.backup_dir, job.backup_type, password=password, codec=codec,
+                              level=config['compression_level'], hash_files=config['content_hash'],
+                              archive_format=job.archive_format, progress=progress,
+                              metrics_export=config['metrics_export'], adaptive=config['adaptive_compression'],
+                              governor=governor_from_config(config), delta_min_size=config['delta_min_size'])
+    policy = policy_from_config(config)
+    if policy:
+        apply_retention(policy, password, source_set=entry['source_set'])
+    return entry
+
+
+class Scheduler:
+    def __init__(self, password=None, config_file=engine.CONFIG_FILE, state_file=SCHEDULER_STATE_FILE, log=None):
+        self.password = password
+        self.config_file = config_file
+        self.state_file = state_file
+        self.log = log or (lambda message: None)
+        self.jobs = {}
+        self.config = None
+        self.config_mtime = None
+        self.running = {}           # name -> (thread, progress, destination)
+        self.finished = queue.Queue()
+        self.stopping = threading.Event()
+
+    # Re-read the jobs and limits whenever the config file changes
+    def refresh(self):
+        try:
+            mtime = os.stat(self.config_file).st_mtime
+        except OSError:
+            mtime = None
+        if self.config is not None and mtime == self.config_mtime:
+            return
+        self.config_mtime = mtime
+        try:
+            jobs = load_jobs(self.config_file)
+        except ValueError as e:
+            if self.config is None:
+                raise
+            self.log(f"Configuration not reloaded, keeping the previous jobs: {e}")
+            return
+        if self.config is not None:
+            self.log(f"Configuration reloaded: {len(jobs)} job(s)")
+        self.config = engine.load_config(self.config_file)
+        self.jobs = {job.name: job for job in jobs}
+
+    # Start due jobs within the concurrency limits; returns the seconds until the next one is due
+    def start_due(self, state, now):
+        waiting = []
+        rows = state.rows()
+        for job in self.jobs.values():
+            if job.enabled and job.name not in self.running:
+                due, missed = next_run(job, rows.get(job.name), now)
+                waiting.append((due, job.name, missed))
+        wait = TICK
+        for due, name, missed in sorted(waiting):
+            if due > now:
+                wait = min(wait, due - now)
+                continue
+            job = self.jobs[name]
+            destination = destination_key(job.backup_dir)
+            if len(self.running) >= max(self.config['max_concurrent_jobs'], 1):
+                break
+            if sum(1 for *_, busy in self.running.values() if busy == destination) >= \
+                    max(self.config['max_jobs_per_destination'], 1):
+                continue
+            self._start(state, job, now, missed, destination)
+        return wait
+
+    def _start(self, state, job, now, missed, destination):
+        state.started(job, now, missed)
+        progress = JobProgress()
+        thread = threading.Thread(target=self._run, args=(job, self.config, progress), name=f"job {job.name}",
+                                  daemon=True)
+        self.running[job.name] = (thread, progress, destination)
+        caught_up = f", catching up after {missed} missed run(s)" if missed else ""
+        self.log(f"{job.name}: {job.backup_type.lower()} backup of {', '.join(job.source_dirs)} started{caught_up}")
+        thread.start()
+
+    def _run(self, job, config, progress):
+        try:
+            entry = run_job(job, config, self.password, progress)
+        except BackupCancelled as e:
+            self.finished.put((job.name, 'cancelled', str(e), None))
+        except BackupRunning as e:
+            self.finished.put((job.name, 'skipped', str(e), None))
+        except Exception as e:
+            self.finished.put((job.name, 'failed', str(e), None))
+        else:
+            self.finished.put((job.name, 'success', None, entry))
+
+    # Wait up to `timeout` seconds for a job to finish and record its outcome
+    def _collect(self, state, timeout):
+        try:
+            item = self.finished.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if item is None:
+            return  # Woken up by stop()
+        name, status, error, entry = item
+        thread, progress, _ = self.running.pop(name)
+        thread.join()
+        job = self.jobs.get(name)
+        retry_at = None
+        if status == 'cancelled':
+            retry_at = time.time()  # Stopped with the scheduler; due again as soon as it is back
+        elif status != 'success':
+            retry_at = time.time() + min(RETRY_DELAY, job.interval if job else RETRY_DELAY)
+        state.finished(name, status, error, entry['id'] if entry else None, retry_at)
+        if status == 'success':
+            self.log(f"{name}: {entry['backup_file']} ({entry['size']} bytes, {progress.files} files)")
+        else:
+            self.log(f"{name}: {status}: {error}")
+
+    # Ask run() to return; runs in progress are cancelled. Safe to call from a signal handler.
+    def stop(self):
+        self.stopping.set()
+        self.finished.put(None)
+
+    # Run until stop(); with `once`, only until the jobs due at the start are done
+    def run(self, once=False):
+        lock = engine.acquire_lock(SCHEDULER_LOCK, "The scheduler is already running")
+        try:
+            with SchedulerState(self.state_file) as state:
+                state.recover()
+                started = time.time()
+                try:
+                    while not self.stopping.is_set():
+                        self.refresh()
+                        # Wakes up when a job finishes, or at the latest when the next one is due
+                        wait = self.start_due(state, started if once else time.time())
+                        if once and not self.running:
+                            break
+                        self._collect(state, wait)
+                finally:
+                    # Runs cancelled here are retried as soon as the scheduler is back
+                    for _, progress, _ in self.running.values():
+                        progress.cancel()
+                    while self.running:
+                        self._collect(state, None)
+        finally:
+            if lock is not None:
+                lock.close()
+
+    # Jobs with their state and next run, for `backup.py schedule --status` and the GUI
+    def status(self, now=None):
+        now = now or time.time()
+        self.refresh()
+        with SchedulerState(self.state_file) as state:
+            rows = state.rows()
+        result = []
+        for job in self.jobs.values():
+            row = rows.get(job.name) or {}
+            due, missed = next_run(job, rows.get(job.name), now)
+            result.append({'name': job.name, 'source_dirs': job.source_dirs, 'backup_dir': job.backup_dir,
+                           'interval': format_interval(job.interval), 'backup_type': job.backup_type,
+                           'enabled': job.enabled, 'next_run': max(due, now), 'missed': row.get('missed', 0) + missed,
+                           'status': row.get('status'), 'error': row.get('error'), 'last_run': row.get('last_run'),
+                           'last_success': row.get('last_success'), 'runs': row.get('runs', 0)})
+        return result
+
+
+# Function to make cron (or the Windows task scheduler) run `backup.py schedule --once` every
+# TRIGGER_MINUTES. Only this utility's own line or task is replaced, so repeated calls never add
+# duplicates and the rest of the user's crontab is left alone.
+def install_trigger(cli_script):
+    if platform.system() == "Windows":
+        command = f'"{sys.executable}" "{cli_script}" schedule --once'
+        subprocess.run(['schtasks', '/create', '/tn', TRIGGER_TASK, '/tr', command, '/sc', 'MINUTE',
+                        '/mo', str(TRIGGER_MINUTES), '/f'], check=True, capture_output=True)
+        return command
+    command = (f"*/{TRIGGER_MINUTES} * * * * {shlex.quote(sys.executable)} {shlex.quote(cli_script)} "
+               f"schedule --once >/dev/null 2>&1")
+    _write_crontab([line for line in _read_crontab() if cli_script not in line] + [command])
+    return command
+
+
+# Function to remove what install_trigger added, and nothing else
+def remove_trigger(cli_script):
+    if platform.system() == "Windows":
+        subprocess.run(['schtasks', '/delete', '/tn', TRIGGER_TASK, '/f'], capture_output=True)
+        return
+    lines = _read_crontab()
+    kept = [line for line in lines if cli_script not in line]
+    if kept != lines:
+        _write_crontab(kept)
+
+
+def _read_crontab():
+    result = subprocess.run(['crontab', '-l'], capture_output=True, text=True)
+    # No crontab yet is not an error
+    return result.stdout.splitlines() if result.returncode == 0 else []
+
+
+def _write_crontab(lines):
+    subprocess.run(['crontab', '-'], input=''.join(f"{line}\n" for line in lines), text=True, check=True,
+                   capture_output=True)
@@ -0,0 +1,461 @@
+import os
+import json
+import stat
+import struct
+import time
+import hashlib
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+from delta import apply_delta
+from extractor import RestoreWriter, data_extents
+from compression import compress_block, decompress_block, check_codec, default_workers, DEFAULT_LEVELS, CODECS
+
+# Seekable block archive (.abx).
+#
+# Layout:
+#   header  = MAGIC | version (1) | flags (1) | codec (1) | salt (16, encrypted only)
+#   blocks  = independently compressed (and, with a password, AES-GCM sealed) blocks
+#   index   = compressed (and sealed) JSON: block table + one entry per path
+#   footer  = index offset (8) | index length (8) | FOOTER_MAGIC
+#
+# Small files share blocks and large files span several, and every index
+# entry maps its path to (block, offset in block, length) segments plus its
+# mode, mtime, owner and BLAKE2b checksum. Restoring one file or one
+# directory therefore reads only the footer, the index and the blocks that
+# hold its data, and listing an archive reads the index alone. Entries of
+# type 'delta' hold a delta against an earlier version of the file (see
+# delta.py); they are applied after the files of the archive are written.
+MAGIC = b"ABUSEEK"
+FOOTER_MAGIC = b"ABUINDEX"
+FORMAT_VERSION = 1
+FLAG_ENCRYPTED = 1
+EXTENSION = ".abx"
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+FOOTER_SIZE = 16 + len(FOOTER_MAGIC)
+NONCE_SIZE = 12
+SALT_SIZE = 16
+READ_SIZE = 1024 * 1024
+
+
+class SeekableArchiveError(ValueError):
+    pass
+
+
+def is_seekable_archive(path):
+    with storage.open_input(path, sequential=False) as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _block_aad(block_number):
+    return b"block" + struct.pack(">Q", block_number)
+
+
+_INDEX_AAD = b"index"
+
+
+# Time a pipeline stage when the caller asked for metrics (see metrics.py)
+def _timed(metrics, stage, size):
+    if metrics is None:
+        return nullcontext()
+    metrics.add(stage, nbytes=size)
+    return metrics.timed(stage)
+
+
+# Block sealing shared by the writer and the reader
+class _BlockCodec:
+    def __init__(self, codec, level, password, salt, metrics=None):
+        self.codec = codec
+        self.level = level
+        self.metrics = metrics
+        self.cipher = None
+        if password:
+            from stream_crypto import derive_stream_key
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+            self.cipher = AESGCM(derive_stream_key(password, salt))
+
+    def seal(self, raw, aad, level=None):
+        with _timed(self.metrics, 'compress', len(raw)):
+            data = compress_block(raw, self.codec, self.level if level is None else level)
+        if self.cipher is None:
+            return data
+        with _timed(self.metrics, 'encrypt', len(data)):
+            nonce = os.urandom(NONCE_SIZE)
+            return nonce + self.cipher.encrypt(nonce, data, aad)
+
+    def open(self, stored, aad):
+        if self.cipher is not None:
+            from cryptography.exceptions import InvalidTag
+            with _timed(self.metrics, 'decrypt', len(stored)):
+                try:
+                    stored = self.cipher.decrypt(stored[:NONCE_SIZE], stored[NONCE_SIZE:], aad)
+                except InvalidTag:
+                    raise SeekableArchiveError("Wrong password or corrupted archive block")
+        with _timed(self.metrics, 'decompress', len(stored)):
+            return decompress_block(stored, self.codec)
+
+
+class SeekableArchiveWriter:
+    def __init__(self, fileobj, codec="gzip", level=None, password=None, block_size=DEFAULT_BLOCK_SIZE, workers=None,
+                 metrics=None, policy=None, governor=None):
+        level = DEFAULT_LEVELS[codec] if level is None else level
+        check_codec(codec, level)
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.metrics = metrics
+        self.governor = governor
+        # With a CompressionPolicy, each file's blocks use the level chosen for it; the
+        # stored data stays in the archive's codec, so readers need no per-block level
+        self.policy = policy
+        self.block_level = level
+        salt = os.urandom(SALT_SIZE) if password else b""
+        flags = FLAG_ENCRYPTED if password else 0
+        self.block_codec = _BlockCodec(codec, level, password, salt, metrics)
+        self.fileobj.write(MAGIC + struct.pack(">BBB", FORMAT_VERSION, flags, CODECS.index(codec)) + salt)
+        self.offset = len(MAGIC) + 3 + len(salt)
+
+        self.workers = workers or default_workers()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.block_count = 0
+        self.blocks = []    # [offset, stored size, raw size] per block, in block order
+        self.entries = []
+        self.bytes_in = 0
+        self.closed = False
+
+    def _seal(self, raw, block_number, level):
+        cpu_start = time.thread_time()
+        stored = self.block_codec.seal(raw, _block_aad(block_number), level)
+        if self.policy is not None:
+            self.policy.record_block(level, len(raw), time.thread_time() - cpu_start)
+        return stored
+
+    def _submit(self, raw):
+        block_number = self.block_count
+        self.block_count += 1
+        if self.executor is None:
+            self._emit(self._seal(raw, block_number, self.block_level), len(raw))
+            return
+        future = self.executor.submit(self._seal, raw, block_number, self.block_level)
+        self.pending.append((future, len(raw)))
+        while len(self.pending) >= self.workers * 2:
+            future, raw_size = self.pending.popleft()
+            self._emit(future.result(), raw_size)
+
+    def _emit(self, stored, raw_size):
+        self.fileobj.write(stored)
+        self.blocks.append([self.offset, len(stored), raw_size])
+        self.offset += len(stored)
+
+    def _append(self, data, segments):
+        # Split `data` across the current block and as many new blocks as needed
+        view = memoryview(data)
+        while view:
+            room = self.block_size - len(self.buffer)
+            part = view[:room]
+            last = segments[-1] if segments else None
+            if last and last[0] == self.block_count and last[1] + last[2] == len(self.buffer):
+                last[2] += len(part)  # Contiguous with the previous read, extend the segment
+            else:
+                segments.append([self.block_count, len(self.buffer), len(part)])
+            self.buffer += part
+            view = view[len(part):]
+            if len(self.buffer) >= self.block_size:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+
+    # Add one file system object, using the stat result the caller already has.
+    # With a delta.DeltaPolicy, a large file may be stored as a delta; `delta_key` is its (source, path).
+    def add(self, arcname, abs_path, st, deltas=None, delta_key=None):
+        entry = {
+            'path': arcname,
+            'mode': stat.S_IMODE(st.st_mode),
+            'mtime': st.st_mtime,
+            'uid': st.st_uid,
+            'gid': st.st_gid,
+        }
+        if stat.S_ISDIR(st.st_mode):
+            entry['type'] = 'dir'
+        elif stat.S_ISLNK(st.st_mode):
+            entry['type'] = 'symlink'
+            entry['linkname'] = os.readlink(abs_path)
+        elif stat.S_ISREG(st.st_mode):
+            entry['type'] = 'file'
+            with open(abs_path, 'rb') as f:
+                extents = data_extents(f, st)
+                if extents:
+                    entry['sparse'] = extents
+                if self.policy is not None and self.policy.select(arcname, st.st_size, f) != self.block_level:
+                    # Start a new block so this file gets its own level
+                    if self.buffer:
+                        self._submit(bytes(self.buffer))
+                        self.buffer = bytearray()
+                    self.block_level = self.policy.current_level
+                if self.metrics is not None:
+                    f = self.metrics.reader(f, 'read')
+                if self.governor is not None:
+                    f = self.governor.reader(f)
+                if deltas is not None:
+                    f, delta_size = deltas.prepare(*delta_key, st.st_size, f)
+                    if delta_size is not None:
+                        entry['type'] = 'delta'
+                        entry.pop('sparse', None)
+                self._add_data(entry, f)
+                if deltas is not None:
+                    deltas.finish(*delta_key, f)
+        else:
+            return False  # Devices, fifos and sockets are not stored
+        self.entries.append(entry)
+        return True
+
+    # Add an entry copied from another archive: `entry` carries the index fields
+    # (path, type, mode, mtime, uid, gid, linkname, sparse) and `fileobj` a file's or delta's contents
+    def add_entry(self, entry, fileobj=None):
+        entry = {key: entry[key] for key in ('path', 'type', 'mode', 'mtime', 'uid', 'gid', 'linkname', 'sparse')
+                 if key in entry}
+        if entry['type'] in ('file', 'delta'):
+            self._add_data(entry, fileobj)
+        self.entries.append(entry)
+
+    def _add_data(self, entry, f):
+        segments = []
+        digest = hashlib.blake2b(digest_size=32)
+        size = 0
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            self._append(data, segments)
+            size += len(data)
+        entry['size'] = size
+        entry['checksum'] = digest.hexdigest()
+        entry['segments'] = segments
+        self.bytes_in += size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                future, raw_size = self.pending.popleft()
+                self._emit(future.result(), raw_size)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+
+        index = json.dumps({'version': FORMAT_VERSION, 'blocks': self.blocks, 'entries': self.entries},
+                           separators=(',', ':')).encode()
+        stored_index = self.block_codec.seal(index, _INDEX_AAD)
+        self.fileobj.write(stored_index)
+        self.fileobj.write(struct.pack(">QQ", self.offset, len(stored_index)) + FOOTER_MAGIC)
+        self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class SeekableArchiveReader:
+    def __init__(self, path, password=None, metrics=None):
+        self.metrics = metrics
+        self.f = storage.open_input(path, sequential=False)
+        try:
+            self._load(password)
+        except Exception:
+            self.f.close()
+            raise
+
+    def _load(self, password):
+        header = self.f.read(len(MAGIC) + 3)
+        if len(header) < len(MAGIC) + 3 or not header.startswith(MAGIC):
+            raise SeekableArchiveError("Not a seekable backup archive")
+        version, flags, codec_id = struct.unpack(">BBB", header[len(MAGIC):])
+        if version != FORMAT_VERSION:
+            raise SeekableArchiveError(f"Unsupported archive format version {version}")
+        self.encrypted = bool(flags & FLAG_ENCRYPTED)
+        salt = self.f.read(SALT_SIZE) if self.encrypted else b""
+        if self.encrypted and not password:
+            raise SeekableArchiveError("Password is required for decryption.")
+        self.codec = CODECS[codec_id]
+        self.block_codec = _BlockCodec(self.codec, None, password if self.encrypted else None, salt, self.metrics)
+
+        self.f.seek(-FOOTER_SIZE, os.SEEK_END)
+        footer = self.f.read(FOOTER_SIZE)
+        if not footer.endswith(FOOTER_MAGIC):
+            raise SeekableArchiveError("Archive index is missing (truncated archive?)")
+        index_offset, index_length = struct.unpack(">QQ", footer[:16])
+        self.f.seek(index_offset)
+        index = json.loads(self.block_codec.open(self.f.read(index_length), _INDEX_AAD))
+        self.blocks = index['blocks']
+        self.entries = index['entries']
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def read_block(self, block_number):
+        offset, stored_size, raw_size = self.blocks[block_number]
+        with _timed(self.metrics, 'read', stored_size):
+            self.f.seek(offset)
+            stored = self.f.read(stored_size)
+        raw = self.block_codec.open(stored, _block_aad(block_number))
+        if len(raw) != raw_size:
+            raise SeekableArchiveError(f"Block {block_number} has the wrong size")
+        return raw
+
+    # File-like reader over one file entry's data; the checksum is verified at the end
+    def open_entry(self, entry):
+        return _EntryReader(self, entry)
+
+    # Entries whose path is one of `paths` or lies below one of them (all entries when `paths` is empty)
+    def select(self, paths=None):
+        if not paths:
+            return list(self.entries)
+        wanted = [path.strip('/') for path in paths]
+        return [entry for entry in self.entries
+                if any(entry['path'] == path or entry['path'].startswith(path + '/') for path in wanted)]
+
+    # Extract the selected entries, reading each needed block once and in file order.
+    # `predicate`, if given, further filters entries by path; `progress` is told
+    # about every finished entry and may cancel between blocks. Blocks are decoded
+    # on this thread and file data written by a pool of `workers` (see extractor.py).
+    def extract(self, restore_location, paths=None, predicate=None, progress=None, workers=None):
+        entries = self.select(paths)
+        if paths and not entries:
+            raise SeekableArchiveError(f"No entries match: {', '.join(paths)}")
+        if predicate is not None:
+            entries = [entry for entry in entries if predicate(entry['path'])]
+
+        files = [entry for entry in entries if entry['type'] == 'file']
+        deltas = [entry for entry in entries if entry['type'] == 'delta']
+        if progress is not None:
+            progress.add_totals(len(entries), sum(entry['size'] for entry in files + deltas))
+        # Which files need which block, so every block is read and decoded exactly once
+        readers = {}
+        for entry in files:
+            for block_number in sorted({segment[0] for segment in entry['segments']}):
+                readers.setdefault(block_number, []).append(entry)
+
+        with RestoreWriter(restore_location, workers, self.metrics) as writer:
+            for entry in entries:
+                if entry['type'] == 'dir':
+                    writer.make_directory(entry['path'], lambda target, entry=entry: _apply_metadata(target, entry))
+                elif entry['type'] == 'symlink':
+                    target = writer.target(entry['path'])
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(entry['linkname'], target)
+                else:
+                    continue
+                if progress is not None:
+                    progress.advance(entry['path'])
+
+            # A file is open only while its blocks are being read; its segments are written at their offsets
+            outputs = {}
+            remaining = {id(entry): len(entry['segments']) for entry in files}
+            digests = {id(entry): hashlib.blake2b(digest_size=32) for entry in files}
+            offsets = {}
+            for entry in files:
+                offset = 0
+                for segment in entry['segments']:
+                    offsets[id(entry), tuple(segment)] = offset
+                    offset += segment[2]
+                if not entry['segments']:
+                    outputs[id(entry)] = writer.create(entry['path'], entry['size'])
+                    self._finish_file(entry, outputs, digests, writer, progress)
+
+            for block_number in sorted(readers):
+                if progress is not None:
+                    progress.check()
+                block = self.read_block(block_number)
+                for entry in readers[block_number]:
+                    if id(entry) not in outputs:
+                        outputs[id(entry)] = writer.create(entry['path'], entry['size'], entry.get('sparse'))
+                    for segment in entry['segments']:
+                        if segment[0] == block_number:
+                            data = block[segment[1]:segment[1] + segment[2]]
+                            writer.write(outputs[id(entry)], offsets[id(entry), tuple(segment)], data)
+                            digests[id(entry)].update(data)
+                            remaining[id(entry)] -= 1
+                    if remaining[id(entry)] == 0:
+                        self._finish_file(entry, outputs, digests, writer, progress)
+            if outputs:
+                raise SeekableArchiveError("Archive index references data that was never read")
+
+            # Deltas apply to the files written above or restored from an older archive
+            if deltas:
+                writer.drain()
+            for entry in deltas:
+                if progress is not None:
+                    progress.check()
+                target = writer.target(entry['path'])
+                with _timed(self.metrics, 'extract', entry['size']):
+                    apply_delta(self.open_entry(entry), target)
+                writer.defer(target, lambda target, entry=entry: _apply_metadata(target, entry))
+                if progress is not None:
+                    progress.advance(entry['path'], entry['size'])
+            writer.finish()
+        return entries
+
+    def _finish_file(self, entry, outputs, digests, writer, progress=None):
+        if digests[id(entry)].hexdigest() != entry['checksum']:
+            raise SeekableArchiveError(f"Checksum mismatch for {entry['path']}")
+        writer.close(outputs.pop(id(entry)), lambda target: _apply_metadata(target, entry))
+        if progress is not None:
+            progress.advance(entry['path'], entry['size'])
+
+
+# Reads an entry's segments in order, decoding each block once even when
+# consecutive segments (or consecutive small files) share it
+class _EntryReader:
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+        self.segments = deque(entry['segments'])
+        self.digest = hashlib.blake2b(digest_size=32)
+        self.pending = b""
+
+    def _next_segment(self):
+        block_number, offset, length = self.segments.popleft()
+        cached = getattr(self.archive, '_cached_block', None)
+        if cached is None or cached[0] != block_number:
+            cached = self.archive._cached_block = (block_number, self.archive.read_block(block_number))
+        data = cached[1][offset:offset + length]
+        self.digest.update(data)
+        if not self.segments and self.digest.hexdigest() != self.entry['checksum']:
+            raise SeekableArchiveError(f"Checksum mismatch for {self.entry['path']}")
+        return data
+
+    def read(self, size=-1):
+        while self.segments and (size < 0 or len(self.pending) < size):
+            self.pending += self._next_segment()
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def _apply_metadata(target, entry):
+    if hasattr(os, 'geteuid') and os.geteuid() == 0 and 'uid' in entry:
+        os.chown(target, entry['uid'], entry['gid'])
+    os.chmod(target, entry['mode'])
+    os.utime(target, (entry['mtime'], entry['mtime']))
@@ -0,0 +1,488 @@
+import os
+import time
+import queue
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, quote, unquote
+
+# Storage backends for backup archives.
+#
+# A backup location is either a local directory or a URL:
+#   s3://bucket/prefix          S3 or any S3-compatible store (MinIO, Ceph, ...)
+#   sftp://user@host:port/path  any SSH server (needs the optional 'paramiko' package)
+# The engine only ever streams: archives are written through open_output()
+# and read through open_input(), so nothing is staged on local disk.
+#
+# S3 uses plain HTTP(S) with SigV4 signing from the standard library. Uploads
+# are multipart: the stream is cut into parts that are uploaded concurrently
+# over a pool of kept-alive connections while the next part is being
+# produced, so memory stays at a few parts. Each part is retried on its own
+# after a network error or a 5xx, so a hiccup never restarts the upload, and
+# a failed or cancelled upload is aborted so no parts are left behind.
+# Reads use ranged GETs: sequential readers get several ranges in flight at
+# once, random access (seekable archives) fetches just the bytes asked for.
+#
+# Credentials and endpoint come from the usual environment variables:
+# AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN, AWS_REGION
+# (or AWS_DEFAULT_REGION) and AWS_ENDPOINT_URL (e.g. http://localhost:9000
+# for MinIO). SFTP uses the SSH agent, ~/.ssh keys and known_hosts, or
+# $SFTP_PASSWORD.
+#
+# The HTTP, XML and thread pool modules the S3 backend needs are imported by
+# the backend itself, so local backups (and `backup.py --help`) never load them.
+REMOTE_SCHEMES = ('s3', 'sftp')
+PARTIAL_SUFFIX = '.part'
+
+PART_SIZE = 16 * 1024 * 1024        # doubled every PART_GROWTH parts, as S3 allows at most 10000
+PART_GROWTH = 1000
+UPLOAD_WORKERS = 8
+RANGE_SIZE = 8 * 1024 * 1024
+READ_AHEAD = 4                      # ranges in flight while reading sequentially
+RETRIES = 5
+RETRY_DELAY = 0.5
+TIMEOUT = 60
+
+
+class StorageError(OSError):
+    pass
+
+
+def is_remote(path):
+    return urlsplit(path).scheme in REMOTE_SCHEMES
+
+
+def join(location, name):
+    if is_remote(location):
+        return location.rstrip('/') + '/' + name.replace(os.sep, '/')
+    return os.path.join(location, name)
+
+
+# One backend per bucket or host, so connections are pooled across calls
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def _backend(path):
+    parts = urlsplit(path)
+    with _backends_lock:
+        backend = _backends.get((parts.scheme, parts.netloc))
+        if backend is None:
+            backend_class = S3Storage if parts.scheme == 's3' else SFTPStorage
+            backend = _backends[(parts.scheme, parts.netloc)] = backend_class(parts.netloc)
+    return backend, unquote(parts.path)
+
+
+def exists(path):
+    if not is_remote(path):
+        return os.path.exists(path)
+    backend, name = _backend(path)
+    return backend.size(name) is not None
+
+
+def size(path):
+    if not is_remote(path):
+        return os.path.getsize(path)
+    backend, name = _backend(path)
+    result = backend.size(name)
+    if result is None:
+        raise StorageError(f"No such backup file: {path}")
+    return result
+
+
+def remove(path):
+    if not is_remote(path):
+        os.remove(path)
+        return
+    backend, name = _backend(path)
+    backend.remove(name)
+
+
+# Readable, seekable binary stream; `sequential` tells remote backends to read ahead
+def open_input(path, sequential=True):
+    if not is_remote(path):
+        return open(path, 'rb')
+    backend, name = _backend(path)
+    return backend.open_input(name, sequential)
+
+
+# Writable binary stream that only appears under `path` once commit() is called;
+# abort() throws away everything written
+def open_output(path):
+    if not is_remote(path):
+        return LocalOutput(path)
+    backend, name = _backend(path)
+    return backend.open_output(name)
+
+
+class LocalOutput:
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.f = open(self.partial_path, 'wb')
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def commit(self):
+        self.f.close()
+        os.replace(self.partial_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, message):
+    import hmac
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+class S3Storage:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.session_token = os.environ.get('AWS_SESSION_TOKEN')
+        if not self.access_key or not self.secret_key:
+            raise StorageError("S3 storage needs AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY")
+        self.region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        endpoint = urlsplit(os.environ.get('AWS_ENDPOINT_URL') or f"https://s3.{self.region}.amazonaws.com")
+        self.secure = endpoint.scheme == 'https'
+        self.host = endpoint.netloc
+        self.connections = queue.LifoQueue()
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='s3')
+
+    def _connect(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            import http.client
+            connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            return connection_class(self.host, timeout=TIMEOUT)
+
+    def _sign(self, method, uri, query, headers, payload_hash):
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        headers.update({'host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+        if self.session_token:
+            headers['x-amz-security-token'] = self.session_token
+        signed = sorted(name.lower() for name in headers)
+        lowered = {name.lower(): str(value).strip() for name, value in headers.items()}
+        canonical = '\n'.join([method, uri, query, ''.join(f"{name}:{lowered[name]}\n" for name in signed),
+                               ';'.join(signed), payload_hash])
+        scope = f"{now.strftime('%Y%m%d')}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, _sha256(canonical.encode())])
+        key = _hmac(('AWS4' + self.secret_key).encode(), now.strftime('%Y%m%d'))
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        signature = _hmac(key, string_to_sign).hex()
+        headers['Authorization'] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={';'.join(signed)}, Signature={signature}")
+
+    # One signed request on a pooled connection, retried on network errors, 5xx and throttling.
+    # Returns (status, headers, body).
+    def request(self, method, key, query=None, headers=None, body=b"", expect=(200,)):
+        import http.client
+        uri = quote(f"/{self.bucket}/{key.lstrip('/')}", safe='/-_.~')
+        query = '&'.join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}"
+                         for name, value in sorted((query or {}).items()))
+        payload_hash = _sha256(body)
+        for attempt in range(RETRIES):
+            request_headers = dict(headers or {})
+            self._sign(method, uri, query, request_headers, payload_hash)
+            connection = self._connect()
+            try:
+                connection.request(method, uri + ('?' + query if query else ''), body=body, headers=request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()  # Never reuse a connection in an unknown state
+                error = e
+            else:
+                self.connections.put(connection)
+                if response.status in expect:
+                    return response.status, response.headers, data
+                error = StorageError(f"S3 {method} {key} failed: {response.status} "
+                                     f"{_error_message(data) or response.reason}")
+                if response.status < 500 and response.status != 429:
+                    raise error
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+        raise StorageError(f"S3 {method} {key} failed after {RETRIES} attempts: {error}")
+
+    def size(self, key):
+        status, headers, _ = self.request('HEAD', key, expect=(200, 404))
+        return int(headers['Content-Length']) if status == 200 else None
+
+    def remove(self, key):
+        self.request('DELETE', key, expect=(200, 204, 404))
+
+    def get_range(self, key, start, end):
+        _, _, data = self.request('GET', key, headers={'Range': f"bytes={start}-{end - 1}"}, expect=(200, 206))
+        return data
+
+    def open_input(self, key, sequential=True):
+        total = self.size(key)
+        if total is None:
+            raise StorageError(f"No such object: s3://{self.bucket}/{key}")
+        return RangeReader(self, key, total)
+
+    def open_output(self, key):
+        return MultipartUpload(self, key)
+
+
+def _error_message(data):
+    if not data:
+        return ''
+    from xml.etree import ElementTree
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError:
+        return data[:200].decode(errors='replace')
+    return f"{root.findtext('Code', '')}: {root.findtext('Message', '')}"
+
+
+class MultipartUpload:
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.buffer = bytearray()
+        self.part_size = PART_SIZE
+        self.upload_id = None
+        self.pending = deque()
+        self.parts = []     # (part number, ETag)
+        self.aborted = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, part):
+        if self.upload_id is None:
+            _, _, data = self.storage.request('POST', self.key, {'uploads': ''})
+            from xml.etree import ElementTree
+            root = ElementTree.fromstring(data)
+            self.upload_id = root.findtext('{*}UploadId') or root.findtext('UploadId')
+        number = len(self.parts) + len(self.pending) + 1
+        self.pending.append((number, self.storage.executor.submit(self._upload_part, number, part)))
+        if number % PART_GROWTH == 0:
+            self.part_size *= 2
+        # Bound memory: wait for the oldest part once every worker is busy
+        while len(self.pending) >= UPLOAD_WORKERS:
+            self._collect()
+
+    def _upload_part(self, number, part):
+        _, headers, _ = self.storage.request('PUT', self.key, {'partNumber': str(number), 'uploadId': self.upload_id},
+                                             body=part)
+        return headers['ETag']
+
+    def _collect(self):
+        number, future = self.pending.popleft()
+        self.parts.append((number, future.result()))
+
+    def commit(self):
+        if self.upload_id is None:
+            # Small enough for a single PUT
+            self.storage.request('PUT', self.key, body=bytes(self.buffer))
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._collect()
+            body = ''.join(f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                           for number, etag in self.parts)
+            _, _, data = self.storage.request('POST', self.key, {'uploadId': self.upload_id},
+                                              body=f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode())
+            # S3 can report a failed completion inside a 200 response
+            if b"<Error>" in data:
+                raise StorageError(f"S3 upload of {self.key} failed: {_error_message(data)}")
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        if self.aborted:
+            return
+        self.aborted = True
+        for _, future in self.pending:
+            future.cancel()
+        for _, future in self.pending:
+            try:
+                future.result()
+            except Exception:
+                pass
+        self.pending.clear()
+        if self.upload_id is not None:
+            self.storage.request('DELETE', self.key, {'uploadId': self.upload_id}, expect=(200, 204, 404))
+
+
+# Seekable reader over ranged GETs
+class RangeReader:
+    def __init__(self, storage, key, total):
+        self.storage = storage
+        self.key = key
+        self.size = total
+        self.position = 0
+        self.last_end = 0
+        self.window = deque()   # (start, end, future) ranges read ahead of the position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def _reset(self):
+        for _, _, future in self.window:
+            future.cancel()
+        self.window.clear()
+
+    def _fill(self):
+        start = self.window[-1][1] if self.window else self.position
+        while len(self.window) < READ_AHEAD and start < self.size:
+            end = min(start + RANGE_SIZE, self.size)
+            self.window.append((start, end, self.storage.executor.submit(self.storage.get_range, self.key, start, end)))
+            start = end
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return b""
+        if self.position != self.last_end:
+            # Random access: fetch exactly what was asked for
+            self._reset()
+            data = self.storage.get_range(self.key, self.position, self.position + size)
+        else:
+            pieces = []
+            remaining = size
+            while remaining:
+                if self.window and not self.window[0][0] <= self.position < self.window[0][1]:
+                    self._reset()
+                self._fill()
+                start, end, future = self.window[0]
+                block = future.result()
+                piece = block[self.position - start:self.position - start + remaining]
+                pieces.append(piece)
+                self.position += len(piece)
+                remaining -= len(piece)
+                if self.position >= end:
+                    self.window.popleft()
+            self._fill()
+            data = b"".join(pieces)
+            self.position -= len(data)
+        self.position += len(data)
+        self.last_end = self.position
+        return data
+
+    def close(self):
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# paramiko is optional and only imported when an sftp:// location is used
+def load_paramiko():
+    try:
+        import paramiko
+    except ImportError:
+        return None
+    return paramiko
+
+
+class SFTPStorage:
+    def __init__(self, netloc):
+        paramiko = load_paramiko()
+        if paramiko is None:
+            raise StorageError("SFTP storage requires the 'paramiko' package")
+        parts = urlsplit(f"sftp://{netloc}")
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.connect(parts.hostname, port=parts.port or 22, username=parts.username,
+                            password=os.environ.get('SFTP_PASSWORD'), timeout=TIMEOUT)
+        self.sftp = self.client.open_sftp()
+        self.lock = threading.Lock()
+
+    def size(self, path):
+        try:
+            with self.lock:
+                return self.sftp.stat(path).st_size
+        except FileNotFoundError:
+            return None
+
+    def remove(self, path):
+        with self.lock:
+            self.sftp.remove(path)
+
+    def open_input(self, path, sequential=True):
+        f = self.sftp.open(path, 'rb')
+        if sequential:
+            f.prefetch()  # Many read requests in flight instead of one round trip per read
+        return f
+
+    def open_output(self, path):
+        return SFTPOutput(self, path)
+
+
+class SFTPOutput:
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.f = storage.sftp.open(self.partial_path, 'wb')
+        self.f.set_pipelined(True)  # Do not wait for each write to be acknowledged
+
+    def write(self, data):
+        self.f.write(data)
+        return len(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def commit(self):
+        self.f.close()
+        with self.storage.lock:
+            self.storage.sftp.posix_rename(self.partial_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        try:
+            with self.storage.lock:
+                self.storage.sftp.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,202 @@
+import os
+import struct
+import hashlib
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Streaming, chunked AES-256-GCM file format.
+#
+# Layout:
+#   header  = MAGIC | version (1) | chunk size (4) | salt (16) | nonce prefix (7)
+#   record  = ciphertext length (4) | ciphertext + 16 byte GCM tag
+#
+# Every record is sealed with its own nonce: nonce prefix | record counter (4)
+# | final flag (1), and the header is bound to every record as associated
+# data. The last record carries final flag = 1, so a stream that ends before
+# the final record (truncation) or continues after it is rejected.
+MAGIC = b"ABUENC"
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 1 + 4 + SALT_SIZE + NONCE_PREFIX_SIZE
+MAX_COUNTER = 2 ** 32 - 1
+
+# scrypt cost parameters used to turn the password into the stream key
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+class DecryptionError(ValueError):
+    pass
+
+
+def derive_stream_key(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+
+
+def _record_nonce(prefix, counter, final):
+    return prefix + struct.pack(">IB", counter, 1 if final else 0)
+
+
+def _read_exact(fileobj, size):
+    data = b""
+    while len(data) < size:
+        block = fileobj.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+# Check whether a file (path or open binary file) starts with the stream header
+def is_stream_encrypted(source):
+    if hasattr(source, "read"):
+        position = source.tell()
+        magic = source.read(len(MAGIC))
+        source.seek(position)
+    else:
+        with open(source, "rb") as f:
+            magic = f.read(len(MAGIC))
+    return magic == MAGIC
+
+
+# File-like object that encrypts everything written to it into `fileobj`
+class EncryptingWriter:
+    def __init__(self, fileobj, password, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        salt = os.urandom(SALT_SIZE)
+        self.nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self.header = MAGIC + struct.pack(">BI", FORMAT_VERSION, chunk_size) + salt + self.nonce_prefix
+        self.cipher = AESGCM(derive_stream_key(password, salt))
+        self.counter = 0
+        self.buffer = bytearray()
+        self.closed = False
+        self.fileobj.write(self.header)
+
+    def _seal(self, data, final):
+        if self.counter > MAX_COUNTER:
+            raise ValueError("Too many chunks for a single encrypted stream")
+        nonce = _record_nonce(self.nonce_prefix, self.counter, final)
+        sealed = self.cipher.encrypt(nonce, bytes(data), self.header)
+        self.fileobj.write(struct.pack(">I", len(sealed)))
+        self.fileobj.write(sealed)
+        self.counter += 1
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed EncryptingWriter")
+        self.buffer += data
+        # Always keep the tail in the buffer so close() can seal it as the final record
+        while len(self.buffer) > self.chunk_size:
+            self._seal(self.buffer[:self.chunk_size], final=False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self._seal(self.buffer, final=True)
+        self.buffer = bytearray()
+        self.closed = True
+        self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# File-like object that reads and authenticates a stream written by EncryptingWriter
+class DecryptingReader:
+    def __init__(self, fileobj, password):
+        self.fileobj = fileobj
+        header = _read_exact(fileobj, HEADER_SIZE)
+        if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+            raise DecryptionError("Not an encrypted backup stream")
+        version, chunk_size = struct.unpack(">BI", header[len(MAGIC):len(MAGIC) + 5])
+        if version != FORMAT_VERSION:
+            raise DecryptionError(f"Unsupported encryption format version {version}")
+        salt_start = len(MAGIC) + 5
+        salt = header[salt_start:salt_start + SALT_SIZE]
+        self.nonce_prefix = header[salt_start + SALT_SIZE:]
+        self.header = header
+        self.max_record = chunk_size + TAG_SIZE
+        self.cipher = AESGCM(derive_stream_key(password, salt))
+        self.counter = 0
+        self.buffer = b""
+        self.finished = False
+
+    def _next_record(self):
+        length_bytes = _read_exact(self.fileobj, 4)
+        if len(length_bytes) < 4:
+            raise DecryptionError("Encrypted backup is truncated (missing final chunk)")
+        (length,) = struct.unpack(">I", length_bytes)
+        if length < TAG_SIZE or length > self.max_record:
+            raise DecryptionError("Encrypted backup is corrupt (bad chunk length)")
+        sealed = _read_exact(self.fileobj, length)
+        if len(sealed) < length:
+            raise DecryptionError("Encrypted backup is truncated (partial chunk)")
+
+        # A record can only be opened with the final flag it was sealed with
+        for final in (False, True):
+            try:
+                data = self.cipher.decrypt(_record_nonce(self.nonce_prefix, self.counter, final), sealed, self.header)
+            except InvalidTag:
+                continue
+            self.counter += 1
+            if final:
+                self.finished = True
+                if self.fileobj.read(1):
+                    raise DecryptionError("Encrypted backup has trailing data after the final chunk")
+            return data
+        raise DecryptionError("Wrong password or corrupted backup chunk")
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.buffer]
+            self.buffer = b""
+            while not self.finished:
+                chunks.append(self._next_record())
+            return b"".join(chunks)
+
+        while len(self.buffer) < size and not self.finished:
+            self.buffer += self._next_record()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.buffer = b""
+
+
+# Encrypt `src_path` into `dst_path` chunk by chunk
+def encrypt_file(src_path, dst_path, password, chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        with EncryptingWriter(dst, password, chunk_size) as writer:
+            while True:
+                block = src.read(chunk_size)
+                if not block:
+                    break
+                writer.write(block)
+
+
+# Decrypt `src_path` into `dst_path` chunk by chunk
+def decrypt_file(src_path, dst_path, password):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        reader = DecryptingReader(src, password)
+        while True:
+            block = reader.read(DEFAULT_CHUNK_SIZE)
+            if not block:
+                break
+            dst.write(block)
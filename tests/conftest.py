@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine
+
+
+# Keep the catalog, manifest and locks of a test run out of the application directory
+@pytest.fixture
+def app_dir(tmp_path, monkeypatch):
+    state = tmp_path / 'app'
+    state.mkdir()
+    monkeypatch.setattr(engine, 'CATALOG_FILE', str(state / 'backup_catalog.db'))
+    monkeypatch.setattr(engine, 'METADATA_FILE', str(state / 'backup_metadata.json'))
+    monkeypatch.setattr(engine, 'MANIFEST_FILE', str(state / 'backup_manifest.db'))
+    monkeypatch.setattr(engine, 'JOURNAL_FILE', str(state / 'change_journal.db'))
+    monkeypatch.setattr(engine, 'LOCK_DIR', str(state / 'locks'))
+    return state
+
+
+def write_tree(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
@@ -0,0 +1,100 @@
+import io
+import os
+
+import pytest
+
+from delta import (DeltaError, SignatureBuilder, apply_delta, block_size_for, encode_delta, HEADER,
+                   FLAG_IN_PLACE)
+
+SIZE = 1024 * 1024
+FLAGS_OFFSET = 9    # after the magic and version
+
+
+def _signature(data):
+    builder = SignatureBuilder(block_size_for(len(data)))
+    builder.update(data)
+    return builder.finish()
+
+
+# Delta from `base` to `new`; without `in_place` it is applied by rebuilding the file
+def _delta(base, new, in_place=True):
+    out = io.BytesIO()
+    assert encode_delta(io.BytesIO(new), _signature(base), out) is not None
+    delta = bytearray(out.getvalue())
+    assert HEADER.unpack_from(delta)[2] & FLAG_IN_PLACE
+    if not in_place:
+        delta[FLAGS_OFFSET] &= ~FLAG_IN_PLACE
+    return bytes(delta)
+
+
+def _target(tmp_path, data):
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def base():
+    return os.urandom(SIZE)
+
+
+def _edited(base):
+    return base[:300000] + os.urandom(5000) + base[305000:] + b"appended"
+
+
+@pytest.mark.parametrize('in_place', [True, False])
+def test_round_trip(tmp_path, base, in_place):
+    new = _edited(base)
+    delta = _delta(base, new, in_place)
+    assert len(delta) < SIZE // 10
+    path = _target(tmp_path, base)
+    assert apply_delta(io.BytesIO(delta), path) == len(new)
+    assert _read(path) == new
+
+
+def test_shrinking_file(tmp_path, base):
+    new = base[:SIZE // 2]
+    path = _target(tmp_path, base)
+    apply_delta(io.BytesIO(_delta(base, new)), path)
+    assert _read(path) == new
+
+
+@pytest.mark.parametrize('in_place', [True, False])
+def test_checksum_mismatch_keeps_base(tmp_path, base, in_place):
+    delta = bytearray(_delta(base, _edited(base), in_place))
+    delta[-1] ^= 1  # The trailing BLAKE2b of the new version
+    path = _target(tmp_path, base)
+    with pytest.raises(DeltaError, match="Checksum mismatch"):
+        apply_delta(io.BytesIO(bytes(delta)), path)
+    assert _read(path) == base
+    assert not os.path.exists(path + '.delta-partial')
+
+
+@pytest.mark.parametrize('in_place', [True, False])
+def test_truncated_delta_keeps_base(tmp_path, base, in_place):
+    delta = _delta(base, _edited(base), in_place)
+    path = _target(tmp_path, base)
+    with pytest.raises(DeltaError):
+        apply_delta(io.BytesIO(delta[:len(delta) - 40]), path)
+    assert _read(path) == base
+
+
+def test_wrong_base_is_refused(tmp_path, base):
+    delta = _delta(base, _edited(base))
+    other = os.urandom(SIZE)
+    path = _target(tmp_path, other)
+    with pytest.raises(DeltaError):
+        apply_delta(io.BytesIO(delta), path)
+    assert _read(path) == other
+
+
+def test_not_a_delta(tmp_path, base):
+    path = _target(tmp_path, base)
+    with pytest.raises(DeltaError):
+        apply_delta(io.BytesIO(b"x" * 64), path)
@@ -0,0 +1,31 @@
+import os
+
+import engine
+
+
+def _add(catalog, dest, name, backup_type, timestamp, status='success'):
+    if status == 'success':
+        open(os.path.join(dest, name), 'wb').close()
+    return catalog.add_backup(name, backup_type, 1 if status == 'success' else 0, dest, name, source_set='s',
+                              status=status, timestamp=timestamp)
+
+
+def test_prune_ignores_failed_fulls(tmp_path, app_dir):
+    dest = str(tmp_path)
+    with engine.open_catalog() as catalog:
+        old_full = _add(catalog, dest, 'old_full.tar.gz', 'Full', '2024-01-01 00:00:00')
+        old_failed = _add(catalog, dest, 'old_failed.tar.gz', 'Incremental', '2024-01-01 12:00:00', 'failed')
+        _add(catalog, dest, 'full.tar.gz', 'Full', '2024-01-02 00:00:00')
+        _add(catalog, dest, 'failed.tar.gz', 'Full', '2024-01-03 00:00:00', 'failed')
+        incremental = _add(catalog, dest, 'incremental.tar.gz', 'Incremental', '2024-01-04 00:00:00')
+        _add(catalog, dest, 'cancelled.tar.gz', 'Full', '2024-01-05 00:00:00', 'cancelled')
+
+    removed = engine.prune_backups(1)
+
+    assert sorted(entry['id'] for entry in removed) == sorted([old_full['id'], old_failed['id']])
+    with engine.open_catalog() as catalog:
+        kept = [entry['backup_file'] for entry in catalog.iter_backups()]
+    assert kept == ['full.tar.gz', 'failed.tar.gz', 'incremental.tar.gz', 'cancelled.tar.gz']
+    assert os.path.exists(os.path.join(dest, 'incremental.tar.gz'))
+    assert not os.path.exists(os.path.join(dest, 'old_full.tar.gz'))
+    assert incremental['id'] not in [entry['id'] for entry in removed]
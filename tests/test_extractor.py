@@ -0,0 +1,29 @@
+import os
+
+import extractor
+from extractor import RestoreWriter
+
+
+def _restore(tmp_path, payloads):
+    with RestoreWriter(str(tmp_path), workers=4) as writer:
+        for name, data in payloads.items():
+            output = writer.create(name, len(data))
+            for offset in range(0, len(data), 4096):
+                writer.write(output, offset, data[offset:offset + 4096])
+            writer.close(output)
+        writer.finish()
+
+
+def test_restore_writes_files(tmp_path):
+    payloads = {'a.bin': os.urandom(100_000), os.path.join('sub', 'b.bin'): os.urandom(5000)}
+    _restore(tmp_path, payloads)
+    for name, data in payloads.items():
+        assert (tmp_path / name).read_bytes() == data
+
+
+def test_restore_without_pwrite(tmp_path, monkeypatch):
+    monkeypatch.delattr(extractor.os, 'pwrite', raising=False)
+    payloads = {f'f{i}.bin': os.urandom(50_000 + i) for i in range(8)}
+    _restore(tmp_path, payloads)
+    for name, data in payloads.items():
+        assert (tmp_path / name).read_bytes() == data
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import engine
+from point_in_time import restore_to_time
+from conftest import write_tree
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'seekable'])
+def test_restore_path_missing_from_latest_incremental(tmp_path, app_dir, archive_format):
+    source, dest, restored = str(tmp_path / 's'), str(tmp_path / 'dest'), str(tmp_path / 'restored')
+    os.makedirs(dest)
+    write_tree(source, {'a.txt': b'one', 'sub/b.txt': b'b'})
+    engine.run_backup([source], dest, archive_format=archive_format, use_journal=False)
+    write_tree(source, {'a.txt': b'two, longer'})
+    engine.run_backup([source], dest, 'Incremental', archive_format=archive_format, use_journal=False)
+
+    restore_to_time('2100-01-01', restored, source_dirs=[source], paths=['s/sub/b.txt'])
+    assert open(os.path.join(restored, 's', 'sub', 'b.txt'), 'rb').read() == b'b'
+    assert not os.path.exists(os.path.join(restored, 's', 'a.txt'))
+
+    restore_to_time('2100-01-01', restored, source_dirs=[source], paths=['s/a.txt'])
+    assert open(os.path.join(restored, 's', 'a.txt'), 'rb').read() == b'two, longer'
+
+
+def test_restore_path_matching_nothing_fails(tmp_path, app_dir):
+    source, dest = str(tmp_path / 's'), str(tmp_path / 'dest')
+    os.makedirs(dest)
+    write_tree(source, {'a.txt': b'one'})
+    engine.run_backup([source], dest, use_journal=False)
+    with pytest.raises(engine.BackupError):
+        restore_to_time('2100-01-01', str(tmp_path / 'restored'), source_dirs=[source], paths=['s/nothing'])
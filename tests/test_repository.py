@@ -0,0 +1,127 @@
+import glob
+import io
+import os
+
+import pytest
+
+import engine
+from repository import Chunker, Repository, RepositoryError, repository_path, MAX_CHUNK_SIZE
+from conftest import write_tree
+
+PASSWORD = 'pw'
+
+
+def _chunker():
+    return Chunker(b"test seed", min_size=256, avg_size=1024, max_size=4096)
+
+
+def test_chunks_reassemble_within_bounds():
+    data = os.urandom(200_000)
+    chunks = list(_chunker().chunks(io.BytesIO(data)))
+    assert b"".join(chunks) == data
+    assert all(256 <= len(chunk) <= 4096 for chunk in chunks[:-1])
+
+
+def test_chunk_boundaries_survive_an_insert():
+    data = os.urandom(200_000)
+    before = set(_chunker().chunks(io.BytesIO(data)))
+    after = list(_chunker().chunks(io.BytesIO(data[:1000] + b"inserted" + data[1000:])))
+    assert sum(chunk in before for chunk in after) >= len(after) - 3
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source, dest = str(tmp_path / 'src'), str(tmp_path / 'dest')
+    os.makedirs(dest)
+    write_tree(source, {'big.bin': os.urandom(3_000_000), 'sub/small.txt': b'hello', 'empty': b''})
+    os.symlink('sub/small.txt', os.path.join(source, 'link'))
+    return source, dest
+
+
+def _backup(tree, password=PASSWORD):
+    return engine.run_backup([tree[0]], tree[1], archive_format='repository', password=password, use_journal=False)
+
+
+def _restore(entry, location, password=PASSWORD, paths=None):
+    engine.restore_backup(engine.get_backup_path(entry), location, password, paths)
+    return os.path.join(location, 'src')
+
+
+def _contents(root):
+    found = {}
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root)
+            found[relative] = os.readlink(path) if os.path.islink(path) else open(path, 'rb').read()
+    return found
+
+
+def test_round_trip_and_deduplication(tree, tmp_path, app_dir):
+    write_tree(tree[0], {'big.bin': os.urandom(6 * MAX_CHUNK_SIZE)})
+    first = _backup(tree)
+    original = _contents(tree[0])
+    with open(os.path.join(tree[0], 'big.bin'), 'r+b') as f:
+        f.seek(3 * MAX_CHUNK_SIZE)
+        f.write(b"changed in place")
+    second = _backup(tree)
+
+    # An in-place edit can move at most the boundaries around it, so at most two chunks are new
+    stats = second['details']['repository']
+    assert stats['chunks_reused'] > 0
+    assert stats['bytes_stored'] < 2 * MAX_CHUNK_SIZE + 64 * 1024
+    assert _contents(_restore(first, str(tmp_path / 'first'))) == original
+    assert _contents(_restore(second, str(tmp_path / 'second'))) == _contents(tree[0])
+    restored = _restore(second, str(tmp_path / 'one'), paths=['src/sub/small.txt'])
+    assert _contents(restored) == {os.path.join('sub', 'small.txt'): b'hello'}
+
+
+def test_wrong_password(tree, tmp_path, app_dir):
+    entry = _backup(tree)
+    with pytest.raises(Exception):
+        _restore(entry, str(tmp_path / 'restored'), password='wrong')
+
+
+def test_garbage_collection(tree, tmp_path, app_dir):
+    first = _backup(tree)
+    # Nothing of the first snapshot stays referenced, so its pack can go
+    write_tree(tree[0], {'big.bin': os.urandom(3_000_000), 'sub/small.txt': b'changed', 'empty': b'now filled'})
+    second = _backup(tree)
+    packs = glob.glob(os.path.join(repository_path(tree[1]), 'packs', '*', '*.pack'))
+    assert len(packs) == 2
+
+    assert engine.collect_repository_garbage(tree[1], PASSWORD) == (0, 0)
+    engine.delete_backup(first['id'], PASSWORD)
+    removed, freed = engine.collect_repository_garbage(tree[1], PASSWORD)
+    assert removed == 1 and freed > 0
+    assert _contents(_restore(second, str(tmp_path / 'restored'))) == _contents(tree[0])
+
+
+def test_corrupted_pack(tree, tmp_path, app_dir):
+    entry = _backup(tree)
+    (pack,) = glob.glob(os.path.join(repository_path(tree[1]), 'packs', '*', '*.pack'))
+    with open(pack, 'r+b') as f:
+        f.seek(1000)
+        byte = f.read(1)
+        f.seek(1000)
+        f.write(bytes([byte[0] ^ 1]))
+    with Repository(repository_path(tree[1]), PASSWORD) as repository:
+        problems, _ = repository.verify_pack(os.path.basename(pack)[:-len('.pack')])
+    assert problems
+    with pytest.raises(Exception):
+        _restore(entry, str(tmp_path / 'restored'))
+
+
+def test_truncated_pack(tree, tmp_path, app_dir):
+    entry = _backup(tree)
+    (pack,) = glob.glob(os.path.join(repository_path(tree[1]), 'packs', '*', '*.pack'))
+    with open(pack, 'r+b') as f:
+        f.truncate(os.path.getsize(pack) // 2)
+    with pytest.raises(Exception):
+        _restore(entry, str(tmp_path / 'restored'))
+
+
+def test_unencrypted_repository_refuses_password_mismatch(tree, app_dir):
+    _backup(tree, password=None)
+    with pytest.raises(RepositoryError):
+        Repository(repository_path(tree[1]), PASSWORD)
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import engine
+from retention import RetentionPolicy, plan_retention, apply_retention
+from point_in_time import restore_to_time
+from conftest import write_tree
+
+
+def _entry(number, backup_type, timestamp, details=None):
+    return {'id': number, 'backup_type': backup_type, 'timestamp': timestamp, 'details': details or {}}
+
+
+def test_plan_merges_expired_backups_into_kept_ones():
+    entries = [
+        _entry(1, 'Full', '2024-01-01 00:00:00'),
+        _entry(2, 'Incremental', '2024-01-02 00:00:00'),
+        _entry(3, 'Incremental', '2024-01-02 12:00:00'),
+        _entry(4, 'Full', '2024-01-03 00:00:00'),
+        _entry(5, 'Incremental', '2024-01-03 06:00:00'),
+        _entry(6, 'Incremental', '2024-01-03 12:00:00'),
+    ]
+    kept, deletions, merges = plan_retention(entries, RetentionPolicy(daily=2, weekly=0, monthly=0))
+
+    assert sorted(kept) == [3, 6]
+    assert [entry['id'] for entry in deletions] == []
+    # Both chains collapse into their newest backup: 3 and 6 become synthetic fulls
+    assert [[entry['id'] for entry in segment] for segment in merges] == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_plan_deletes_chains_without_kept_points():
+    entries = [
+        _entry(1, 'Full', '2024-01-01 00:00:00'),
+        _entry(2, 'Incremental', '2024-01-01 12:00:00'),
+        _entry(3, 'Full', '2024-01-02 00:00:00'),
+    ]
+    kept, deletions, merges = plan_retention(entries, RetentionPolicy(daily=1, weekly=0, monthly=0))
+    assert sorted(kept) == [3]
+    assert [entry['id'] for entry in deletions] == [1, 2]
+    assert merges == []
+
+
+def test_plan_keeps_repository_snapshot_runs_whole():
+    snapshot = {'format': 'repository'}
+    entries = [
+        _entry(1, 'Full', '2024-01-01 00:00:00', snapshot),
+        _entry(2, 'Incremental', '2024-01-02 00:00:00', snapshot),
+    ]
+    kept, deletions, merges = plan_retention(entries, RetentionPolicy(daily=1, weekly=0, monthly=0))
+    assert sorted(kept) == [1, 2]
+    assert deletions == [] and merges == []
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'seekable'])
+def test_apply_builds_restorable_synthetic_full(tmp_path, app_dir, archive_format):
+    source, dest, restored = str(tmp_path / 's'), str(tmp_path / 'dest'), str(tmp_path / 'restored')
+    os.makedirs(dest)
+    write_tree(source, {'a.txt': b'one', 'gone.txt': b'old', 'sub/b.txt': b'b'})
+    engine.run_backup([source], dest, archive_format=archive_format, use_journal=False)
+    os.remove(os.path.join(source, 'gone.txt'))
+    write_tree(source, {'a.txt': b'two, longer'})
+    engine.run_backup([source], dest, 'Incremental', archive_format=archive_format, use_journal=False)
+
+    summary = apply_retention(RetentionPolicy(daily=1, weekly=0, monthly=0))
+
+    assert summary['kept'] == 1 and summary['deleted'] == []
+    assert [merge['backups'] for merge in summary['merged']] == [2]
+    with engine.open_catalog() as catalog:
+        (entry,) = catalog.iter_backups()
+    assert entry['backup_type'] == 'Full'
+    assert os.listdir(dest) == [entry['backup_file']]
+
+    restore_to_time('2100-01-01', restored, source_dirs=[source])
+    assert open(os.path.join(restored, 's', 'a.txt'), 'rb').read() == b'two, longer'
+    assert open(os.path.join(restored, 's', 'sub', 'b.txt'), 'rb').read() == b'b'
+    assert not os.path.exists(os.path.join(restored, 's', 'gone.txt'))
@@ -0,0 +1,61 @@
+import os
+import shutil
+
+import pytest
+
+import engine
+from point_in_time import restore_to_time
+from scanner import ScanStats, scan_tree
+from conftest import write_tree
+
+
+def test_scan_tree_missing_root_raises(tmp_path):
+    with pytest.raises(OSError):
+        list(scan_tree(str(tmp_path / 'missing')))
+
+
+def test_scan_tree_reports_unreadable_subtree(tmp_path, monkeypatch):
+    write_tree(tmp_path, {'a.txt': b'a', 'locked/b.txt': b'b'})
+    scandir = os.scandir
+    def failing_scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    stats = ScanStats()
+    paths = {scanned.path for scanned in scan_tree(str(tmp_path), stats=stats)}
+    assert paths == {'a.txt'}
+    assert stats.unreadable == [str(tmp_path / 'locked')]
+
+
+def test_incremental_of_missing_source_fails(tmp_path, app_dir):
+    source, dest = str(tmp_path / 'src'), str(tmp_path / 'dest')
+    os.makedirs(dest)
+    write_tree(source, {'a.txt': b'a', 'sub/b.txt': b'b'})
+    engine.run_backup([source], dest, use_journal=False)
+    shutil.move(source, str(tmp_path / 'moved'))
+    with pytest.raises(engine.BackupError):
+        engine.run_backup([source], dest, 'Incremental', use_journal=False)
+    with engine.open_catalog() as catalog:
+        assert [entry['status'] for entry in catalog.iter_backups()] == ['success', 'failed']
+
+
+def test_unreadable_subtree_is_not_recorded_as_deleted(tmp_path, app_dir, monkeypatch):
+    source, dest = str(tmp_path / 'src'), str(tmp_path / 'dest')
+    os.makedirs(dest)
+    write_tree(source, {'a.txt': b'a', 'sub/b.txt': b'b'})
+    engine.run_backup([source], dest, use_journal=False)
+
+    scandir = os.scandir
+    def failing_scandir(path):
+        if os.path.basename(path) == 'sub':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'scandir', failing_scandir)
+        entry = engine.run_backup([source], dest, 'Incremental', use_journal=False)
+    assert entry['details']['unreadable'] == [os.path.join(source, 'sub')]
+
+    restore_to_time('2100-01-01 00:00:00', str(tmp_path / 'restored'), source_dirs=[source])
+    restored = os.path.join(str(tmp_path / 'restored'), os.path.basename(source))
+    assert open(os.path.join(restored, 'sub', 'b.txt'), 'rb').read() == b'b'
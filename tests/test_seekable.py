@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from seekable import SeekableArchiveWriter, SeekableArchiveReader, SeekableArchiveError, is_seekable_archive
+from conftest import write_tree
+
+FILES = {
+    'a.txt': b'alpha\n' * 1000,
+    'dir/b.bin': os.urandom(300000),
+    'dir/sub/c.txt': b'',
+    'other/d.txt': b'delta\n' * 50,
+}
+
+
+def _write_archive(tmp_path, password=None, block_size=64 * 1024):
+    source = tmp_path / 'source'
+    write_tree(str(source), FILES)
+    archive = str(tmp_path / 'backup.abx')
+    with open(archive, 'wb') as f, SeekableArchiveWriter(f, password=password, block_size=block_size,
+                                                        workers=2) as writer:
+        for root, dirs, files in os.walk(source):
+            for name in sorted(dirs) + sorted(files):
+                path = os.path.join(root, name)
+                writer.add(os.path.relpath(path, source), path, os.lstat(path))
+    return archive
+
+
+def _read_tree(root):
+    found = {}
+    for current, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(current, name)
+            with open(path, 'rb') as f:
+                found[os.path.relpath(path, root)] = f.read()
+    return found
+
+
+@pytest.mark.parametrize('password', [None, 'secret'])
+def test_round_trip(tmp_path, password):
+    archive = _write_archive(tmp_path, password)
+    assert is_seekable_archive(archive)
+    with SeekableArchiveReader(archive, password) as reader:
+        reader.extract(str(tmp_path / 'out'))
+    assert _read_tree(tmp_path / 'out') == FILES
+
+
+def test_extract_selected_paths_reads_only_their_entries(tmp_path):
+    archive = _write_archive(tmp_path)
+    with SeekableArchiveReader(archive) as reader:
+        entries = reader.extract(str(tmp_path / 'out'), paths=['dir/sub', 'a.txt'])
+    assert sorted(entry['path'] for entry in entries) == ['a.txt', 'dir/sub', 'dir/sub/c.txt']
+    assert _read_tree(tmp_path / 'out') == {'a.txt': FILES['a.txt'], 'dir/sub/c.txt': b''}
+
+
+def test_extract_unknown_path_fails(tmp_path):
+    archive = _write_archive(tmp_path)
+    with SeekableArchiveReader(archive) as reader, pytest.raises(SeekableArchiveError, match='No entries match'):
+        reader.extract(str(tmp_path / 'out'), paths=['missing'])
+
+
+def test_missing_password_fails(tmp_path):
+    archive = _write_archive(tmp_path, 'secret')
+    with pytest.raises(SeekableArchiveError, match='Password is required'):
+        SeekableArchiveReader(archive)
+
+
+def test_truncated_archive_fails(tmp_path):
+    archive = _write_archive(tmp_path)
+    with open(archive, 'r+b') as f:
+        f.truncate(os.path.getsize(archive) - 10)
+    with pytest.raises(SeekableArchiveError, match='index is missing'):
+        SeekableArchiveReader(archive)
+
+
+def test_tampered_block_fails(tmp_path):
+    password = 'secret'
+    archive = _write_archive(tmp_path, password)
+    with SeekableArchiveReader(archive, password) as reader:
+        offset, stored_size, raw_size = reader.blocks[1]
+    with open(archive, 'r+b') as f:
+        f.seek(offset + stored_size // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    with SeekableArchiveReader(archive, password) as reader, pytest.raises(SeekableArchiveError, match='corrupted'):
+        reader.extract(str(tmp_path / 'out'))
@@ -0,0 +1,117 @@
+import io
+import os
+import struct
+
+import pytest
+
+from stream_crypto import (DecryptingReader, DecryptionError, EncryptingWriter, HEADER_SIZE, MAGIC, TAG_SIZE,
+                           decrypt_file, encrypt_file, is_stream_encrypted)
+
+PASSWORD = 'correct horse'
+CHUNK = 1000
+
+
+def _encrypt(data, password=PASSWORD, chunk_size=CHUNK):
+    out = io.BytesIO()
+    with EncryptingWriter(out, password, chunk_size) as writer:
+        for start in range(0, len(data), 777):
+            writer.write(data[start:start + 777])
+    return out.getvalue()
+
+
+def _decrypt(stream, password=PASSWORD, size=-1):
+    reader = DecryptingReader(io.BytesIO(stream), password)
+    if size < 0:
+        return reader.read()
+    return b"".join(iter(lambda: reader.read(size), b""))
+
+
+# Offsets of the records (length prefix included) after the header
+def _records(stream):
+    offsets = []
+    position = HEADER_SIZE
+    while position < len(stream):
+        offsets.append(position)
+        position += 4 + struct.unpack_from(">I", stream, position)[0]
+    return offsets
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 10 * CHUNK, 10 * CHUNK + 123])
+def test_round_trip(size):
+    data = os.urandom(size)
+    stream = _encrypt(data)
+    assert stream.startswith(MAGIC)
+    assert _decrypt(stream) == data
+    assert _decrypt(stream, size=100) == data
+
+
+def test_record_layout():
+    stream = _encrypt(os.urandom(3 * CHUNK + 10))
+    records = _records(stream)
+    # Full chunks, then the final record holding the tail
+    assert len(records) == 4
+    assert struct.unpack_from(">I", stream, records[0])[0] == CHUNK + TAG_SIZE
+    assert struct.unpack_from(">I", stream, records[-1])[0] == 10 + TAG_SIZE
+
+
+def test_wrong_password():
+    with pytest.raises(DecryptionError):
+        _decrypt(_encrypt(b"secret data"), password='wrong')
+
+
+def test_tampered_byte():
+    stream = bytearray(_encrypt(os.urandom(5 * CHUNK)))
+    stream[HEADER_SIZE + 4 + 10] ^= 1
+    with pytest.raises(DecryptionError):
+        _decrypt(bytes(stream))
+
+
+def test_tampered_header():
+    stream = bytearray(_encrypt(os.urandom(2 * CHUNK)))
+    stream[HEADER_SIZE - 1] ^= 1  # Part of the nonce prefix, bound to every record
+    with pytest.raises(DecryptionError):
+        _decrypt(bytes(stream))
+
+
+def test_truncated_at_record_boundary():
+    stream = _encrypt(os.urandom(5 * CHUNK))
+    with pytest.raises(DecryptionError, match="truncated"):
+        _decrypt(stream[:_records(stream)[-1]])
+
+
+def test_truncated_inside_record():
+    stream = _encrypt(os.urandom(5 * CHUNK))
+    with pytest.raises(DecryptionError, match="truncated"):
+        _decrypt(stream[:_records(stream)[2] + 50])
+
+
+def test_trailing_data():
+    with pytest.raises(DecryptionError, match="trailing"):
+        _decrypt(_encrypt(os.urandom(2 * CHUNK)) + b"more")
+
+
+def test_reordered_records():
+    stream = _encrypt(os.urandom(4 * CHUNK))
+    records = _records(stream)
+    first, second = stream[records[0]:records[1]], stream[records[1]:records[2]]
+    swapped = stream[:records[0]] + second + first + stream[records[2]:]
+    with pytest.raises(DecryptionError):
+        _decrypt(swapped)
+
+
+def test_not_encrypted():
+    assert not is_stream_encrypted(io.BytesIO(b"plain tar data"))
+    with pytest.raises(DecryptionError):
+        DecryptingReader(io.BytesIO(b"plain tar data" * 10), PASSWORD)
+
+
+def test_file_helpers(tmp_path):
+    data = os.urandom(3 * CHUNK + 5)
+    plain, encrypted, decrypted = (str(tmp_path / name) for name in ('plain', 'encrypted', 'decrypted'))
+    with open(plain, 'wb') as f:
+        f.write(data)
+    encrypt_file(plain, encrypted, PASSWORD, chunk_size=CHUNK)
+    assert is_stream_encrypted(encrypted)
+    decrypt_file(encrypted, decrypted, PASSWORD)
+    with open(decrypted, 'rb') as f:
+        assert f.read() == data
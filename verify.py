@@ -0,0 +1,336 @@
+import time
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import engine
+import storage
+from engine import BackupError
+from checksums import new_digest
+from compression import open_decompressed_stream, default_workers
+from seekable import SeekableArchiveReader, is_seekable_archive
+from repository import Repository, is_repository_snapshot, snapshot_repository
+
+# Integrity verification and scrubbing of stored backups.
+#
+# Nothing is extracted to disk. Each backup is checked at one of two levels:
+#   quick  the stored archive is hashed block by block and compared with the
+#          block checksums recorded when it was written (see checksums.py).
+#          This needs no password and no decompression. For a repository
+#          snapshot, every pack it uses is hashed and compared with its
+#          name, which is the BLAKE2b of its contents.
+#   deep   the archive is also decrypted and decompressed, and every file's
+#          content is checked against its recorded checksum; for a snapshot
+#          every chunk it uses is decoded and checked against its id.
+# Backups made before checksums were recorded always get the deep check,
+# the only one possible for them.
+#
+# Work is split into tasks (a slice of blocks, a group of packs, or decoding
+# one archive) that run on a thread pool, so several archives are checked at
+# once and one large archive is spread over several cores; hashing,
+# decompression and decryption all release the GIL.
+#
+# A scrub checks the backups that were verified least recently (never
+# verified ones first) until a time budget is spent. Every result is recorded
+# in the catalog, so nightly scrubs with a small budget cycle through the whole
+# store without one large burst of I/O. The budget is checked after every
+# block, pack and file, so one large backup cannot overrun it: where each task
+# stopped is saved as the backup's verification cursor, and the next run
+# carries on from there before starting anything else. (A tar archive is
+# streamed, so it is read again up to the cursor, but not hashed again.)
+SLICE_BLOCKS = 8        # stored blocks hashed per task
+PACKS_PER_TASK = 8      # repository packs checked per task
+READ_SIZE = 1024 * 1024
+
+
+def _result(entry, level):
+    return {'id': entry['id'], 'backup_file': entry['backup_file'], 'level': level, 'status': 'ok',
+            'errors': [], 'bytes': 0, 'files': 0}
+
+
+def _expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+# Tasks take `start`, the position saved when an earlier run stopped (None to start
+# afresh), and `deadline` (time.monotonic(), or None), and return (problems, bytes
+# checked, files checked, position); the position is None once the task is complete.
+
+# Hash blocks first..first+len(digests)-1 of a stored archive and compare them with `digests`
+def _check_blocks(path, block_size, first, digests, start=None, deadline=None):
+    problems = []
+    checked = 0
+    done = start or 0
+    if _expired(deadline):
+        return problems, checked, 0, done
+    with storage.open_input(path) as f:
+        f.seek((first + done) * block_size)
+        for number, expected in enumerate(digests[done:], first + done):
+            data = f.read(block_size)
+            checked += len(data)
+            if new_digest(data).digest() != expected:
+                problems.append(f"bytes {number * block_size}-{number * block_size + block_size - 1} "
+                                f"do not match their checksum")
+            done += 1
+            if done < len(digests) and _expired(deadline):
+                return problems, checked, 0, done
+    return problems, checked, 0, None
+
+
+# Decode a tar archive and check every file's content against `expected` {member name: digest}.
+# The position is the number of files checked and the names that did not match so far.
+def _decode_tar(path, password, expected, start=None, deadline=None):
+    skip = start['files'] if start else 0
+    mismatched = set(start['mismatched']) if start else set()
+    seen = set()
+    files = 0
+    if _expired(deadline):
+        return [], 0, 0, start
+    with engine.open_backup_for_reading(path, password) as stream:
+        with tarfile.open(fileobj=open_decompressed_stream(stream), mode="r|") as tar:
+            number = 0
+            for member in tar:
+                if not member.isreg():
+                    continue
+                seen.add(member.name)
+                number += 1
+                if number <= skip:
+                    continue
+                if files and _expired(deadline):
+                    return [], 0, files, {'files': number - 1, 'mismatched': sorted(mismatched)}
+                digest = new_digest()
+                f = tar.extractfile(member)
+                for data in iter(lambda: f.read(READ_SIZE), b""):
+                    digest.update(data)
+                # A merged archive may hold a file and its later deltas; the last member's checksum
+                # is recorded, so an earlier mismatch is cleared by a later match
+                if member.name in expected:
+                    if digest.digest() == expected[member.name]:
+                        mismatched.discard(member.name)
+                    else:
+                        mismatched.add(member.name)
+                files += 1
+    problems = [f"{name}: content does not match its checksum" for name in sorted(mismatched)]
+    problems += [f"{name}: missing from the archive" for name in sorted(set(expected) - seen)]
+    return problems, storage.size(path), files, None
+
+
+# Decode a seekable archive; its index carries every file's checksum. The position is the
+# number of files checked.
+def _decode_seekable(path, password, start=None, deadline=None):
+    problems = []
+    files = 0
+    skip = start or 0
+    if _expired(deadline):
+        return problems, 0, 0, skip
+    with SeekableArchiveReader(path, password) as reader:
+        number = 0
+        for entry in reader.entries:
+            if entry['type'] not in ('file', 'delta'):
+                continue
+            number += 1
+            if number <= skip:
+                continue
+            if files and _expired(deadline):
+                return problems, 0, files, number - 1
+            f = reader.open_entry(entry)
+            try:
+                while f.read(READ_SIZE):
+                    pass
+            except Exception as e:
+                problems.append(f"{entry['path']}: {e}")
+            files += 1
+    return problems, storage.size(path), files, None
+
+
+def _decode(path, password, expected, start=None, deadline=None):
+    if is_seekable_archive(path):
+        return _decode_seekable(path, password, start, deadline)
+    return _decode_tar(path, password, expected, start, deadline)
+
+
+# The position is the number of packs checked
+def _check_packs(repository, packs, deep, start=None, deadline=None):
+    problems = []
+    checked = 0
+    done = start or 0
+    for name, blobs in packs[done:]:
+        if _expired(deadline):
+            return problems, checked, 0, done
+        pack_problems, size = repository.verify_pack(name, blobs if deep else ())
+        problems += pack_problems
+        checked += size
+        done += 1
+    return problems, checked, 0, None
+
+
+# Function to plan the checks of one backup: returns (result, tasks, cleanup). A task is a
+# callable taking (start, deadline), as described above.
+def plan_backup(entry, password=None, deep=False):
+    path = engine.get_backup_path(entry)
+    summary = entry['details'].get('checksums')
+    level = 'deep' if deep or not summary else 'quick'
+    result = _result(entry, level)
+    if not storage.exists(path):
+        result.update(status='missing', errors=[f"Backup file does not exist: {path}"])
+        return result, [], None
+    snapshot = is_repository_snapshot(path)
+    if entry['encrypted'] and (level == 'deep' or snapshot) and not password:
+        result.update(status='error', errors=["Password is required to verify encrypted backups."])
+        return result, [], None
+
+    if snapshot:
+        repository = Repository(snapshot_repository(path), password if entry['encrypted'] else None)
+        try:
+            referenced = repository.referenced_blobs([repository.read_snapshot(path)])
+            packs, missing = repository.blob_locations(referenced)
+        except Exception:
+            repository.close()
+            raise
+        result['level'] = level = 'deep' if deep else 'quick'
+        result['errors'] = [f"blob {blob_id} is missing from the repository" for blob_id in sorted(missing)]
+        result['files'] = len(referenced)
+        packs = sorted(packs.items())
+        tasks = [lambda start, deadline, group=packs[first:first + PACKS_PER_TASK]:
+                 _check_packs(repository, group, deep, start, deadline)
+                 for first in range(0, len(packs), PACKS_PER_TASK)]
+        return result, tasks, repository.close
+
+    tasks = []
+    with engine.open_catalog() as catalog:
+        digests = catalog.block_checksums(entry['id']) if summary else []
+        expected = catalog.file_checksums(entry['id']) if level == 'deep' else {}
+    if digests:
+        stored_size = storage.size(path)
+        if stored_size != summary['size']:
+            result['errors'].append(f"archive is {stored_size} bytes, {summary['size']} were written")
+        block_size = summary['block_size']
+        tasks += [lambda start, deadline, first=first:
+                  _check_blocks(path, block_size, first, digests[first:first + SLICE_BLOCKS], start, deadline)
+                  for first in range(0, len(digests), SLICE_BLOCKS)]
+    if level == 'deep':
+        tasks.append(lambda start, deadline:
+                     _decode(path, password if entry['encrypted'] else None, expected, start, deadline))
+    return result, tasks, None
+
+
+# Function to verify backups on a thread pool. `entries` is any iterable of catalog entries;
+# with `budget` (seconds) every task stops once it is spent, and a backup whose check is
+# unfinished gets status 'partial' and a cursor in the catalog to resume from. Every result
+# is recorded in the catalog and passed to `on_result`. Returns the list of results.
+def verify_backups(entries, password=None, deep=False, workers=None, budget=None, progress=None, on_result=None):
+    workers = workers or default_workers()
+    deadline = time.monotonic() + budget if budget is not None else None
+    results = []
+    entries = iter(entries)
+    pending = {}        # future -> (backup id, task number)
+    open_backups = {}   # backup id -> {'result', 'tasks' left, 'cleanup', 'cursor'}
+
+    def finish(backup_id):
+        state = open_backups.pop(backup_id)
+        result, cursor = state['result'], state['cursor']
+        if state['cleanup'] is not None:
+            state['cleanup']()
+        with engine.open_catalog() as catalog:
+            if cursor['remaining']:
+                result['status'] = 'partial'
+                catalog.save_verification_cursor(backup_id, cursor)
+            else:
+                if result['errors'] and result['status'] == 'ok':
+                    result['status'] = 'corrupt'
+                catalog.record_verification(backup_id, result['status'], '\n'.join(result['errors'][:20]) or None)
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+        if progress is not None:
+            progress.advance(result['backup_file'], result['bytes'])
+
+    def start_next():
+        for entry in entries:
+            if _expired(deadline):
+                return False
+            try:
+                result, tasks, cleanup = plan_backup(entry, password, deep)
+                with engine.open_catalog() as catalog:
+                    saved = catalog.verification_cursor(entry['id'])
+            except Exception as e:
+                result, tasks, cleanup = _result(entry, 'deep' if deep else 'quick'), [], None
+                result.update(status='error' if isinstance(e, BackupError) else 'corrupt', errors=[str(e)])
+                saved = None
+            # Results of the tasks; a saved cursor only applies to the same plan
+            cursor = {'level': result['level'], 'tasks': len(tasks), 'errors': [], 'bytes': 0, 'files': 0,
+                      'remaining': {str(number): None for number in range(len(tasks))}}
+            if saved and saved['level'] == cursor['level'] and saved['tasks'] == cursor['tasks']:
+                cursor = saved
+                result['errors'] += cursor['errors']
+                result['bytes'] += cursor['bytes']
+                result['files'] += cursor['files']
+            open_backups[entry['id']] = {'result': result, 'tasks': len(cursor['remaining']), 'cleanup': cleanup,
+                                         'cursor': cursor}
+            if not cursor['remaining']:
+                finish(entry['id'])
+                continue
+            for number, start in cursor['remaining'].items():
+                pending[executor.submit(tasks[int(number)], start, deadline)] = (entry['id'], number)
+            return True
+        return False
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify') as executor:
+        try:
+            more = True
+            while True:
+                # Keep every worker busy, but plan only a little ahead of them
+                while more and len(pending) < 2 * workers:
+                    more = start_next()
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    backup_id, number = pending.pop(future)
+                    state = open_backups[backup_id]
+                    try:
+                        problems, checked, files, position = future.result()
+                    except BackupError as e:
+                        state['result']['status'] = 'error'
+                        problems, checked, files, position = [str(e)], 0, 0, None
+                    except Exception as e:
+                        problems, checked, files, position = [str(e)], 0, 0, None
+                    for totals in (state['result'], state['cursor']):
+                        totals['errors'] += problems
+                        totals['bytes'] += checked
+                        totals['files'] += files
+                    if position is None:
+                        del state['cursor']['remaining'][number]
+                    else:
+                        state['cursor']['remaining'][number] = position
+                    state['tasks'] -= 1
+                    if not state['tasks']:
+                        finish(backup_id)
+                if progress is not None:
+                    progress.check()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            for state in open_backups.values():
+                if state['cleanup'] is not None:
+                    state['cleanup']()
+            raise
+    return results
+
+
+# Function to verify the given backups, or every successful backup
+def verify(backup_ids=None, password=None, deep=False, workers=None, progress=None, on_result=None):
+    if backup_ids:
+        entries = [engine.get_backup(backup_id) for backup_id in backup_ids]
+    else:
+        with engine.open_catalog() as catalog:
+            entries = list(catalog.iter_backups(status='success'))
+    if progress is not None:
+        progress.add_totals(len(entries), sum(entry['size'] for entry in entries))
+    return verify_backups(entries, password, deep, workers, progress=progress, on_result=on_result)
+
+
+# Function to verify the least recently verified backups for at most `budget` seconds
+def scrub(budget, password=None, deep=False, workers=None, progress=None, on_result=None):
+    with engine.open_catalog() as catalog:
+        return verify_backups(catalog.iter_scrub_order(), password, deep, workers, budget=budget, progress=progress,
+                              on_result=on_result)